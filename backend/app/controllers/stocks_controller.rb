@@ -109,8 +109,9 @@ class StocksController < ApplicationController
 
   def popularity_ranking
     id = params[:id]
-    # First attempt to use the pre-built popularity rankings cache
-    cached_popularity_ranking = get_cache("popularity_rankings", id)
+    # First attempt to use the pre-built popularity rankings, which the scraper keeps outside of
+    # the generational cache
+    cached_popularity_ranking = $redis.hget "popularity_rankings", id
     res = nil
 
     if cached_popularity_ranking
@@ -139,6 +140,19 @@ class StocksController < ApplicationController
     render json: res
   end
 
+  def similar_stocks
+    id = params[:id]
+    res = with_cache(__method__.to_s, id) do
+      entries = SimilarInstrument.find_by_symbol id
+      raise NotFound unless entries
+      entries.map do |entry|
+        {symbol: entry["similar_symbol"], name: entry["similar_name"], rank: entry["rank"]}
+      end
+    end
+
+    render json: res
+  end
+
   def total_symbols
     hours_ago = hours_ago_param
     res = with_cache(__method__.to_s, "#{hours_ago}") do
@@ -1,23 +1,41 @@
 require 'date'
 
 module ApplicationHelper
+  # Bumped by the scraper every time a scrape finishes.  Cache hashes are namespaced by generation,
+  # so bumping it invalidates every entry at once and the old hashes expire on their own.
+  CACHE_GENERATION_KEY = "CACHE_GENERATION"
+  CACHE_HASH_TTL_SECONDS = 2 * 24 * 60 * 60
+
   def hash_hash(hash)
     hash.keys.sort.map { |key| hash[key] }.join("_")
   end
 
+  # The generation is read once per request so that all cache accesses of a request agree
+  def cache_generation
+    @cache_generation ||= $redis.get(CACHE_GENERATION_KEY).to_i
+  end
+
+  def generational_hash_name(hash_name)
+    "#{hash_name}:#{cache_generation}"
+  end
+
   def get_cache(hash_name, key)
-    $redis.hget hash_name, key
+    $redis.hget generational_hash_name(hash_name), key
   end
 
   # Inserts an item into the cache with a given hash name and key, returning whatever was inserted.
   def put_cache(hash_name, key, val, json)
     val = (json ? JSON.dump(val) : val)
-    $redis.hset hash_name, key, val
+    name = generational_hash_name(hash_name)
+    $redis.multi do |multi|
+      multi.hset name, key, val
+      multi.expire name, CACHE_HASH_TTL_SECONDS
+    end
     val
   end
 
   def delete_cache(hash_name, key)
-    $redis.hdel hash_name, key
+    $redis.hdel generational_hash_name(hash_name), key
   end
 
   # Given the name of the has in the cache to use, first attempts to retrieve an existing value
@@ -37,7 +55,7 @@ module ApplicationHelper
 
     # Lock the cache entry that we're trying to write to in order to ensure that we're not
     # computing the same expensive value that some other worker is already computing
-    lock_key = "#{hash_name}_#{key}"
+    lock_key = "#{generational_hash_name(hash_name)}_#{key}"
     ret = nil
     $lock_manager.lock(lock_key, 240000) do |locked|
       if locked
@@ -0,0 +1,13 @@
+class SimilarInstrument
+  def self.find_by_symbol(symbol)
+    instrument = MongoClient[:index].find({ symbol: symbol }).first
+    if !instrument
+      return nil
+    end
+    instrument_id = instrument[:instrument_id]
+
+    MongoClient[:similar_instruments]
+      .find({ instrument_id: instrument_id })
+      .sort({ rank: 1 })
+  end
+end
@@ -13,6 +13,7 @@ Rails.application.routes.draw do
       get :popularity_history_csv
       get :popularity_ranking
       get :quote_history
+      get :similar_stocks
     end
   end
 
@@ -22,8 +22,30 @@ mongo_client = MongoClient(mongo_url)
 
 redis_client = redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, db=0)
 
+async_mongo_client = None
+
 
 def get_db():
     """ Returns an instance of the MongoDB database for this project. """
 
     return mongo_client["robinhood"]
+
+
+def create_db():
+    """ Returns an instance of the MongoDB database for this project backed by a new client.
+    `MongoClient` isn't fork-safe, so every worker process needs to create its own. """
+
+    return MongoClient(mongo_url)["robinhood"]
+
+
+def get_async_db():
+    """ Returns an instance of the MongoDB database for this project backed by the asyncio Motor
+    driver.  The client is created lazily so that Motor is only required by code that uses it. """
+
+    global async_mongo_client
+    if async_mongo_client is None:
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        async_mongo_client = AsyncIOMotorClient(mongo_url)
+
+    return async_mongo_client["robinhood"]
@@ -0,0 +1,70 @@
+""" Writes history datasets as Parquet files partitioned by date.
+
+Every day is written to its own `date=YYYY-MM-DD/part-0.parquet` file, which pandas and pyarrow
+read back as a single dataset with a `date` column:
+
+    pandas.read_parquet("/path/to/output")
+
+Columns that repeat a small set of values, such as symbols, are dictionary-encoded.  pyarrow is
+imported lazily so that it's only required by code that actually writes Parquet. """
+
+from datetime import datetime
+import os
+from typing import Dict, List
+
+PARQUET_COMPRESSION = "snappy"
+
+
+def import_pyarrow():
+    """ Returns the `pyarrow` module, exiting with an error if it isn't installed. """
+
+    try:
+        import pyarrow
+        import pyarrow.parquet  # pylint: disable=unused-import
+    except ImportError:
+        print("ERROR: pyarrow must be installed to write Parquet files")
+        exit(1)
+
+    return pyarrow
+
+
+def get_partition_path(output_dir: str, day: datetime) -> str:
+    return os.path.join(output_dir, f"date={day.strftime('%Y-%m-%d')}", "part-0.parquet")
+
+
+def build_table(columns: Dict[str, list], types: Dict[str, str], dictionary_columns: List[str]):
+    """ Builds a table from the provided column values.  `types` maps every column to a pyarrow
+    type alias such as `"timestamp[ms]"` or `"float64"`. """
+
+    pyarrow = import_pyarrow()
+
+    arrays = []
+    for (name, values) in columns.items():
+        array = pyarrow.array(values, type=pyarrow.type_for_alias(types[name]))
+        if name in dictionary_columns:
+            array = array.dictionary_encode()
+        arrays.append(array)
+
+    return pyarrow.Table.from_arrays(arrays, names=list(columns.keys()))
+
+
+def write_day_partition(
+    output_dir: str,
+    day: datetime,
+    columns: Dict[str, list],
+    types: Dict[str, str],
+    dictionary_columns: List[str],
+) -> str:
+    """ Writes the rows of a day to its partition, replacing any previous export of that day.
+    Returns the path of the written file. """
+
+    pyarrow = import_pyarrow()
+
+    path = get_partition_path(output_dir, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    table = build_table(columns, types, dictionary_columns)
+    pyarrow.parquet.write_table(table, f"{path}.tmp", compression=PARQUET_COMPRESSION)
+    os.replace(f"{path}.tmp", path)
+
+    return path
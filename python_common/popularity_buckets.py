@@ -0,0 +1,194 @@
+""" Bucketed storage layout for popularity history.
+
+Instead of one document per instrument per scrape, each document in the `popularity_buckets`
+collection holds all popularities of a single instrument for one (UTC) day as parallel arrays of
+timestamps and values.  New popularities are appended to the bucket with `$push` upserts.
+
+The workers write buckets in addition to the regular `popularity` collection (which the backend
+keeps reading for its recent windows) when `BUCKETED_POPULARITY` is set.  Scripts that read
+popularity history should go through `iter_popularities`, which reads from whichever layout is
+enabled and yields documents in the same shape as the `popularity` collection. """
+
+from datetime import datetime, timedelta
+from os import environ
+from typing import Iterator, List, Optional
+
+import pymongo
+
+POPULARITY_BUCKETS_COLLECTION = "popularity_buckets"
+
+BUCKETED_POPULARITY_ENABLED = environ.get("BUCKETED_POPULARITY") == "1"
+
+# Holds a marker recording how much of the popularity history `migrate_popularity_buckets` covered
+MIGRATIONS_COLLECTION = "migrations"
+POPULARITY_MIGRATION_ID = "popularity_buckets"
+
+
+def get_bucket_day(timestamp: datetime) -> datetime:
+    """ Returns the start of the day that the provided timestamp's bucket covers. """
+
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def build_bucket_update_ops(popularity_map: dict, timestamp: datetime) -> List[pymongo.UpdateOne]:
+    """ Builds the upserts that append the provided popularities to their day buckets. """
+
+    day = get_bucket_day(timestamp)
+    return [
+        pymongo.UpdateOne(
+            {"instrument_id": instrument_id, "day": day},
+            {
+                "$push": {"timestamps": timestamp, "popularities": popularity},
+                "$inc": {"count": 1},
+            },
+            upsert=True,
+        )
+        for (instrument_id, popularity) in popularity_map.items()
+    ]
+
+
+def build_bucket_doc(instrument_id: str, day: datetime, docs: List[dict]) -> dict:
+    """ Builds a complete bucket out of popularity documents from the `popularity` collection. """
+
+    docs = sorted(docs, key=lambda doc: doc["timestamp"])
+    return {
+        "instrument_id": instrument_id,
+        "day": day,
+        "timestamps": [doc["timestamp"] for doc in docs],
+        "popularities": [doc["popularity"] for doc in docs],
+        "count": len(docs),
+    }
+
+
+def unpack_bucket(bucket: dict, start: datetime = None, end: datetime = None) -> List[dict]:
+    """ Returns the popularities in the provided bucket as documents shaped like the ones in the
+    `popularity` collection, ordered by timestamp and limited to `[start, end)`. """
+
+    docs = []
+    for (timestamp, popularity) in zip(bucket["timestamps"], bucket["popularities"]):
+        if (start is not None and timestamp < start) or (end is not None and timestamp >= end):
+            continue
+
+        docs.append(
+            {
+                "timestamp": timestamp,
+                "instrument_id": bucket["instrument_id"],
+                "popularity": popularity,
+            }
+        )
+
+    docs.sort(key=lambda doc: doc["timestamp"])
+    return docs
+
+
+def build_range_query(field: str, start: datetime, end: datetime) -> dict:
+    query = {}
+    if start is not None:
+        query["$gte"] = start
+    if end is not None:
+        query["$lt"] = end
+    return {field: query} if query else {}
+
+
+def iter_popularities(
+    db,
+    instrument_ids: List[str] = None,
+    start: datetime = None,
+    end: datetime = None,
+    order_by_instrument: bool = True,
+) -> Iterator[dict]:
+    """ Yields popularity documents (`timestamp`, `instrument_id`, `popularity`) with timestamps in
+    `[start, end)`, optionally only for the provided instruments.  Documents are ordered by
+    instrument ID and then timestamp, or only by timestamp if `order_by_instrument` is `False`. """
+
+    instrument_query = {} if instrument_ids is None else {"instrument_id": {"$in": instrument_ids}}
+
+    if not BUCKETED_POPULARITY_ENABLED:
+        sort = [("timestamp", pymongo.ASCENDING)]
+        if order_by_instrument:
+            sort.insert(0, ("instrument_id", pymongo.ASCENDING))
+
+        yield from db["popularity"].find(
+            {**instrument_query, **build_range_query("timestamp", start, end)},
+            projection={"_id": False, "timestamp": True, "instrument_id": True, "popularity": True},
+            sort=sort,
+        )
+        return
+
+    # Buckets are keyed by the start of their day, so the first one may start before `start`
+    day_query = build_range_query("day", start and get_bucket_day(start), end)
+    sort = [("day", pymongo.ASCENDING)]
+    if order_by_instrument:
+        sort.insert(0, ("instrument_id", pymongo.ASCENDING))
+    buckets = db[POPULARITY_BUCKETS_COLLECTION].find(
+        {**instrument_query, **day_query}, projection={"_id": False}, sort=sort
+    )
+
+    if order_by_instrument:
+        for bucket in buckets:
+            yield from unpack_bucket(bucket, start, end)
+        return
+
+    # Buckets of the same day overlap in time, so all of a day's popularities are merged before
+    # they're yielded
+    cur_day = None
+    day_docs = []
+    for bucket in buckets:
+        if bucket["day"] != cur_day:
+            day_docs.sort(key=lambda doc: doc["timestamp"])
+            yield from day_docs
+            cur_day = bucket["day"]
+            day_docs = []
+
+        day_docs.extend(unpack_bucket(bucket, start, end))
+
+    day_docs.sort(key=lambda doc: doc["timestamp"])
+    yield from day_docs
+
+
+def get_first_popularity_day(db) -> Optional[datetime]:
+    """ Returns the day of the oldest popularity, or `None` if there aren't any. """
+
+    if BUCKETED_POPULARITY_ENABLED:
+        oldest = db[POPULARITY_BUCKETS_COLLECTION].find_one(sort=[("day", pymongo.ASCENDING)])
+        return oldest and oldest["day"]
+
+    oldest = db["popularity"].find_one(sort=[("timestamp", pymongo.ASCENDING)])
+    return oldest and get_bucket_day(oldest["timestamp"])
+
+
+def get_last_popularity_day(db) -> Optional[datetime]:
+    """ Returns the day of the newest popularity, or `None` if there aren't any. """
+
+    if BUCKETED_POPULARITY_ENABLED:
+        newest = db[POPULARITY_BUCKETS_COLLECTION].find_one(sort=[("day", pymongo.DESCENDING)])
+        return newest and newest["day"]
+
+    newest = db["popularity"].find_one(sort=[("timestamp", pymongo.DESCENDING)])
+    return newest and get_bucket_day(newest["timestamp"])
+
+
+def get_day_range(start: datetime, end: datetime) -> Iterator[datetime]:
+    """ Yields the start of every day in `[start, end)`. """
+
+    day = get_bucket_day(start)
+    while day < end:
+        yield day
+        day += timedelta(days=1)
+
+
+def get_migrated_through(db) -> Optional[datetime]:
+    """ Returns the day before which the whole history of the `popularity` collection has been
+    migrated into buckets, or `None` if no migration has covered it yet. """
+
+    marker = db[MIGRATIONS_COLLECTION].find_one({"_id": POPULARITY_MIGRATION_ID})
+    return marker and marker["migrated_through"]
+
+
+def record_migrated_through(db, day: datetime):
+    """ Records that the history of the `popularity` collection has been migrated up to `day`,
+    never moving an earlier record back. """
+
+    db[MIGRATIONS_COLLECTION].update_one(
+        {"_id": POPULARITY_MIGRATION_ID}, {"$max": {"migrated_through": day}}, upsert=True
+    )
@@ -0,0 +1,155 @@
+""" Numeric quote parsing and an optional bucketed storage layout for quotes.
+
+Robinhood sends prices as decimal strings; they're parsed into floats once when quotes are
+ingested.  When `BUCKETED_QUOTES` is set, the quote worker also appends every quote to a
+per-instrument, per-day document in the `quotes_buckets` collection holding parallel arrays of all
+quote fields, in the same way as `popularity_buckets`.  Scripts should read quotes through
+`iter_quotes`, which reads from whichever layout is enabled and always yields numeric prices, even
+for documents stored before prices were parsed at ingest. """
+
+from datetime import datetime
+from os import environ
+from typing import Iterator, List, Optional
+
+import pymongo
+
+from python_common.popularity_buckets import build_range_query, get_bucket_day
+
+QUOTES_BUCKETS_COLLECTION = "quotes_buckets"
+
+BUCKETED_QUOTES_ENABLED = environ.get("BUCKETED_QUOTES") == "1"
+
+QUOTE_PRICE_KEYS = ["bid_price", "ask_price", "last_trade_price", "last_extended_hours_trade_price"]
+
+# Fields stored as parallel arrays in each bucket, in addition to `updated_at`
+BUCKETED_QUOTE_KEYS = QUOTE_PRICE_KEYS + ["bid_size", "ask_size"]
+
+
+def parse_price(price) -> float:
+    """ Parses a price sent by Robinhood as a decimal string, passing through prices that are
+    already numeric and returning `None` for missing prices. """
+
+    if price is None or price == "":
+        return None
+    return float(price)
+
+
+def parse_quote_prices(quote: dict) -> dict:
+    """ Returns a copy of the provided quote with all prices parsed into floats. """
+
+    return {
+        **quote,
+        **{key: parse_price(quote[key]) for key in QUOTE_PRICE_KEYS if key in quote},
+    }
+
+
+def build_quote_bucket_update_ops(quotes: List[dict]) -> List[pymongo.UpdateOne]:
+    """ Builds the upserts that append the provided (already parsed) quotes to their day buckets.
+    Quotes that are already in their bucket don't match the filter, so the upsert fails with a
+    duplicate key error on the bucket's unique index instead of appending them twice. """
+
+    ops = []
+    for quote in quotes:
+        updated_at = quote["updated_at"]
+        ops.append(
+            pymongo.UpdateOne(
+                {
+                    "instrument_id": quote["instrument_id"],
+                    "day": get_bucket_day(updated_at),
+                    "updated_at": {"$ne": updated_at},
+                },
+                {
+                    "$push": {
+                        "updated_at": updated_at,
+                        **{key: quote.get(key) for key in BUCKETED_QUOTE_KEYS},
+                    },
+                    "$inc": {"count": 1},
+                },
+                upsert=True,
+            )
+        )
+
+    return ops
+
+
+def unpack_quote_bucket(bucket: dict, start: datetime = None, end: datetime = None) -> List[dict]:
+    """ Returns the quotes in the provided bucket as documents shaped like the ones in the `quotes`
+    collection, ordered by `updated_at` and limited to `[start, end)`. """
+
+    docs = []
+    for (i, updated_at) in enumerate(bucket["updated_at"]):
+        if (start is not None and updated_at < start) or (end is not None and updated_at >= end):
+            continue
+
+        doc = {"instrument_id": bucket["instrument_id"], "updated_at": updated_at}
+        for key in BUCKETED_QUOTE_KEYS:
+            doc[key] = bucket[key][i]
+        docs.append(doc)
+
+    docs.sort(key=lambda doc: doc["updated_at"])
+    return docs
+
+
+def iter_quotes(
+    db,
+    instrument_ids: List[str] = None,
+    start: datetime = None,
+    end: datetime = None,
+    order_by_instrument: bool = True,
+) -> Iterator[dict]:
+    """ Yields quote documents with `updated_at` in `[start, end)` and numeric prices, optionally
+    only for the provided instruments.  Documents are ordered by instrument ID and then
+    `updated_at`, or only by `updated_at` if `order_by_instrument` is `False`. """
+
+    instrument_query = {} if instrument_ids is None else {"instrument_id": {"$in": instrument_ids}}
+
+    if not BUCKETED_QUOTES_ENABLED:
+        sort = [("updated_at", pymongo.ASCENDING)]
+        if order_by_instrument:
+            sort.insert(0, ("instrument_id", pymongo.ASCENDING))
+
+        for doc in db["quotes"].find(
+            {**instrument_query, **build_range_query("updated_at", start, end)},
+            projection={"_id": False},
+            sort=sort,
+        ):
+            yield parse_quote_prices(doc)
+        return
+
+    day_query = build_range_query("day", start and get_bucket_day(start), end)
+    sort = [("day", pymongo.ASCENDING)]
+    if order_by_instrument:
+        sort.insert(0, ("instrument_id", pymongo.ASCENDING))
+    buckets = db[QUOTES_BUCKETS_COLLECTION].find(
+        {**instrument_query, **day_query}, projection={"_id": False}, sort=sort
+    )
+
+    if order_by_instrument:
+        for bucket in buckets:
+            yield from unpack_quote_bucket(bucket, start, end)
+        return
+
+    cur_day = None
+    day_docs = []
+    for bucket in buckets:
+        if bucket["day"] != cur_day:
+            day_docs.sort(key=lambda doc: doc["updated_at"])
+            yield from day_docs
+            cur_day = bucket["day"]
+            day_docs = []
+
+        day_docs.extend(unpack_quote_bucket(bucket, start, end))
+
+    day_docs.sort(key=lambda doc: doc["updated_at"])
+    yield from day_docs
+
+
+def get_first_quote_day(db) -> Optional[datetime]:
+    """ Returns the day of the oldest quote, or `None` if there aren't any. """
+
+    if BUCKETED_QUOTES_ENABLED:
+        oldest = db[QUOTES_BUCKETS_COLLECTION].find_one(sort=[("day", pymongo.ASCENDING)])
+        return oldest and oldest["day"]
+
+    oldest = db["quotes"].find_one(sort=[("updated_at", pymongo.ASCENDING)])
+    return oldest and get_bucket_day(oldest["updated_at"])
@@ -0,0 +1,390 @@
+""" Declares the indexes that every MongoDB collection of the project needs and builds them.
+
+`ensure_indexes` is idempotent and builds indexes in the background, so it's safe to call every
+time a scraper or script starts.  Running this module directly can also build the indexes or
+verify that none of the queries that the scrapers, scripts, and backend rely on fall back to a
+collection scan:
+
+    python -m python_common.schema ensure
+    python -m python_common.schema verify """
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from os import environ
+from typing import List, Optional
+
+import click
+import pymongo
+from pymongo.errors import OperationFailure
+
+from python_common.db import get_db
+from python_common.popularity_buckets import (
+    BUCKETED_POPULARITY_ENABLED,
+    POPULARITY_BUCKETS_COLLECTION,
+    get_migrated_through,
+)
+from python_common.quote_buckets import QUOTES_BUCKETS_COLLECTION
+
+IndexSpec = namedtuple("IndexSpec", ["keys", "options"])
+
+# A query that is checked by `verify`.  `sort` may be `None`.
+QuerySpec = namedtuple("QuerySpec", ["description", "collection", "filter", "sort"])
+
+ASC = pymongo.ASCENDING
+DESC = pymongo.DESCENDING
+
+# If set, raw popularity documents are expired after this many days.  This deletes data that the
+# backend still serves: its popularity history endpoints, including `popularity_history_csv`, read
+# raw popularity documents, so they only return the retained days.  The full history is only kept
+# in `popularity_buckets` if `BUCKETED_POPULARITY` is enabled, so documents are only expired if it
+# is and `migrate_popularity_buckets` recorded that it migrated the history before the buckets.
+POPULARITY_RETENTION_DAYS = (
+    int(environ["POPULARITY_RETENTION_DAYS"]) if environ.get("POPULARITY_RETENTION_DAYS") else None
+)
+
+# `collMod` can't remove the TTL of an index, so expiry is turned off by setting the largest TTL
+NEVER_EXPIRE_SECONDS = 2 ** 31 - 1
+
+POPULARITY_TIMESTAMP_KEYS = [("timestamp", ASC)]
+
+
+def index(*keys, **options) -> IndexSpec:
+    return IndexSpec(list(keys), options)
+
+
+# The TTL of the popularity timestamp index isn't declared here; it's set in place by
+# `apply_popularity_expiry` so that changing `POPULARITY_RETENTION_DAYS` never conflicts with the
+# options that the index was built with.
+INDEXES = {
+    "popularity": [
+        index(("instrument_id", ASC), ("timestamp", ASC)),
+        index(*POPULARITY_TIMESTAMP_KEYS),
+    ],
+    # The quote worker relies on duplicate key errors to skip quotes that haven't changed
+    "quotes": [
+        index(("instrument_id", ASC), ("updated_at", ASC), unique=True),
+        index(("updated_at", ASC)),
+    ],
+    "fundamentals": [index(("instrument_id", ASC), unique=True)],
+    # The instrument scraper relies on duplicate key errors to detect symbols that moved
+    "index": [index(("instrument_id", ASC), unique=True), index(("symbol", ASC), unique=True)],
+    "total_change_per_day": [index(("day_id", ASC), ("instrument_id", ASC), unique=True)],
+    "total_change_per_day_sums": [index(("day_id", ASC), unique=True)],
+    POPULARITY_BUCKETS_COLLECTION: [
+        index(("instrument_id", ASC), ("day", ASC), unique=True),
+        index(("day", ASC)),
+    ],
+    QUOTES_BUCKETS_COLLECTION: [
+        index(("instrument_id", ASC), ("day", ASC), unique=True),
+        index(("day", ASC)),
+    ],
+    "category_popularity_daily": [
+        index(("day_id", ASC), ("category_type", ASC), ("category", ASC), unique=True),
+        index(("category_type", ASC), ("category", ASC), ("day_id", ASC)),
+    ],
+    "category_assignments": [index(("instrument_id", ASC), unique=True)],
+    "candles": [
+        index(
+            ("instrument_id", ASC),
+            ("interval", ASC),
+            ("bounds", ASC),
+            ("begins_at", ASC),
+            unique=True,
+        ),
+        index(("begins_at", ASC)),
+    ],
+    "candle_progress": [
+        index(
+            ("instrument_id", ASC), ("interval", ASC), ("span", ASC), ("bounds", ASC), unique=True
+        ),
+        index(("interval", ASC), ("span", ASC), ("bounds", ASC), ("fetched_at", ASC)),
+    ],
+    "similar_instruments": [
+        index(("instrument_id", ASC), ("similar_instrument_id", ASC), unique=True),
+        index(("instrument_id", ASC), ("rank", ASC)),
+    ],
+    "similar_instruments_progress": [
+        index(("instrument_id", ASC), unique=True),
+        index(("fetched_at", ASC)),
+    ],
+}
+
+
+def get_verify_queries() -> List[QuerySpec]:
+    """ Returns representative versions of the queries that are run against each collection. """
+
+    now = datetime.utcnow()
+    day = now.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    day_range = {"$gte": day, "$lt": day + timedelta(days=1)}
+    instrument_id = "00000000-0000-0000-0000-000000000000"
+
+    return [
+        QuerySpec(
+            "recent popularities",
+            "popularity",
+            {"timestamp": {"$gte": now - timedelta(hours=2)}},
+            [("timestamp", DESC)],
+        ),
+        QuerySpec(
+            "popularity history of an instrument",
+            "popularity",
+            {"instrument_id": instrument_id},
+            [("timestamp", ASC)],
+        ),
+        QuerySpec(
+            "popularities of a day by instrument",
+            "popularity",
+            {"timestamp": day_range},
+            [("instrument_id", ASC), ("timestamp", ASC)],
+        ),
+        QuerySpec(
+            "latest quote of an instrument",
+            "quotes",
+            {"instrument_id": instrument_id},
+            [("updated_at", DESC)],
+        ),
+        QuerySpec(
+            "popularities of a day by time",
+            "popularity",
+            {"timestamp": day_range, "popularity": {"$ne": None}},
+            [("timestamp", ASC)],
+        ),
+        QuerySpec("quotes of a day", "quotes", {"updated_at": day_range}, None),
+        QuerySpec(
+            "quotes of a day by time",
+            "quotes",
+            {"updated_at": day_range, "last_trade_price": {"$ne": None}},
+            [("updated_at", ASC)],
+        ),
+        QuerySpec(
+            "fundamentals of an instrument", "fundamentals", {"instrument_id": instrument_id}, None
+        ),
+        QuerySpec("instrument by ID", "index", {"instrument_id": instrument_id}, None),
+        QuerySpec("instrument by symbol", "index", {"symbol": "AAPL"}, None),
+        QuerySpec(
+            "total changes of a day",
+            "total_change_per_day",
+            {"day_id": day.strftime("%Y-%m-%d")},
+            None,
+        ),
+        QuerySpec(
+            "total change sums",
+            "total_change_per_day_sums",
+            {"abs_pop_diff_sum": {"$ne": 0}},
+            [("day_id", ASC)],
+        ),
+        QuerySpec(
+            "popularity buckets of an instrument",
+            POPULARITY_BUCKETS_COLLECTION,
+            {"instrument_id": instrument_id},
+            [("day", ASC)],
+        ),
+        QuerySpec("popularity buckets of a day", POPULARITY_BUCKETS_COLLECTION, {"day": day}, None),
+        QuerySpec(
+            "quote buckets of an instrument",
+            QUOTES_BUCKETS_COLLECTION,
+            {"instrument_id": instrument_id},
+            [("day", ASC)],
+        ),
+        QuerySpec("quote buckets of a day", QUOTES_BUCKETS_COLLECTION, {"day": day}, None),
+        QuerySpec(
+            "category popularity history",
+            "category_popularity_daily",
+            {"category_type": "sector", "category": "Technology Services"},
+            [("day_id", ASC)],
+        ),
+        QuerySpec(
+            "category popularities of a day",
+            "category_popularity_daily",
+            {"day_id": day.strftime("%Y-%m-%d")},
+            None,
+        ),
+        QuerySpec(
+            "daily candles of an instrument",
+            "candles",
+            {"instrument_id": instrument_id, "interval": "day", "bounds": "regular"},
+            [("begins_at", ASC)],
+        ),
+        QuerySpec(
+            "recently fetched candle progress",
+            "candle_progress",
+            {
+                "interval": "day",
+                "span": "year",
+                "bounds": "regular",
+                "fetched_at": {"$gte": now - timedelta(hours=20)},
+            },
+            None,
+        ),
+        QuerySpec(
+            "similar instruments of an instrument",
+            "similar_instruments",
+            {"instrument_id": instrument_id},
+            [("rank", ASC)],
+        ),
+        QuerySpec(
+            "recently fetched similar instruments progress",
+            "similar_instruments_progress",
+            {"fetched_at": {"$gte": now - timedelta(hours=24 * 7)}},
+            None,
+        ),
+    ]
+
+
+def format_keys(keys: list) -> str:
+    return ", ".join(f"{key}: {direction}" for (key, direction) in keys)
+
+
+def get_popularity_expiry_seconds(db) -> Optional[int]:
+    """ Returns after how many seconds raw popularity documents expire, or `None` if they're kept.
+    They're only expired if their history is kept in `popularity_buckets`. """
+
+    if POPULARITY_RETENTION_DAYS is None:
+        return None
+    if not BUCKETED_POPULARITY_ENABLED or get_migrated_through(db) is None:
+        print(
+            "WARNING: Not expiring raw popularities since bucketed popularity storage isn't "
+            "enabled or the history hasn't been migrated; set `BUCKETED_POPULARITY=1` and run "
+            "`migrate_popularity_buckets` before setting `POPULARITY_RETENTION_DAYS`"
+        )
+        return None
+
+    return int(timedelta(days=POPULARITY_RETENTION_DAYS).total_seconds())
+
+
+def apply_popularity_expiry(db) -> List[str]:
+    """ Sets the TTL of the popularity timestamp index with `collMod`.  Returns a description of
+    the index if its TTL couldn't be changed. """
+
+    expire_after_seconds = get_popularity_expiry_seconds(db)
+    timestamp_index = next(
+        (
+            info
+            for info in db["popularity"].index_information().values()
+            if info["key"] == POPULARITY_TIMESTAMP_KEYS
+        ),
+        {},
+    )
+    current_seconds = timestamp_index.get("expireAfterSeconds")
+
+    if expire_after_seconds is None:
+        if current_seconds in (None, NEVER_EXPIRE_SECONDS):
+            return []
+        expire_after_seconds = NEVER_EXPIRE_SECONDS
+    elif current_seconds == expire_after_seconds:
+        return []
+
+    try:
+        db.command(
+            "collMod",
+            "popularity",
+            index={
+                "keyPattern": dict(POPULARITY_TIMESTAMP_KEYS),
+                "expireAfterSeconds": expire_after_seconds,
+            },
+        )
+    except OperationFailure as e:
+        # Servers before MongoDB 5.1 can only change the TTL of an index that was built with one
+        failure = f"popularity ({format_keys(POPULARITY_TIMESTAMP_KEYS)})"
+        print(f"ERROR: Failed to set the TTL of the index on {failure}: {e}")
+        return [failure]
+
+    print(f"Set the TTL of raw popularities to {expire_after_seconds} seconds")
+    return []
+
+
+def ensure_indexes(db, collections: List[str] = None) -> List[str]:
+    """ Builds all declared indexes, or only those of the provided collections, in the background.
+    Indexes that already exist are left alone, and raw popularity documents are only expired if
+    their history is kept in `popularity_buckets`.  Returns a description of every index that
+    couldn't be built. """
+
+    failures = []
+    for (collection_name, specs) in INDEXES.items():
+        if collections is not None and collection_name not in collections:
+            continue
+
+        existing_keys = [info["key"] for info in db[collection_name].index_information().values()]
+        for spec in specs:
+            if spec.keys in existing_keys:
+                continue
+
+            try:
+                db[collection_name].create_index(spec.keys, background=True, **spec.options)
+            except OperationFailure as e:
+                failure = f"{collection_name} ({format_keys(spec.keys)})"
+                print(f"ERROR: Failed to build index on {failure}: {e}")
+                failures.append(failure)
+
+    if collections is None or "popularity" in collections:
+        failures.extend(apply_popularity_expiry(db))
+
+    return failures
+
+
+def get_plan_stages(plan) -> List[str]:
+    """ Returns the names of all stages in a query plan returned by `explain()`. """
+
+    stages = []
+    if isinstance(plan, dict):
+        if isinstance(plan.get("stage"), str):
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(get_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(get_plan_stages(value))
+
+    return stages
+
+
+def explain_query(db, query: QuerySpec) -> List[str]:
+    """ Returns the stages of the winning plan of the provided query. """
+
+    cursor = db[query.collection].find(query.filter)
+    if query.sort is not None:
+        cursor = cursor.sort(query.sort)
+
+    return get_plan_stages(cursor.explain()["queryPlanner"]["winningPlan"])
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--collection", "collections", multiple=True, help="Only build these collections")
+def ensure(collections: tuple):
+    failures = ensure_indexes(get_db(), list(collections) or None)
+    if failures:
+        exit(1)
+
+    print("All indexes built.")
+
+
+@cli.command()
+def verify():
+    db = get_db()
+
+    collection_scans = 0
+    for query in get_verify_queries():
+        stages = explain_query(db, query)
+        if "COLLSCAN" in stages:
+            collection_scans += 1
+            status = "COLLSCAN"
+        elif "SORT" in stages:
+            status = "IXSCAN + in-memory sort"
+        else:
+            status = "IXSCAN"
+        print(f"{query.collection}: {query.description}: {status}")
+
+    if collection_scans:
+        print(f"ERROR: {collection_scans} queries would scan their entire collection")
+        exit(1)
+
+    print("No queries would scan their entire collection.")
+
+
+if __name__ == "__main__":
+    cli()
@@ -16,7 +16,8 @@ export PYTHONPATH="${PWD}/../"
 until python src/worker.py \
 	--mode $1 \
 	--rabbitmq_host=$RABBITMQ_HOST \
-	--rabbitmq_port=$RABBITMQ_PORT; do
+	--rabbitmq_port=$RABBITMQ_PORT \
+	"${@:2}"; do
 	echo "Popularities scraper exited with code $?.  Restarting in 10 seconds..."
 	sleep 10
 done
@@ -0,0 +1,187 @@
+""" Defines an asyncio-based popularity worker.  Rather than handling one batch of instrument IDs at
+a time like the worker in `worker.py`, it consumes several messages from RabbitMQ at once and keeps
+multiple popularity requests in flight, writing results to MongoDB through an async driver.
+Requests are paced by the popularity rate limiter shared with all other workers. """
+
+import asyncio
+import datetime
+
+import aio_pika
+import aiohttp
+
+from python_common.db import get_async_db
+from python_common.popularity_buckets import (
+    BUCKETED_POPULARITY_ENABLED,
+    POPULARITY_BUCKETS_COLLECTION,
+    build_bucket_update_ops,
+)
+
+from db import record_popularities, set_popularities_finished
+from queue_metrics import record_queue_lag
+from rate_limiter import SharedRateLimiter
+from retry import (
+    RetryableError,
+    get_dead_letter_queue,
+    raise_for_response,
+    run_with_retries_async,
+)
+from utils import build_popularity_docs, parse_popularity_results
+
+POPULARITY_URL = "https://api.robinhood.com/instruments/popularity/?ids={}"
+
+
+async def fetch_popularity_batch(
+    session: aiohttp.ClientSession, rate_limiter: SharedRateLimiter, instrument_ids: str
+) -> dict:
+    """ Makes a single attempt at fetching the popularity for a comma-separated batch of instrument
+    IDs, returning a dict mapping instrument ID to popularity.  Failures are signalled by raising
+    the errors from `retry`. """
+
+    await rate_limiter.acquire_async()
+
+    try:
+        async with session.get(POPULARITY_URL.format(instrument_ids)) as res:
+            body = await res.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise RetryableError("Error while fetching popularity: {}".format(e))
+    except ValueError:
+        raise RetryableError("Robinhood API sending back HTML")
+
+    raise_for_response(body)
+    try:
+        popularities = parse_popularity_results(body["results"])
+    except (TypeError, KeyError):
+        raise RetryableError("Robinhood sent back garbage: {}".format(body))
+
+    await asyncio.get_event_loop().run_in_executor(None, rate_limiter.report_success)
+    return popularities
+
+
+async def consume_popularity(
+    rabbitmq_host: str,
+    rabbitmq_port: int,
+    headers: dict,
+    prefetch: int,
+    concurrency: int,
+    management_url: str,
+    lag_report_interval_seconds: float,
+):
+    connection = await aio_pika.connect_robust(host=rabbitmq_host, port=rabbitmq_port)
+    channel = await connection.channel()
+    await channel.set_qos(prefetch_count=prefetch)
+    queue = await channel.declare_queue("instrument_ids")
+    dead_letter_queue = get_dead_letter_queue("instrument_ids")
+    await channel.declare_queue(dead_letter_queue)
+    print("rabbitmq connection init'd")
+
+    collection = get_async_db()["popularity"]
+    buckets_collection = get_async_db()[POPULARITY_BUCKETS_COLLECTION]
+    rate_limiter = SharedRateLimiter("popularity")
+    semaphore = asyncio.Semaphore(concurrency)
+    in_flight = set()
+    loop = asyncio.get_event_loop()
+
+    async def store_popularities(popularities: dict):
+        """ Stores a fetched batch.  Neither write is idempotent, so this is only called once per
+        batch rather than being retried. """
+
+        timestamp = datetime.datetime.utcnow()
+        await collection.insert_many(build_popularity_docs(popularities, timestamp))
+        if BUCKETED_POPULARITY_ENABLED:
+            await buckets_collection.bulk_write(
+                build_bucket_update_ops(popularities, timestamp), ordered=False
+            )
+
+        # The batch is already persisted at this point, so failing to update the rankings mustn't
+        # cause it to be dead-lettered
+        try:
+            await loop.run_in_executor(None, record_popularities, popularities, timestamp)
+        except Exception as e:  # pylint: disable=W0703
+            print(f"ERROR: Failed to record popularities in the rankings: {e}")
+        print(f"Stored popularities for {len(popularities)} instruments")
+
+    async def handle_message(session: aiohttp.ClientSession, message, instrument_ids: str):
+        popularities = {}
+
+        async def attempt():
+            popularities.update(await fetch_popularity_batch(session, rate_limiter, instrument_ids))
+
+        try:
+            try:
+                # Only the fetch is retried; the popularities are stored once it has succeeded
+                error = await run_with_retries_async(attempt, rate_limiter)
+                if error is None:
+                    await store_popularities(popularities)
+            except Exception as e:  # pylint: disable=W0703
+                error = e
+
+            if error is not None:
+                print("Giving up on batch; moving it to {}: {}".format(dead_letter_queue, error))
+                await channel.default_exchange.publish(
+                    aio_pika.Message(
+                        message.body,
+                        headers={"x-source-queue": "instrument_ids", "x-error": repr(error)},
+                    ),
+                    routing_key=dead_letter_queue,
+                )
+
+            await message.ack()
+        finally:
+            semaphore.release()
+
+    async def report_lag():
+        while True:
+            await loop.run_in_executor(None, record_queue_lag, management_url, "instrument_ids")
+            await asyncio.sleep(lag_report_interval_seconds)
+
+    if lag_report_interval_seconds > 0:
+        loop.create_task(report_lag())
+
+    timeout = aiohttp.ClientTimeout(total=15)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(
+        headers=headers, timeout=timeout, connector=connector
+    ) as session:
+        async with queue.iterator() as queue_iter:
+            async for message in queue_iter:
+                instrument_ids = message.body.decode("utf-8")
+
+                if instrument_ids == "__DONE":
+                    # Make sure that everything before the DONE message has been stored before
+                    # marking the scrape as finished
+                    if in_flight:
+                        await asyncio.wait(in_flight)
+
+                    print("Received DONE message for popularity fetching; marking as complete...")
+                    await loop.run_in_executor(None, set_popularities_finished)
+                    await message.ack()
+                    continue
+
+                await semaphore.acquire()
+                task = loop.create_task(handle_message(session, message, instrument_ids))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+
+
+def run_popularity_worker(
+    rabbitmq_host: str,
+    rabbitmq_port: int,
+    headers: dict,
+    prefetch: int,
+    concurrency: int,
+    management_url: str,
+    lag_report_interval_seconds: float,
+):
+    """ Runs the async popularity worker until the process is killed. """
+
+    asyncio.run(
+        consume_popularity(
+            rabbitmq_host,
+            rabbitmq_port,
+            headers,
+            prefetch,
+            concurrency,
+            management_url,
+            lag_report_interval_seconds,
+        )
+    )
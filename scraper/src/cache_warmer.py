@@ -0,0 +1,226 @@
+""" Pre-computes the backend's popularity change responses and writes them into the next cache
+generation before it goes live, so that no user request ever has to wait for them to be computed
+from MongoDB after a scrape.
+
+Every standard lookback window, endpoint, and `min_popularity` bucket is computed from a single
+pass over the recent popularity documents. """
+
+from datetime import datetime, timedelta
+import heapq
+import json
+from typing import Dict, List, Tuple
+
+from python_common.popularity_buckets import iter_popularities
+
+# Must match `CACHE_HASH_TTL_SECONDS` in the backend's `ApplicationHelper`
+CACHE_HASH_TTL_SECONDS = 2 * 24 * 60 * 60
+
+# Default page size and start index used by the frontend for the popularity changes tables
+DEFAULT_LIMIT = 50
+DEFAULT_START_INDEX = 0
+
+# Lookback windows of the popularity changes tables that are warmed
+WARMUP_HOURS_AGO = [1, 2, 4, 8, 24, 48, 168]
+
+# Must match the values accepted by `min_popularity_param` in the backend's `PopularitiesController`
+MIN_POPULARITY_BUCKETS = [1, 10, 50, 100, 500, 1000, 10000]
+
+SORT_ASCENDING = 1
+SORT_DESCENDING = -1
+
+# Cache hash name -> (sort direction, whether to sort by the absolute value of the difference)
+ENDPOINTS = {
+    "largest_popularity_changes": (SORT_DESCENDING, True),
+    "largest_popularity_increases": (SORT_DESCENDING, False),
+    "largest_popularity_decreases": (SORT_ASCENDING, False),
+}
+
+# Number of cache entries written per pipeline
+WRITE_CHUNK_SIZE = 100
+
+
+def get_generational_hash_name(hash_name: str, generation: int) -> str:
+    """ Returns the name of the cache hash in the given generation, matching
+    `generational_hash_name` in the backend's `ApplicationHelper`. """
+
+    return f"{hash_name}:{generation}"
+
+
+def get_backend_hours_ago(hours_ago: int) -> int:
+    """ The backend serves one hour lookbacks as two hours since there's never more than one
+    update per hour. """
+
+    return 2 if hours_ago == 1 else hours_ago
+
+
+def format_option(value) -> str:
+    """ Formats an option value the same way that Ruby's `to_s` does. """
+
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+
+def hash_options(options: dict) -> str:
+    """ Builds the cache key for a set of request options, matching `hash_hash` in the backend's
+    `ApplicationHelper`. """
+
+    return "_".join(format_option(options[key]) for key in sorted(options))
+
+
+def dump_response(response) -> str:
+    """ Serializes a response the same way that Ruby's `JSON.dump` does. """
+
+    return json.dumps(response, separators=(",", ":"), ensure_ascii=False)
+
+
+def collect_window_popularities(db, hours_agos: List[int]) -> Dict[int, Dict[str, Tuple[int, int]]]:
+    """ Returns a dict mapping each lookback window to a dict of instrument ID to the instrument's
+    earliest and latest popularity within that window, reading each popularity document once.
+    Popularities are read from whichever storage layout is enabled. """
+
+    now = datetime.utcnow()
+    # Oldest cutoff first
+    cutoffs = sorted((now - timedelta(hours=hours_ago), hours_ago) for hours_ago in set(hours_agos))
+    starts = {hours_ago: {} for hours_ago in hours_agos}
+    ends = {}
+
+    for doc in iter_popularities(db, start=cutoffs[0][0], order_by_instrument=False):
+        instrument_id = doc["instrument_id"]
+        popularity = doc["popularity"]
+        ends[instrument_id] = popularity
+
+        for (cutoff, hours_ago) in cutoffs:
+            if doc["timestamp"] < cutoff:
+                break
+
+            window_starts = starts[hours_ago]
+            if instrument_id not in window_starts:
+                window_starts[instrument_id] = popularity
+
+    return {
+        hours_ago: {
+            instrument_id: (start, ends[instrument_id])
+            for (instrument_id, start) in window_starts.items()
+        }
+        for (hours_ago, window_starts) in starts.items()
+    }
+
+
+def rank_popularity_differences(
+    popularities: Dict[str, Tuple[int, int]],
+    sort_direction: int,
+    take_absolute_value: bool,
+    percentage: bool,
+    min_popularity: int,
+    limit: int,
+    start_index: int = DEFAULT_START_INDEX,
+) -> List[tuple]:
+    """ Ranks instruments by the difference between their start and end popularity the same way
+    that `popularity_difference_lookup` in the backend's `Popularity` model does, returning a list
+    of `(instrument_id, start_popularity, end_popularity, popularity_difference)`. """
+
+    entries = []
+    for (instrument_id, (start, end)) in popularities.items():
+        if min_popularity is not None and start < min_popularity:
+            continue
+
+        if not percentage:
+            difference = end - start
+        elif start == 0:
+            difference = None
+        else:
+            difference = 100 * ((end - start) / start)
+        entries.append((instrument_id, start, end, difference))
+
+    def sort_key(entry):
+        difference = entry[3]
+        if difference is None:
+            return (True, 0)
+        if take_absolute_value:
+            difference = abs(difference)
+        return (False, difference * sort_direction)
+
+    # Entries without a difference are always sorted last
+    return heapq.nsmallest(start_index + limit, entries, key=sort_key)[start_index:]
+
+
+def get_warmup_options(hours_ago: int) -> List[dict]:
+    """ Returns the request options, as built by the backend, of every view of the popularity
+    changes tables that is warmed for the provided lookback window. """
+
+    base_options = {
+        "hours_ago": get_backend_hours_ago(hours_ago),
+        "limit": DEFAULT_LIMIT,
+        "start_index": DEFAULT_START_INDEX,
+    }
+    all_options = [{**base_options, "percentage": False, "min_popularity": None}]
+    for min_popularity in MIN_POPULARITY_BUCKETS:
+        all_options.append({**base_options, "percentage": True, "min_popularity": min_popularity})
+    return all_options
+
+
+def warm_cache(redis_client, get_db, generation: int):
+    """ Writes every standard view of the popularity changes tables into the provided cache
+    generation. """
+
+    db = get_db()
+    hours_agos = sorted({get_backend_hours_ago(hours_ago) for hours_ago in WARMUP_HOURS_AGO})
+    print(f"Collecting popularities for the last {hours_agos[-1]} hours...")
+    popularities_by_window = collect_window_popularities(db, hours_agos)
+
+    # (hash name, cache key, ranked entries)
+    ranked = []
+    for hours_ago in hours_agos:
+        popularities = popularities_by_window[hours_ago]
+        for options in get_warmup_options(hours_ago):
+            for (hash_name, (sort_direction, take_absolute_value)) in ENDPOINTS.items():
+                entries = rank_popularity_differences(
+                    popularities,
+                    sort_direction,
+                    take_absolute_value,
+                    options["percentage"],
+                    options["min_popularity"],
+                    options["limit"],
+                    options["start_index"],
+                )
+                ranked.append((hash_name, hash_options(options), entries))
+
+    instrument_ids = list({entry[0] for (_, _, entries) in ranked for entry in entries})
+    data_by_instrument_id = {
+        datum["instrument_id"]: datum
+        for datum in db["index"].find(
+            {"instrument_id": {"$in": instrument_ids}},
+            projection={"_id": False, "instrument_id": True, "simple_name": True, "symbol": True},
+        )
+    }
+
+    print(f"Writing {len(ranked)} entries into cache generation {generation}...")
+    for i in range(0, len(ranked), WRITE_CHUNK_SIZE):
+        pipe = redis_client.pipeline(transaction=False)
+        for (hash_name, key, entries) in ranked[i : i + WRITE_CHUNK_SIZE]:
+            response = []
+            for (instrument_id, start, end, difference) in entries:
+                datum = data_by_instrument_id.get(instrument_id, {})
+                response.append(
+                    {
+                        "start_popularity": start,
+                        "end_popularity": end,
+                        "popularity_difference": difference,
+                        "symbol": datum.get("symbol"),
+                        "name": datum.get("simple_name"),
+                    }
+                )
+
+            pipe.hset(
+                get_generational_hash_name(hash_name, generation), key, dump_response(response)
+            )
+        pipe.execute()
+
+    pipe = redis_client.pipeline(transaction=False)
+    for hash_name in ENDPOINTS:
+        pipe.expire(get_generational_hash_name(hash_name, generation), CACHE_HASH_TTL_SECONDS)
+    pipe.execute()
+    print(f"Finished warming cache generation {generation}")
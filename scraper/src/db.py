@@ -1,9 +1,23 @@
 """ Utilities for interacting with MongoDB """
 
 
+from os import environ
+
 from python_common.db import redis_client, get_db
 
-from popularity_ranking import populate_popularity_rankings
+from cache_warmer import warm_cache
+from popularity_ranking import (
+    invalidate_ranking_metadata,
+    maybe_refresh_popularity_rankings,
+    populate_popularity_rankings,
+    record_latest_popularities,
+)
+
+# Incremented every time a scrape finishes, invalidating every backend cache entry at once
+CACHE_GENERATION_KEY = "CACHE_GENERATION"
+
+# Set this to skip pre-computing popular responses for the new cache generation
+CACHE_WARMUP_ENABLED = environ.get("DISABLE_CACHE_WARMUP") is None
 
 
 def set_update_started():
@@ -19,7 +33,7 @@ def set_update_started():
 
 def check_if_all_finished():
     """ Checks if the instrument, popularity, and quote scrapes are all finished.  If they are,
-    then flush, unlock, and re-enable the cache. """
+    then invalidate, unlock, and re-enable the cache. """
 
     all_finished = (
         redis_client.get("INSTRUMENTS_FINISHED")
@@ -28,9 +42,9 @@ def check_if_all_finished():
     )
 
     if all_finished:
-        print("All updates finished! Flushing + unlocking cache...")
-        flush_cache()
+        print("All updates finished! Invalidating + unlocking cache...")
         populate_popularity_rankings(redis_client, get_db)
+        bump_cache_generation()
         unlock_cache()
 
 
@@ -61,11 +75,36 @@ def set_quotes_finished():
     check_if_all_finished()
 
 
-def flush_cache():
-    """ Removes all cache hashes, removing all existing cache entries. """
+def record_popularities(popularity_map: dict, timestamp):
+    """ Records freshly scraped popularities into the incrementally maintained popularity
+    rankings, re-publishing the rankings if they haven't been refreshed recently. """
+
+    record_latest_popularities(redis_client, popularity_map, timestamp)
+    maybe_refresh_popularity_rankings(redis_client, get_db)
+
+
+def invalidate_instrument_metadata(instrument_ids):
+    """ Called with the IDs of instruments whose index entries were updated. """
+
+    invalidate_ranking_metadata(redis_client, instrument_ids)
+
+
+def bump_cache_generation():
+    """ Invalidates all existing cache entries by moving the backend on to a new cache generation.
+    Entries from old generations are no longer read and expire on their own.  If enabled, the new
+    generation is warmed before it goes live. """
+
+    next_generation = int(redis_client.get(CACHE_GENERATION_KEY) or 0) + 1
+    if CACHE_WARMUP_ENABLED:
+        try:
+            warm_cache(redis_client, get_db, next_generation)
+        except Exception as e:  # pylint: disable=W0703
+            print(f"ERROR: Failed to warm cache generation {next_generation}: {e}")
 
-    print("Flushing cache...")
-    redis_client.flushdb()
+    generation = redis_client.incr(CACHE_GENERATION_KEY)
+    if generation != next_generation:
+        print(f"WARN: Cache generation moved to {generation} while warming {next_generation}")
+    print(f"Cache generation is now {generation}.")
 
 
 def lock_cache():
@@ -0,0 +1,134 @@
+""" Keeps the `index` collection in sync with the instruments returned by the Robinhood API.
+
+Pages of instruments are diffed against the existing index documents using a hash of their content,
+so unchanged instruments cause no writes at all.  Symbol collisions (a symbol being moved to a new
+instrument ID) are resolved in memory instead of by catching duplicate key errors one document at
+a time. """
+
+import hashlib
+import json
+from typing import Dict, List, Set, Tuple
+
+import pymongo
+from pymongo.errors import BulkWriteError
+
+from utils import omit
+
+
+def build_index_doc(instrument_datum: dict) -> dict:
+    """ Converts an instrument from the API into an index document, including a hash of its
+    content. """
+
+    doc = {**omit("id", instrument_datum), "instrument_id": instrument_datum["id"]}
+    serialized = json.dumps(doc, sort_keys=True, default=str).encode("utf-8")
+    doc["content_hash"] = hashlib.sha1(serialized).hexdigest()
+    return doc
+
+
+def diff_instrument_page(
+    instruments: List[dict], existing_docs: List[dict]
+) -> Tuple[Set[str], List[dict]]:
+    """ Given a page of instruments and the existing index docs sharing either an instrument ID or
+    a symbol with them, returns the IDs of the index docs that must be deleted to free up their
+    symbol along with the index docs that need to be written. """
+
+    # If the same symbol shows up multiple times in the page, the last instrument wins
+    docs_by_symbol: Dict[str, dict] = {}
+    for instrument_datum in instruments:
+        doc = build_index_doc(instrument_datum)
+        docs_by_symbol[doc.get("symbol") or doc["instrument_id"]] = doc
+    docs = {doc["instrument_id"]: doc for doc in docs_by_symbol.values()}
+
+    existing_by_id = {doc["instrument_id"]: doc for doc in existing_docs}
+    existing_by_symbol = {doc["symbol"]: doc for doc in existing_docs if doc.get("symbol")}
+
+    stale_ids = set()
+    for doc in docs.values():
+        owner = existing_by_symbol.get(doc.get("symbol"))
+        if owner is not None and owner["instrument_id"] != doc["instrument_id"]:
+            stale_ids.add(owner["instrument_id"])
+
+    to_write = []
+    for (instrument_id, doc) in docs.items():
+        existing = existing_by_id.get(instrument_id)
+        unchanged = existing is not None and existing.get("content_hash") == doc["content_hash"]
+        if unchanged and instrument_id not in stale_ids:
+            continue
+
+        to_write.append(doc)
+
+    return (stale_ids, to_write)
+
+
+def try_update_instrument(index_coll, doc: dict):
+    """ Writes a single index doc, deleting any other doc with the same symbol if there is a
+    conflict. """
+
+    instrument_id = doc["instrument_id"]
+
+    try:
+        index_coll.replace_one({"instrument_id": instrument_id}, doc, True)
+    except pymongo.errors.DuplicateKeyError:
+        # There must be another document with the same symbol in the collection.  We should delete
+        # it and replace it with this one instead.
+        res = index_coll.delete_many({"symbol": doc["symbol"]})
+        if res.deleted_count == 0:
+            print(
+                (
+                    f"WARN: Duplicate key error for symbol {doc['symbol']} "
+                    f"(id {instrument_id}) but no other entry with that symbol in the "
+                    "index collection"
+                )
+            )
+        else:
+            index_coll.insert_one(doc)
+            print(f"Handled symbol conflict; re-trying update for instrument {instrument_id}")
+
+
+def sync_instrument_page(index_coll, instruments: List[dict]) -> List[str]:
+    """ Brings the index collection up to date with a page of instruments, returning the IDs of
+    the instruments whose documents were written. """
+
+    if not instruments:
+        return []
+
+    instrument_ids = [datum["id"] for datum in instruments]
+    symbols = [datum["symbol"] for datum in instruments if datum.get("symbol") is not None]
+    existing_docs = list(
+        index_coll.find(
+            {"$or": [{"instrument_id": {"$in": instrument_ids}}, {"symbol": {"$in": symbols}}]},
+            projection={"_id": False, "instrument_id": True, "symbol": True, "content_hash": True},
+        )
+    )
+
+    (stale_ids, to_write) = diff_instrument_page(instruments, existing_docs)
+
+    # Deletes have to land before the writes that take over their symbols, and unordered bulk
+    # writes don't guarantee any ordering between operations, so they're sent first.
+    if stale_ids:
+        index_coll.bulk_write(
+            [pymongo.DeleteOne({"instrument_id": instrument_id}) for instrument_id in stale_ids],
+            ordered=False,
+        )
+        print(f"Removed {len(stale_ids)} index entries whose symbols were taken by new instruments")
+
+    if not to_write:
+        return []
+
+    ops = [
+        pymongo.ReplaceOne({"instrument_id": doc["instrument_id"]}, doc, upsert=True)
+        for doc in to_write
+    ]
+    try:
+        index_coll.bulk_write(ops, ordered=False)
+    except BulkWriteError as bwe:
+        for err in bwe.details["writeErrors"]:
+            if err["code"] != 11000:
+                print("ERROR: Unhandled exception occured during batch write:")
+                print(err)
+                continue
+
+            # Someone else must have written a conflicting symbol since we read the index
+            try_update_instrument(index_coll, to_write[err["index"]])
+
+    return [doc["instrument_id"] for doc in to_write]
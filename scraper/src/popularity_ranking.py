@@ -1,14 +1,61 @@
 """ Pre-computes popularity ranking for all symbols and stores it in Redis for quick + easy
-retrieval, avoiding the expensive popularity ranking queries every time. """
+retrieval, avoiding the expensive popularity ranking queries every time.
+
+Rankings are maintained incrementally: every time a batch of popularities is stored, the workers
+record the latest popularity of each instrument in a Redis sorted set.  Publishing the rankings
+then only requires reading that sorted set and looking up metadata for instruments that we haven't
+seen before rather than aggregating over all recent popularity documents. """
 
 from datetime import datetime, timedelta
+from itertools import chain
 import json
+from typing import List
 
 from pymongo.cursor import Cursor
 
+# Hash of symbol -> ranking and list of all symbols from most to least popular read by the backend
+RANKINGS_KEY = "popularity_rankings"
+RANKINGS_LIST_KEY = "popularity_list"
+# New rankings are written under versioned staging keys and then renamed over the live ones
+RANKINGS_VERSION_KEY = "popularity_rankings_version"
+RANKINGS_STAGING_PREFIX = "popularity_rankings_staging:"
+RANKINGS_STAGING_TTL_SECONDS = 10 * 60
+# Number of rankings written to the staging keys per pipeline
+RANKINGS_WRITE_CHUNK_SIZE = 500
+
+# Renames the staging keys `KEYS[1]` and `KEYS[2]` over the live keys `KEYS[3]` and `KEYS[4]`, but
+# only if both staging keys still exist.  Redis doesn't roll back a MULTI/EXEC transaction if one
+# of its commands fails, so the check and the renames are done in a script to make sure that
+# either both live keys are replaced or neither is.  Returns 1 if the keys were swapped.
+SWAP_RANKINGS_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 or redis.call("EXISTS", KEYS[2]) == 0 then
+  return 0
+end
+redis.call("RENAME", KEYS[1], KEYS[3])
+redis.call("RENAME", KEYS[2], KEYS[4])
+-- RENAME carries over the TTL of the staging keys
+redis.call("PERSIST", KEYS[3])
+redis.call("PERSIST", KEYS[4])
+return 1
+"""
+
+# Sorted set of instrument ID -> latest popularity
+LATEST_POPULARITY_KEY = "popularity_latest"
+# Sorted set of instrument ID -> UNIX timestamp of its latest popularity
+LATEST_POPULARITY_TIMESTAMPS_KEY = "popularity_latest_timestamps"
+# Hash of instrument ID -> JSON-encoded symbol and name used in the rankings
+RANKING_METADATA_KEY = "popularity_ranking_metadata"
+# Set while rankings were published recently to limit how often workers re-publish them
+RANKINGS_REFRESHED_KEY = "popularity_rankings_refreshed"
+
+# Instruments without a popularity update in this long are dropped from the rankings
+RANKING_MAX_AGE = timedelta(hours=2)
+# Minimum delay between re-publishing rankings while a scrape is in progress
+RANKINGS_REFRESH_INTERVAL_SECONDS = 60
+
 
 def get_popularity_ranking_query():
-    two_hours_ago = datetime.now() - timedelta(hours=2)
+    two_hours_ago = datetime.now() - RANKING_MAX_AGE
     return [
         {"$match": {"timestamp": {"$gte": two_hours_ago}}},
         {"$group": {"_id": "$instrument_id", "latest_popularity": {"$first": "$popularity"}}},
@@ -42,8 +89,113 @@ def compute_popularity_rankings(get_db) -> list:
     return ret
 
 
+def record_latest_popularities(redis_client, popularity_map: dict, timestamp: datetime):
+    """ Records the latest popularity of each instrument in the provided map into the sorted sets
+    used to incrementally maintain the rankings. """
+
+    if not popularity_map:
+        return
+
+    epoch_seconds = timestamp.timestamp()
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.zadd(
+        LATEST_POPULARITY_KEY,
+        *chain.from_iterable(
+            (popularity, instrument_id) for (instrument_id, popularity) in popularity_map.items()
+        ),
+    )
+    pipe.zadd(
+        LATEST_POPULARITY_TIMESTAMPS_KEY,
+        *chain.from_iterable((epoch_seconds, instrument_id) for instrument_id in popularity_map),
+    )
+    pipe.execute()
+
+
+def invalidate_ranking_metadata(redis_client, instrument_ids: List[str]):
+    """ Drops the cached symbol and name for instruments whose index entries changed. """
+
+    if instrument_ids:
+        redis_client.hdel(RANKING_METADATA_KEY, *instrument_ids)
+
+
+def get_ranking_metadata(redis_client, get_db, instrument_ids: List[str]) -> dict:
+    """ Returns a dict mapping instrument ID to its symbol and name, only querying the index
+    collection for instruments that aren't already cached in Redis. """
+
+    metadata = {}
+    if not instrument_ids:
+        return metadata
+
+    missing_ids = []
+    cached = redis_client.hmget(RANKING_METADATA_KEY, instrument_ids)
+    for (instrument_id, datum) in zip(instrument_ids, cached):
+        if datum is None:
+            missing_ids.append(instrument_id)
+        else:
+            metadata[instrument_id] = json.loads(datum)
+
+    if missing_ids:
+        print(f"Fetching ranking metadata for {len(missing_ids)} instruments")
+        new_metadata = {}
+        for item in get_db()["index"].find(
+            {"instrument_id": {"$in": missing_ids}},
+            projection={"_id": False, "instrument_id": True, "symbol": True, "simple_name": True},
+        ):
+            new_metadata[item["instrument_id"]] = {
+                "symbol": item.get("symbol"),
+                "name": item.get("simple_name"),
+            }
+
+        if new_metadata:
+            encoded = {
+                instrument_id: json.dumps(datum) for (instrument_id, datum) in new_metadata.items()
+            }
+            redis_client.hmset(RANKING_METADATA_KEY, encoded)
+        metadata.update(new_metadata)
+
+    return metadata
+
+
+def get_incremental_popularity_rankings(redis_client, get_db) -> list:
+    """ Returns a list of all symbols ordered by current popularity, ordered most to least popular,
+    built from the incrementally maintained sorted sets.  Returns `None` if they are empty. """
+
+    # Drop instruments that haven't been updated recently, matching the window of the full query
+    cutoff = (datetime.utcnow() - RANKING_MAX_AGE).timestamp()
+    stale_ids = redis_client.zrangebyscore(LATEST_POPULARITY_TIMESTAMPS_KEY, "-inf", cutoff)
+    if stale_ids:
+        pipe = redis_client.pipeline(transaction=False)
+        pipe.zrem(LATEST_POPULARITY_KEY, *stale_ids)
+        pipe.zrem(LATEST_POPULARITY_TIMESTAMPS_KEY, *stale_ids)
+        pipe.execute()
+
+    entries = redis_client.zrevrange(LATEST_POPULARITY_KEY, 0, -1, withscores=True)
+    if not entries:
+        return None
+
+    instrument_ids = [instrument_id.decode("utf-8") for (instrument_id, _) in entries]
+    metadata = get_ranking_metadata(redis_client, get_db, instrument_ids)
+
+    ret = []
+    for (instrument_id, (_, popularity)) in zip(instrument_ids, entries):
+        instrument_datum = metadata.get(instrument_id)
+        if instrument_datum is None:
+            continue
+
+        ret.append(
+            {
+                "latest_popularity": int(popularity),
+                "name": instrument_datum["name"],
+                "symbol": instrument_datum["symbol"],
+            }
+        )
+
+    return ret
+
+
 def set_popularity_rankings(redis_client, rankings: Cursor):
-    """ Sets the popularity rankings for each symbol into Redis. """
+    """ Sets the popularity rankings for each symbol into Redis.  The new rankings are swapped in
+    atomically, so readers see either the old or the new rankings in full. """
 
     rankings_map = {}
     rankings_list = []
@@ -60,19 +212,60 @@ def set_popularity_rankings(redis_client, rankings: Cursor):
         rankings_map[symbol] = ranking
         rankings_list.append(json.dumps({"symbol": symbol, "popularity": popularity, "name": name}))
 
-    print("Setting popularity rankings hash...")
-    # Populate the popularity mapping hash used to map symbol to ranking
-    redis_client.delete("popularity_rankings")
-    redis_client.hmset("popularity_rankings", rankings_map)
-    print("Setting popularity list...")
-    # Populate the list rankings all symbols from most to least popular in order
-    redis_client.delete("popularity_list")
-    redis_client.rpush("popularity_list", *rankings_list)
+    print("Writing popularity rankings to staging keys...")
+    version = redis_client.incr(RANKINGS_VERSION_KEY)
+    staging_rankings_key = f"{RANKINGS_STAGING_PREFIX}{version}:{RANKINGS_KEY}"
+    staging_list_key = f"{RANKINGS_STAGING_PREFIX}{version}:{RANKINGS_LIST_KEY}"
+
+    # Populate the popularity mapping hash used to map symbol to ranking and the list ranking all
+    # symbols from most to least popular in order, a chunk per round trip
+    symbols = list(rankings_map)
+    for i in range(0, len(rankings_list), RANKINGS_WRITE_CHUNK_SIZE):
+        pipe = redis_client.pipeline(transaction=False)
+        chunk_symbols = symbols[i : i + RANKINGS_WRITE_CHUNK_SIZE]
+        if chunk_symbols:
+            pipe.hmset(
+                staging_rankings_key, {symbol: rankings_map[symbol] for symbol in chunk_symbols}
+            )
+        pipe.rpush(staging_list_key, *rankings_list[i : i + RANKINGS_WRITE_CHUNK_SIZE])
+        # Staging keys left behind by a crashed publisher clean themselves up
+        pipe.expire(staging_rankings_key, RANKINGS_STAGING_TTL_SECONDS)
+        pipe.expire(staging_list_key, RANKINGS_STAGING_TTL_SECONDS)
+        pipe.execute()
+
+    print("Swapping in new popularity rankings...")
+    if not rankings_list:
+        redis_client.delete(RANKINGS_KEY, RANKINGS_LIST_KEY)
+    else:
+        swap_rankings = redis_client.register_script(SWAP_RANKINGS_SCRIPT)
+        swapped = swap_rankings(
+            keys=[staging_rankings_key, staging_list_key, RANKINGS_KEY, RANKINGS_LIST_KEY]
+        )
+        if not swapped:
+            # The staging keys expired or were removed out from under us; the previous rankings
+            # stay in place
+            print(f"ERROR: Failed to swap in popularity rankings version {version}")
+            redis_client.delete(staging_rankings_key, staging_list_key)
+            return
+
     print("Finished computing popularity caches")
 
 
 def populate_popularity_rankings(redis_client, get_db):
-    """ Compute the popularity rankings cache and set it into Redis. """
+    """ Compute the popularity rankings cache and set it into Redis.  Falls back to aggregating
+    over the popularity collection if the incremental rankings haven't been built yet. """
+
+    rankings = get_incremental_popularity_rankings(redis_client, get_db)
+    if rankings is None:
+        print("No incremental popularity rankings available; falling back to full aggregation")
+        rankings = compute_popularity_rankings(get_db)
 
-    rankings = compute_popularity_rankings(get_db)
     set_popularity_rankings(redis_client, rankings)
+
+
+def maybe_refresh_popularity_rankings(redis_client, get_db):
+    """ Re-publishes the popularity rankings if they haven't been published by any worker in the
+    last `RANKINGS_REFRESH_INTERVAL_SECONDS`, keeping them fresh while a scrape is running. """
+
+    if redis_client.set(RANKINGS_REFRESHED_KEY, "1", nx=True, ex=RANKINGS_REFRESH_INTERVAL_SECONDS):
+        populate_popularity_rankings(redis_client, get_db)
@@ -0,0 +1,77 @@
+""" Consumer lag metrics for the RabbitMQ work queues.  Ready and unacknowledged message counts are
+read from the RabbitMQ management API, published into Redis, and can be printed for all queues by
+running this module directly. """
+
+import datetime
+import json
+from os import environ
+from urllib.parse import quote
+
+import click
+import requests
+
+from python_common.db import redis_client
+
+QUEUE_LAG_KEY = "QUEUE_LAG"
+
+WORK_QUEUES = ["instrument_ids", "symbols", "fundamentals_instrument_ids"]
+
+
+def get_management_url(rabbitmq_host: str) -> str:
+    return environ.get("RABBITMQ_MANAGEMENT_URL") or f"http://{rabbitmq_host}:15672"
+
+
+def get_queue_lag(management_url: str, queue: str) -> dict:
+    """ Returns the number of ready and unacknowledged messages along with the number of consumers
+    for the provided queue, or `None` if the management API can't be reached. """
+
+    auth = (
+        environ.get("RABBITMQ_USER") or "guest",
+        environ.get("RABBITMQ_PASSWORD") or "guest",
+    )
+    url = "{}/api/queues/{}/{}".format(management_url, quote("/", safe=""), quote(queue, safe=""))
+
+    try:
+        res = requests.get(url, auth=auth, timeout=5)
+        res.raise_for_status()
+        stats = res.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        print(f"Unable to fetch queue stats for {queue} from the management API: {e}")
+        return None
+
+    return {
+        "ready": stats.get("messages_ready", 0),
+        "unacked": stats.get("messages_unacknowledged", 0),
+        "consumers": stats.get("consumers", 0),
+    }
+
+
+def record_queue_lag(management_url: str, queue: str) -> dict:
+    """ Fetches the lag for the provided queue and publishes it into Redis. """
+
+    lag = get_queue_lag(management_url, queue)
+    if lag is None:
+        return None
+
+    lag["timestamp"] = datetime.datetime.utcnow().isoformat()
+    redis_client.hset(QUEUE_LAG_KEY, queue, json.dumps(lag))
+    print(
+        "Queue {}: {} ready, {} unacked, {} consumers".format(
+            queue, lag["ready"], lag["unacked"], lag["consumers"]
+        )
+    )
+    return lag
+
+
+@click.command()
+@click.option("--rabbitmq_host", default="localhost")
+@click.option("--queue", "queues", multiple=True, default=WORK_QUEUES)
+def cli(rabbitmq_host: str, queues: list):
+    management_url = get_management_url(rabbitmq_host)
+
+    for queue in queues:
+        record_queue_lag(management_url, queue)
+
+
+if __name__ == "__main__":
+    cli()  # pylint: disable=E1120
@@ -0,0 +1,158 @@
+""" Rate limiter shared by every scraper process through Redis.
+
+Each endpoint family (instruments, popularity, quotes, fundamentals, candles, similar instruments)
+has a single token bucket stored in Redis which all workers draw from, so the fleet as a whole is
+limited rather than each worker individually.  The refill rate of the bucket is adjusted
+AIMD-style: every successful request additively increases it and every throttle response from
+Robinhood multiplicatively decreases it and pauses the bucket for the cooldown that Robinhood asked
+for. """
+
+import asyncio
+from collections import namedtuple
+import time
+
+from python_common.db import redis_client
+
+RateLimitConfig = namedtuple(
+    "RateLimitConfig",
+    ["initial_rate", "min_rate", "max_rate", "additive_increase", "decrease_factor"],
+)
+
+# Rates are in requests per second for the whole fleet of workers
+ENDPOINT_FAMILIES = {
+    "instruments": RateLimitConfig(1.0, 0.1, 5.0, 0.05, 0.5),
+    "popularity": RateLimitConfig(4.0, 0.2, 40.0, 0.2, 0.5),
+    "quotes": RateLimitConfig(2.0, 0.2, 20.0, 0.1, 0.5),
+    "fundamentals": RateLimitConfig(1.0, 0.1, 10.0, 0.05, 0.5),
+    "candles": RateLimitConfig(1.0, 0.1, 10.0, 0.05, 0.5),
+    "similar_instruments": RateLimitConfig(1.0, 0.1, 5.0, 0.05, 0.5),
+}
+
+# Number of seconds worth of requests that can be made in a burst after the bucket has been idle
+BURST_SECONDS = 1.0
+# The limiter state is dropped if no worker touches it for this long, resetting to the initial rate
+STATE_TTL_SECONDS = 60 * 60
+
+# Takes a token from the bucket if one is available.  Returns the number of seconds to wait before
+# trying again, which is 0 if a token was taken.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local state = redis.call("HMGET", KEYS[1], "rate", "tokens", "last_refill", "paused_until")
+local rate = tonumber(state[1]) or tonumber(ARGV[2])
+local capacity = math.max(1, rate * tonumber(ARGV[3]))
+local tokens = tonumber(state[2]) or capacity
+local last_refill = tonumber(state[3]) or now
+local paused_until = tonumber(state[4]) or 0
+
+if now < paused_until then
+    return tostring(paused_until - now)
+end
+
+tokens = math.min(capacity, tokens + math.max(0, now - last_refill) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+
+redis.call("HMSET", KEYS[1], "rate", rate, "tokens", tokens, "last_refill", now)
+redis.call("EXPIRE", KEYS[1], ARGV[4])
+return tostring(wait)
+"""
+
+# Additive increase of the refill rate, scaled by the current rate so that the fleet-wide rate grows
+# by roughly `additive_increase` per second while the bucket is being fully used.
+INCREASE_SCRIPT = """
+local rate = tonumber(redis.call("HGET", KEYS[1], "rate")) or tonumber(ARGV[1])
+rate = math.min(tonumber(ARGV[3]), rate + tonumber(ARGV[2]) / rate)
+redis.call("HSET", KEYS[1], "rate", rate)
+redis.call("EXPIRE", KEYS[1], ARGV[4])
+return tostring(rate)
+"""
+
+# Multiplicative decrease of the refill rate along with a pause of the whole bucket.  Workers that
+# were throttled during a pause that another worker already reported don't decrease the rate again.
+DECREASE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local state = redis.call("HMGET", KEYS[1], "rate", "paused_until")
+local rate = tonumber(state[1]) or tonumber(ARGV[2])
+local paused_until = tonumber(state[2]) or 0
+
+if now < paused_until then
+    return tostring(rate)
+end
+
+rate = math.max(tonumber(ARGV[3]), rate * tonumber(ARGV[4]))
+redis.call(
+    "HMSET", KEYS[1], "rate", rate, "tokens", 0, "last_refill", now + tonumber(ARGV[5]),
+    "paused_until", now + tonumber(ARGV[5])
+)
+redis.call("EXPIRE", KEYS[1], ARGV[6])
+return tostring(rate)
+"""
+
+
+class SharedRateLimiter:
+    """ Fleet-wide rate limiter for a single endpoint family. """
+
+    def __init__(self, family: str, redis=redis_client):
+        self.family = family
+        self.config = ENDPOINT_FAMILIES[family]
+        self.key = f"RATE_LIMIT_{family}"
+        self.acquire_script = redis.register_script(ACQUIRE_SCRIPT)
+        self.increase_script = redis.register_script(INCREASE_SCRIPT)
+        self.decrease_script = redis.register_script(DECREASE_SCRIPT)
+
+    def try_acquire(self) -> float:
+        """ Takes a token if one is available, returning the number of seconds to wait before
+        trying again if not. """
+
+        args = [time.time(), self.config.initial_rate, BURST_SECONDS, STATE_TTL_SECONDS]
+        return float(self.acquire_script(keys=[self.key], args=args))
+
+    def acquire(self, sleep=time.sleep):
+        """ Blocks until a request can be made, using the provided `sleep` function to wait. """
+
+        wait = self.try_acquire()
+        while wait > 0:
+            sleep(wait)
+            wait = self.try_acquire()
+
+    async def acquire_async(self):
+        loop = asyncio.get_event_loop()
+
+        wait = await loop.run_in_executor(None, self.try_acquire)
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = await loop.run_in_executor(None, self.try_acquire)
+
+    def report_success(self) -> float:
+        """ Additively increases the rate after a successful request, returning the new rate. """
+
+        args = [
+            self.config.initial_rate,
+            self.config.additive_increase,
+            self.config.max_rate,
+            STATE_TTL_SECONDS,
+        ]
+        return float(self.increase_script(keys=[self.key], args=args))
+
+    def report_throttle(self, cooldown_seconds: float) -> float:
+        """ Multiplicatively decreases the rate and pauses all workers for `cooldown_seconds` after
+        Robinhood throttled a request, returning the new rate. """
+
+        args = [
+            time.time(),
+            self.config.initial_rate,
+            self.config.min_rate,
+            self.config.decrease_factor,
+            cooldown_seconds,
+            STATE_TTL_SECONDS,
+        ]
+        rate = float(self.decrease_script(keys=[self.key], args=args))
+        print(f"Throttled by Robinhood; {self.family} rate limit is now {rate:.2f} requests/second")
+        return rate
+
+
+RATE_LIMITERS = {family: SharedRateLimiter(family) for family in ENDPOINT_FAMILIES}
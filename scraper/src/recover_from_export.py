@@ -1,183 +1,281 @@
-import datetime
-import os
+""" Merges exported history back into the database, for recovering data that was lost or never
+scraped.  The export directory holds one file per symbol: Robinhood historicals JSON files for
+quotes, or CSV files written by the popularity history exporter for popularities.
+
+Exports only have second precision, so documents are skipped if the database already holds a
+document for their instrument within the same second.  The rest are upserted with `$setOnInsert`,
+keyed on their instrument and timestamp, so data that's already in the database always wins and
+recovering the same files again is a no-op.
+Symbols are recovered in parallel and appended to a checkpoint file once they're done, so an
+interrupted recovery picks up where it left off when it's run again. """
+
+from collections import namedtuple
+from datetime import datetime, timedelta
 import json
+from multiprocessing import Pool
+import os
+from typing import Dict, List, Optional, Tuple
 
+import click
 import pymongo
 
-from db import get_db, set_popularities_finished, set_quotes_finished, unlock_cache
+from python_common.db import create_db, get_db
+from python_common.quote_buckets import parse_price
+from python_common.schema import ensure_indexes
 
-INDEX_COLLECTION = get_db()["index"]
-QUOTES_COLLECTION = get_db()["quotes"]
+WRITE_BATCH_SIZE = 1000
+EXPORT_EXTENSIONS = [".csv", ".json"]
 
-BASE_PATH = "/Users/cprimozic/Downloads/out"
+# `parse` turns an export file into documents for the provided instrument, or returns `None` if
+# the file doesn't contain any history
+ExportKind = namedtuple("ExportKind", ["collection", "time_key", "parse"])
 
-ALREADY_PROCESSED_FNAME = "/Users/cprimozic/robintrack/scraper/src/already_processed.txt"
-already_processed = open(ALREADY_PROCESSED_FNAME, "r")
-ALREADY_PROCESSED = set(list(map(lambda s: s.replace("\n", ""), list(already_processed))))
-already_processed.close()
+worker_db = None
 
-already_processed_file = open(ALREADY_PROCESSED_FNAME, "a")
 
-START_DT = datetime.datetime(2019, 12, 9, 0, 0, 0, 0)
-END_DT = datetime.datetime(2020, 1, 15, 0, 0, 0, 0)
+def in_window(dt: datetime, start: Optional[datetime], end: Optional[datetime]) -> bool:
+    return (start is None or dt >= start) and (end is None or dt < end)
 
-for fname in os.listdir(BASE_PATH):
-    symbol = fname.split(".")[0]
-    if symbol in ALREADY_PROCESSED:
-        print("Skipping already processed symbol {}".format(symbol))
-        continue
 
-    instrument_id_doc = INDEX_COLLECTION.find_one({"symbol": symbol})
-    if instrument_id_doc is None:
-        print("No index doc for symbol {}; skipping recovery...".format(symbol))
-        continue
-    instrument_id = instrument_id_doc["instrument_id"]
+def parse_quotes_export(path: str, instrument_id: str) -> Optional[List[dict]]:
+    with open(path) as f:
+        parsed = json.load(f)
+    if "historicals" not in parsed:
+        return None
+
+    docs = []
+    for historical in parsed["historicals"]:
+        price = parse_price(historical["open_price"])
+        docs.append(
+            {
+                "instrument_id": instrument_id,
+                "ask_price": price,
+                "ask_size": 0.0,
+                "bid_price": price,
+                "bid_size": 0.0,
+                "last_trade_price": price,
+                "last_extended_hours_trade_price": price,
+                "updated_at": datetime.strptime(historical["begins_at"], "%Y-%m-%dT%H:%M:%SZ"),
+            }
+        )
+
+    return docs
 
-    existing_local_docs = []
-    with open(os.path.join(BASE_PATH, fname)) as f:
-        parsed = json.loads(f.read())
-        if "historicals" not in parsed:
-            print(f"Error: no historicals for symbol {symbol}")
-            continue
 
-        existing_local_docs = parsed["historicals"]
+def parse_popularity_export(path: str, instrument_id: str) -> Optional[List[dict]]:
+    docs = []
+    with open(path) as f:
+        next(f)  # Skip header row
 
-    existing_remote_docs = list(
-        QUOTES_COLLECTION.find({"instrument_id": instrument_id}).sort(
-            "updated_at", pymongo.ASCENDING
+        for line in f:
+            (timestamp, popularity) = line.split(",")
+            docs.append(
+                {
+                    "instrument_id": instrument_id,
+                    # "2020-01-05 00:42:26"
+                    "timestamp": datetime.strptime(timestamp.strip('"'), "%Y-%m-%d %H:%M:%S"),
+                    "popularity": int(popularity),
+                }
+            )
+
+    return docs
+
+
+EXPORT_KINDS = {
+    "quotes": ExportKind("quotes", "updated_at", parse_quotes_export),
+    "popularity": ExportKind("popularity", "timestamp", parse_popularity_export),
+}
+
+
+def build_upsert_ops(docs: List[dict], time_key: str) -> List[pymongo.UpdateOne]:
+    return [
+        pymongo.UpdateOne(
+            {"instrument_id": doc["instrument_id"], time_key: doc[time_key]},
+            {"$setOnInsert": doc},
+            upsert=True,
         )
+        for doc in docs
+    ]
+
+
+def get_export_symbol(filename: str) -> str:
+    # Only the extension is stripped since symbols like `BRK.B` contain dots themselves
+    symbol = filename
+    for extension in EXPORT_EXTENSIONS:
+        if symbol.endswith(extension):
+            symbol = symbol[: -len(extension)]
+            break
+    # The popularity exporter prefixes symbols that are reserved filenames on Windows
+    if symbol.startswith("_"):
+        symbol = symbol[1:]
+    return symbol
+
+
+def truncate_to_second(dt: datetime) -> datetime:
+    return dt.replace(microsecond=0)
+
+
+def get_existing_seconds(collection, instrument_id: str, time_key: str, docs: List[dict]) -> set:
+    """ Returns the timestamps of the instrument's stored documents in the time range covered by
+    `docs`, truncated to whole seconds.  Exports only have second precision while stored
+    documents have millisecond precision, so they can't be matched on their exact timestamps. """
+
+    if not docs:
+        return set()
+
+    times = [doc[time_key] for doc in docs]
+    cursor = collection.find(
+        {
+            "instrument_id": instrument_id,
+            time_key: {
+                "$gte": truncate_to_second(min(times)),
+                "$lt": truncate_to_second(max(times)) + timedelta(seconds=1),
+            },
+        },
+        projection={"_id": False, time_key: True},
     )
+    return set(truncate_to_second(doc[time_key]) for doc in cursor)
 
-    existing_local_docs = list(
-        filter(
-            lambda doc: doc["updated_at"] > START_DT and doc["updated_at"] < END_DT,
-            list(
-                map(
-                    lambda doc: {
-                        "instrument_id": instrument_id,
-                        "ask_price": float(doc["open_price"]),
-                        "ask_size": 0.0,
-                        "bid_price": float(doc["open_price"]),
-                        "bid_size": 0.0,
-                        "last_trade_price": float(doc["open_price"]),
-                        "last_extended_hours_trade_price": float(doc["open_price"]),
-                        "updated_at": datetime.datetime.strptime(
-                            doc["begins_at"], "%Y-%m-%dT%H:%M:%SZ"
-                        ),
-                    },
-                    existing_local_docs,
-                )
-            ),
-        )
+
+def recover_symbol(
+    db, kind: str, path: str, instrument_id: str, start: datetime, end: datetime
+) -> Optional[int]:
+    """ Merges a symbol's export into the database, returning how many documents were inserted
+    or `None` if the export doesn't contain any history. """
+
+    export_kind = EXPORT_KINDS[kind]
+    docs = export_kind.parse(path, instrument_id)
+    if docs is None:
+        return None
+
+    collection = db[export_kind.collection]
+    time_key = export_kind.time_key
+    docs = [doc for doc in docs if in_window(doc[time_key], start, end)]
+    existing_seconds = get_existing_seconds(collection, instrument_id, time_key, docs)
+    ops = build_upsert_ops(
+        [doc for doc in docs if truncate_to_second(doc[time_key]) not in existing_seconds],
+        time_key,
     )
-    existing_remote_docs = list(
-        map(
-            lambda doc: {
-                "instrument_id": doc["instrument_id"],
-                "ask_price": doc["ask_price"],
-                "ask_size": doc["ask_size"],
-                "bid_price": doc["bid_price"],
-                "bid_size": doc["bid_size"],
-                "last_trade_price": doc["last_trade_price"],
-                "last_extended_hours_trade_price": doc["last_extended_hours_trade_price"],
-                "updated_at": doc["updated_at"],
-            },
-            existing_remote_docs,
+
+    inserted_count = 0
+    for i in range(0, len(ops), WRITE_BATCH_SIZE):
+        res = collection.bulk_write(ops[i : i + WRITE_BATCH_SIZE], ordered=False)
+        inserted_count += res.upserted_count
+
+    return inserted_count
+
+
+def init_worker():
+    global worker_db
+    worker_db = create_db()
+
+
+def recover_symbol_task(args: Tuple[str, str, str, str, datetime, datetime]):
+    (symbol, kind, path, instrument_id, start, end) = args
+    return (symbol, recover_symbol(worker_db, kind, path, instrument_id, start, end))
+
+
+def load_checkpoint(checkpoint_path: str) -> set:
+    if not os.path.exists(checkpoint_path):
+        return set()
+
+    with open(checkpoint_path) as f:
+        return set(line.strip() for line in f if line.strip())
+
+
+def record_results(results, checkpoint_path: str, task_count: int):
+    """ Adds every successfully recovered symbol to the checkpoint as soon as it's done. """
+
+    with open(checkpoint_path, "a") as checkpoint_file:
+        for (i, (symbol, inserted_count)) in enumerate(results):
+            if inserted_count is None:
+                print(f"Error: no historicals for symbol {symbol}")
+                continue
+
+            checkpoint_file.write(symbol + "\n")
+            checkpoint_file.flush()
+            print(f"[{i + 1}/{task_count}] Restored {inserted_count} documents for {symbol}")
+
+
+def get_instrument_ids_by_symbol(db, symbols: List[str]) -> Dict[str, str]:
+    return {
+        doc["symbol"]: doc["instrument_id"]
+        for doc in db["index"].find(
+            {"symbol": {"$in": symbols}},
+            projection={"_id": False, "symbol": True, "instrument_id": True},
         )
-    )
+    }
+
+
+def parse_datetime_option(ctx, param, value: Optional[str]) -> Optional[datetime]:
+    if value is None:
+        return None
+
+    for fmt in ["%Y-%m-%d", "%Y-%m-%dT%H:%M:%S"]:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise click.BadParameter("must be formatted as YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS")
+
+
+@click.command()
+@click.argument("export-dir", type=click.Path(exists=True, file_okay=False))
+@click.option("--kind", type=click.Choice(list(EXPORT_KINDS.keys())), default="quotes")
+@click.option(
+    "--start",
+    callback=parse_datetime_option,
+    default=None,
+    help="Only recover history from this time on (inclusive)",
+)
+@click.option(
+    "--end",
+    callback=parse_datetime_option,
+    default=None,
+    help="Only recover history before this time (exclusive)",
+)
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    default=None,
+    help="File listing the symbols that were already recovered; defaults to one in EXPORT_DIR",
+)
+@click.option("--workers", type=click.INT, default=os.cpu_count())
+def main(export_dir: str, kind: str, start: datetime, end: datetime, checkpoint: str, workers: int):
+    checkpoint_path = checkpoint or os.path.join(export_dir, f".recovered_{kind}")
+    already_processed = load_checkpoint(checkpoint_path)
+
+    paths_by_symbol = {}
+    for filename in sorted(os.listdir(export_dir)):
+        if filename.startswith("."):
+            continue
+
+        symbol = get_export_symbol(filename)
+        if symbol in already_processed:
+            continue
+        paths_by_symbol[symbol] = os.path.join(export_dir, filename)
+    print(f"Skipping {len(already_processed)} already recovered symbols")
+
+    db = get_db()
+    ensure_indexes(db, [EXPORT_KINDS[kind].collection])
+    instrument_ids_by_symbol = get_instrument_ids_by_symbol(db, list(paths_by_symbol.keys()))
+
+    tasks = []
+    for (symbol, path) in paths_by_symbol.items():
+        instrument_id = instrument_ids_by_symbol.get(symbol)
+        if instrument_id is None:
+            print(f"No index doc for symbol {symbol}; skipping recovery...")
+            continue
+        tasks.append((symbol, kind, path, instrument_id, start, end))
+
+    if workers <= 1:
+        results = ((task[0], recover_symbol(db, *task[1:])) for task in tasks)
+        record_results(results, checkpoint_path, len(tasks))
+    else:
+        with Pool(workers, initializer=init_worker) as pool:
+            results = pool.imap_unordered(recover_symbol_task, tasks)
+            record_results(results, checkpoint_path, len(tasks))
+
 
-    docs = [*existing_local_docs, *existing_remote_docs]
-    docs_by_ts = {}
-    for doc in docs:
-        docs_by_ts[doc["updated_at"]] = doc
-    docs = list(docs_by_ts.values())
-    # sort by timestamp ascending
-    docs.sort(key=lambda item: item["updated_at"])
-
-    QUOTES_COLLECTION.delete_many({"instrument_id": instrument_id})
-    if len(docs) > 0:
-        QUOTES_COLLECTION.insert_many(docs)
-    print("Successfully restored symbol {}".format(symbol))
-    already_processed_file.write(symbol + "\n")
-
-
-# import datetime
-# import os
-
-# import pymongo
-
-# from db import get_db, set_popularities_finished, set_quotes_finished, unlock_cache
-
-# INDEX_COLLECTION = get_db()["index"]
-# POPULARITY_COLLECTION = get_db()["popularity"]
-
-# LOCAL_QUOTES_COLLECTION = get_db_local()['quotes']
-
-# BASE_PATH = "/Users/cprimozic/Downloads/tmp/popularity_export"
-
-# ALREADY_PROCESSED_FNAME = "/Users/cprimozic/robintrack/scraper/src/already_processed.txt"
-# already_processed = open(ALREADY_PROCESSED_FNAME, "r")
-# ALREADY_PROCESSED = set(list(map(lambda s: s.replace("\n", ""), list(already_processed))))
-# already_processed.close()
-
-# for fname in os.listdir(BASE_PATH):
-#     symbol = fname.split(".")[0]
-#     if symbol in ALREADY_PROCESSED:
-#         print("Skipping already processed symbol {}".format(symbol))
-#         continue
-
-#     fpath = str(os.path.join(BASE_PATH, fname))
-#     with open(fpath, "r") as f:
-#         next(f)  # Skip header row
-
-#         vals = []
-#         for line in f:
-#             spl = line.split(",")
-#             # "2020-01-05 00:42:26"
-#             ts_string = spl[0].replace('"', "")
-#             dt = datetime.datetime.strptime(ts_string, "%Y-%m-%d %H:%M:%S")
-#             popularity = int(spl[1])
-#             vals.append((dt, popularity))
-
-#         instrument_id_doc = INDEX_COLLECTION.find_one({"symbol": symbol})
-#         if instrument_id_doc is None:
-#             print("No index doc for symbol {}; skipping recovery...".format(symbol))
-#             continue
-#         instrument_id = instrument_id_doc["instrument_id"]
-#         existing_docs = list(
-#             POPULARITY_COLLECTION.find({"instrument_id": instrument_id}).sort(
-#                 "timestamp", pymongo.ASCENDING
-#             )
-#         )
-#         existing_docs = list(
-#             map(
-#                 lambda doc: {
-#                     "instrument_id": doc["instrument_id"],
-#                     "timestamp": doc["timestamp"],
-#                     "popularity": doc["popularity"],
-#                 },
-#                 existing_docs,
-#             )
-#         )
-
-#         docs = list(
-#             map(
-#                 lambda item: {
-#                     "instrument_id": instrument_id,
-#                     "timestamp": item[0],
-#                     "popularity": item[1],
-#                 },
-#                 vals,
-#             )
-#         )
-#         docs = [*existing_docs, *docs]
-#         docs_by_ts = {}
-#         for doc in docs:
-#             docs_by_ts[doc["timestamp"]] = doc
-#         docs = list(docs_by_ts.values())
-#         # sort by timestamp ascending
-#         docs.sort(key=lambda item: item["timestamp"])
-
-#         POPULARITY_COLLECTION.delete_many({"instrument_id": instrument_id})
-#         POPULARITY_COLLECTION.insert_many(docs)
-#         print("Successfully restored symbol {}".format(symbol))
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
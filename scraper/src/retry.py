@@ -0,0 +1,144 @@
+""" Bounded retry engine used by the workers.  Work functions signal failures by raising one of the
+errors defined here; the engine retries with exponential backoff and jitter until the attempt
+budget is used up and then hands the error back so that the batch can be dead-lettered. """
+
+import asyncio
+from collections import namedtuple
+import random
+
+from common import parse_throttle_res
+
+RetryPolicy = namedtuple(
+    "RetryPolicy",
+    ["max_attempts", "max_throttled_attempts", "base_delay_seconds", "max_delay_seconds"],
+)
+
+DEFAULT_RETRY_POLICY = RetryPolicy(
+    max_attempts=6, max_throttled_attempts=30, base_delay_seconds=2.0, max_delay_seconds=120.0
+)
+
+DEAD_LETTER_QUEUE_SUFFIX = "_dead_letter"
+
+
+class RetryableError(Exception):
+    """ Raised for errors that will likely go away if the request is retried, such as timeouts or
+    garbage responses from Robinhood. """
+
+
+class PermanentError(Exception):
+    """ Raised for errors that will never succeed no matter how many times they're retried. """
+
+
+class Throttled(Exception):
+    """ Raised when Robinhood throttles a request. """
+
+    def __init__(self, cooldown_seconds: float):
+        super().__init__(f"Throttled by Robinhood for {cooldown_seconds} seconds")
+        self.cooldown_seconds = cooldown_seconds
+
+
+def get_dead_letter_queue(queue: str) -> str:
+    return f"{queue}{DEAD_LETTER_QUEUE_SUFFIX}"
+
+
+def raise_for_response(res: dict):
+    """ Raises the appropriate error if the provided Robinhood API response doesn't contain any
+    results. """
+
+    if not isinstance(res, dict):
+        raise RetryableError("Robinhood sent back garbage: {}".format(res))
+    if res.get("results") is not None:
+        return
+    if res.get("detail"):
+        raise Throttled(parse_throttle_res(res["detail"]))
+
+    raise RetryableError("Unexpected response received from Robinhood: {}".format(res))
+
+
+def backoff_delay(attempt: int, policy: RetryPolicy = DEFAULT_RETRY_POLICY) -> float:
+    """ Returns the delay before the retry following the zero-indexed `attempt` using exponential
+    backoff with full jitter. """
+
+    cap = min(policy.max_delay_seconds, policy.base_delay_seconds * 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+def run_with_retries(
+    attempt_fn, sleep, rate_limiter=None, policy: RetryPolicy = DEFAULT_RETRY_POLICY
+) -> Exception:
+    """ Calls `attempt_fn` until it returns without raising or the retry budget is used up, waiting
+    between attempts with the provided `sleep` function.  Returns `None` on success and the error
+    that caused the last attempt to fail otherwise.
+
+    Throttled attempts have their own, larger budget since they're caused by the whole fleet rather
+    than the batch being processed.  If a rate limiter is provided, throttles are reported to it and
+    the wait is left to its next `acquire`. """
+
+    attempts = 0
+    throttled_attempts = 0
+    while True:
+        try:
+            attempt_fn()
+            return None
+        except PermanentError as e:
+            return e
+        except Throttled as e:
+            throttled_attempts += 1
+            if throttled_attempts >= policy.max_throttled_attempts:
+                return e
+
+            print("Request throttled; waiting for {} second cooldown...".format(e.cooldown_seconds))
+            if rate_limiter is None:
+                sleep(e.cooldown_seconds)
+            else:
+                rate_limiter.report_throttle(e.cooldown_seconds)
+        except RetryableError as e:
+            attempts += 1
+            if attempts >= policy.max_attempts:
+                return e
+
+            delay = backoff_delay(attempts - 1, policy)
+            print(
+                "Attempt {}/{} failed: {}; re-trying in {:.1f} seconds...".format(
+                    attempts, policy.max_attempts, e, delay
+                )
+            )
+            sleep(delay)
+
+
+async def run_with_retries_async(
+    attempt_fn, rate_limiter=None, policy: RetryPolicy = DEFAULT_RETRY_POLICY
+) -> Exception:
+    """ Same as `run_with_retries`, but `attempt_fn` is a coroutine function. """
+
+    loop = asyncio.get_event_loop()
+    attempts = 0
+    throttled_attempts = 0
+    while True:
+        try:
+            await attempt_fn()
+            return None
+        except PermanentError as e:
+            return e
+        except Throttled as e:
+            throttled_attempts += 1
+            if throttled_attempts >= policy.max_throttled_attempts:
+                return e
+
+            print("Request throttled; waiting for {} second cooldown...".format(e.cooldown_seconds))
+            if rate_limiter is None:
+                await asyncio.sleep(e.cooldown_seconds)
+            else:
+                await loop.run_in_executor(None, rate_limiter.report_throttle, e.cooldown_seconds)
+        except RetryableError as e:
+            attempts += 1
+            if attempts >= policy.max_attempts:
+                return e
+
+            delay = backoff_delay(attempts - 1, policy)
+            print(
+                "Attempt {}/{} failed: {}; re-trying in {:.1f} seconds...".format(
+                    attempts, policy.max_attempts, e, delay
+                )
+            )
+            await asyncio.sleep(delay)
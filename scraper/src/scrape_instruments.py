@@ -1,17 +1,44 @@
 """ Entrypoint for the Robinhood scraper.  Pulls data from the top instruments and pushes the
-IDs of tradable instruments into a RabbitMQ queue. """
+IDs of tradable instruments into a RabbitMQ queue.
 
+The scrape runs as a pipeline of concurrent stages connected by bounded queues: pages are fetched
+from the API, filtered down to tradable instruments, synced into the `index` collection in bulk,
+and published to RabbitMQ.  This way the crawl is limited by the API rate rather than by the
+latency of the database writes. """
+
+from queue import Queue
+from threading import Thread
 from time import sleep
-from typing import Dict, Iterable, List
+import traceback
+from typing import Callable, Dict, Iterable, List
 
 import click
 import pika
-import pymongo
+import requests
 from Robinhood import Robinhood
 
-from common import parse_throttle_res
-from db import get_db, set_instruments_finished, set_update_started
-from utils import omit
+from python_common.schema import ensure_indexes
+
+from db import (
+    get_db,
+    invalidate_instrument_metadata,
+    set_instruments_finished,
+    set_update_started,
+)
+from index_sync import sync_instrument_page
+from rate_limiter import RATE_LIMITERS
+from retry import RetryableError, raise_for_response, run_with_retries
+
+INSTRUMENTS_URL = "https://api.robinhood.com/instruments/"
+
+# Max number of items buffered between two stages of the pipeline
+PIPELINE_QUEUE_SIZE = 8
+
+# Sent through the pipeline queues after the last item
+END_OF_STREAM = object()
+
+# Number of symbols or instrument IDs published to RabbitMQ in each message
+PUBLISH_BATCH_SIZE = 20
 
 
 def get_tradable_instruments(instruments: List[Dict[str, object]]) -> Iterable[Dict[str, object]]:
@@ -20,32 +47,12 @@ def get_tradable_instruments(instruments: List[Dict[str, object]]) -> Iterable[D
     return filter(lambda instrument: instrument.get("tradability") == "tradable", instruments)
 
 
-def try_update_instrument(index_coll, instrument_datum: dict):
-    instrument_id = instrument_datum["id"]
-    new_doc = {**omit("id", instrument_datum), "instrument_id": instrument_id}
-
-    try:
-        index_coll.replace_one({"instrument_id": instrument_id}, new_doc, True)
-    except pymongo.errors.DuplicateKeyError:
-        # There must be another document with the same symbol in the collection.  We should delete
-        # it and replace it with this one instead.
-        res = index_coll.delete_many({"symbol": instrument_datum["symbol"]})
-        if res.deleted_count == 0:
-            print(
-                (
-                    f"WARN: Duplicate key error for symbol {instrument_datum['symbol']} "
-                    f"(id {instrument_id}) but no other entry with that symbol in the "
-                    "index collection"
-                )
-            )
-        else:
-            index_coll.insert_one(new_doc)
-            print(f"Handled symbol conflict; re-trying update for instrument {instrument_id}")
-
-
 def publish_all(
     rabbitmq_channel, quotes: List[str], instrument_ids: List[str], scrape_fundamentals: bool
 ):
+    if not instrument_ids:
+        return
+
     rabbitmq_channel.basic_publish(exchange="", routing_key="symbols", body=",".join(quotes))
 
     rabbitmq_channel.basic_publish(
@@ -58,10 +65,70 @@ def publish_all(
         )
 
 
+def fetch_pages(
+    trader: Robinhood, request_cooldown_seconds: float, should_stop: Callable[[], bool]
+) -> Iterable[List[dict]]:
+    """ Yields the list of instruments on each page of the instruments API, retrying failed and
+    throttled requests. """
+
+    rate_limiter = RATE_LIMITERS["instruments"]
+    url = INSTRUMENTS_URL
+    res = None
+
+    def attempt():
+        nonlocal res
+
+        rate_limiter.acquire()
+        try:
+            res = trader.get_url(url)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            raise RetryableError("Error while fetching instruments: {}".format(e))
+
+        raise_for_response(res)
+        rate_limiter.report_success()
+
+    while url is not None and not should_stop():
+        error = run_with_retries(attempt, sleep, rate_limiter)
+        if error is not None:
+            raise error
+
+        yield res["results"]
+        url = res.get("next")
+        sleep(request_cooldown_seconds)
+
+
+def start_stage(name: str, process, input_queue: Queue, output_queue: Queue, errors: list):
+    """ Starts a pipeline stage in a new thread.  The stage calls `process` with each item from the
+    input queue and puts everything it yields into the output queue.  If it fails, the error is
+    recorded and the rest of the input is drained so that earlier stages don't block. """
+
+    def run():
+        try:
+            for item in iter(input_queue.get, END_OF_STREAM):
+                for output in process(item):
+                    output_queue.put(output)
+        except Exception as e:  # pylint: disable=W0703
+            traceback.print_exc()
+            errors.append((name, e))
+            for _ in iter(input_queue.get, END_OF_STREAM):
+                pass
+        finally:
+            output_queue.put(END_OF_STREAM)
+
+    thread = Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread
+
+
 @click.command()
 @click.option("--rabbitmq_host", type=click.STRING, default="localhost")
 @click.option("--rabbitmq_port", type=click.INT, default=5672)
-@click.option("--scraper_request_cooldown_seconds", type=click.FLOAT, default=1.0)
+@click.option(
+    "--scraper_request_cooldown_seconds",
+    type=click.FLOAT,
+    default=0.0,
+    help="Extra delay after each request on top of the rate limit shared with the workers",
+)
 @click.option("--scrape-fundamentals", is_flag=True, default=False)
 def cli(
     rabbitmq_host: str,
@@ -82,66 +149,88 @@ def cli(
     set_update_started()
 
     trader = Robinhood()
-    res = trader.get_url("https://api.robinhood.com/instruments/")
 
     db = get_db()
     index_coll = db["index"]
-    index_coll.create_index("instrument_id", unique=True)
-
+    ensure_indexes(db, ["index"])
+
+    errors = []
+    page_queue = Queue(PIPELINE_QUEUE_SIZE)
+    tradable_queue = Queue(PIPELINE_QUEUE_SIZE)
+    publish_queue = Queue(PIPELINE_QUEUE_SIZE)
+
+    def fetch_stage():
+        try:
+            for page in fetch_pages(trader, scraper_request_cooldown_seconds, lambda: bool(errors)):
+                page_queue.put(page)
+        except Exception as e:  # pylint: disable=W0703
+            traceback.print_exc()
+            errors.append(("fetch", e))
+        finally:
+            page_queue.put(END_OF_STREAM)
+
+    def filter_stage(page: List[dict]):
+        tradable_instruments = list(get_tradable_instruments(page))
+        if tradable_instruments:
+            yield tradable_instruments
+
+    written_count = 0
+
+    def write_stage(instruments: List[dict]):
+        nonlocal written_count
+
+        written_ids = sync_instrument_page(index_coll, instruments)
+        invalidate_instrument_metadata(written_ids)
+        written_count += len(written_ids)
+        yield instruments
+
+    stages = [
+        Thread(target=fetch_stage, name="fetch", daemon=True),
+        start_stage("filter", filter_stage, page_queue, tradable_queue, errors),
+        start_stage("write", write_stage, tradable_queue, publish_queue, errors),
+    ]
+    stages[0].start()
+
+    # Publishing happens on this thread since the RabbitMQ connection isn't thread safe
     total_ids = 0
     quotes = []
     instrument_ids = []
-    while True:
-        fetched_instruments: List[Dict[str, str]] = res["results"]
-        tradable_instruments = get_tradable_instruments(fetched_instruments)
-
-        for instrument_datum in tradable_instruments:
+    for instruments in iter(publish_queue.get, END_OF_STREAM):
+        for instrument_datum in instruments:
             total_ids += 1
-            try_update_instrument(index_coll, instrument_datum)
-
             instrument_ids.append(instrument_datum["id"])
             quotes.append(instrument_datum["symbol"])
 
-            if len(quotes) == 20:
+            if len(quotes) == PUBLISH_BATCH_SIZE:
                 publish_all(rabbitmq_channel, quotes, instrument_ids, scrape_fundamentals)
 
                 quotes = []
                 instrument_ids = []
 
-        if res.get("detail"):
-            # Request was throttled; wait for a cooldown before continuing
-
-            cooldown_seconds = parse_throttle_res(res["detail"])
-            print(
-                "Instruments fetch request failed; waiting for {} second cooldown...".format(
-                    cooldown_seconds
-                )
-            )
-            sleep(cooldown_seconds)
-        elif res.get("next"):
-            # There are more instruments to scrape.  Wait for the standard cooldown and then
-            # continue by fetching the next request url.
-
-            sleep(scraper_request_cooldown_seconds)
-            res = trader.get_url(res["next"])
-        else:
-            # We're done scraping; there are no more instruments in the list.
-            publish_all(rabbitmq_channel, quotes, instrument_ids, scrape_fundamentals)
-
-            # Publish a finished message over the channels to indicate that there are no more
-            # items to process in this run.
-            rabbitmq_channel.basic_publish(exchange="", routing_key="symbols", body="__DONE")
-            rabbitmq_channel.basic_publish(exchange="", routing_key="instrument_ids", body="__DONE")
-
-            # Mark the instrument scrape as finished
-            set_instruments_finished()
-
-            print(
-                "Finished scraping; fetched a total of {} tradable instrument IDs.".format(
-                    total_ids
-                )
-            )
-            break
+    for stage in stages:
+        stage.join()
+
+    if errors:
+        rabbitmq_connection.close()
+        print("ERROR: Instrument scrape failed in stage(s): {}".format([e[0] for e in errors]))
+        exit(1)
+
+    # We're done scraping; there are no more instruments in the list.
+    publish_all(rabbitmq_channel, quotes, instrument_ids, scrape_fundamentals)
+
+    # Publish a finished message over the channels to indicate that there are no more
+    # items to process in this run.
+    rabbitmq_channel.basic_publish(exchange="", routing_key="symbols", body="__DONE")
+    rabbitmq_channel.basic_publish(exchange="", routing_key="instrument_ids", body="__DONE")
+
+    # Mark the instrument scrape as finished
+    set_instruments_finished()
+
+    print(
+        "Finished scraping; fetched a total of {} tradable instrument IDs ({} changed).".format(
+            total_ids, written_count
+        )
+    )
 
     rabbitmq_connection.close()
 
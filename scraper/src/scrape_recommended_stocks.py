@@ -1,56 +1,200 @@
-import json
-import os
-import time
+""" Fetches the instruments that Robinhood lists as similar to every instrument in the index and
+stores them as a graph in the `similar_instruments` collection, with one document per edge.  The
+similar instruments of an instrument can then be looked up with a single indexed query on
+`instrument_id`, ordered by `rank`.
 
-from db import get_db
+Several requests are kept in flight at once, paced by the `similar_instruments` rate limiter that
+is shared with every other scraper process.  Every instrument that was fetched is recorded in the
+`similar_instruments_progress` collection, and instruments that were fetched recently are skipped,
+so an interrupted scrape picks up where it left off when it's run again. """
 
-SECONDS_BETWEEN_SYMBOLS = 4
+import asyncio
+from datetime import datetime, timedelta
+from typing import List, Tuple
 
-BEARER_TOKEN = os.environ.get("BEARER_TOKEN")
+import aiohttp
+import click
+import pymongo
+from pymongo.errors import AutoReconnect
 
-if BEARER_TOKEN is None:
-    print("The `BEARER_TOKEN` environment variable must be set")
-    exit(1)
+from python_common.db import get_async_db, get_db
+from python_common.schema import ensure_indexes
 
-db = get_db()
+from common import parse_throttle_res
+from rate_limiter import SharedRateLimiter
+from retry import RetryableError, Throttled, run_with_retries_async
+from scrape_historical_candles import get_headers
+from utils import parse_similar_instruments
 
+SIMILAR_URL = "https://dora.robinhood.com/instruments/similar/{}/"
 
-def get_uuid_for_symbol(symbol: str) -> str:
-    doc = db["index"].find_one({"symbol": symbol})
-    if doc is None:
-        return None
-    return doc["instrument_id"]
+SIMILAR_INSTRUMENTS_COLLECTION = "similar_instruments"
+SIMILAR_INSTRUMENTS_PROGRESS_COLLECTION = "similar_instruments_progress"
 
 
-CMD = "curl 'https://dora.robinhood.com/instruments/similar/{}/' -H 'User-Agent: Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:72.0) Gecko/20100101 Firefox/72.0' -H 'Accept: */*' -H 'Accept-Language: en-US,en;q=0.5' --compressed -H 'Authorization: Bearer {}' -H 'Origin: https://robinhood.com' -H 'Connection: keep-alive' -H 'Referer: https://robinhood.com/stocks/VIR' -H 'Pragma: no-cache' -H 'Cache-Control: no-cache' -H 'TE: Trailers' > /home/casey/Downloads/out/{}.json"
+def build_adjacency_ops(instrument_id: str, edges: List[dict]) -> list:
+    """ Builds the writes that replace all edges of an instrument with the provided ones. """
 
-existing = set()
-for fname in os.listdir("/home/casey/Downloads/out"):
-    spl = fname.split(".")
-    symbol = fname.replace(".{}".format(spl[-1]), "")
-    existing.add(symbol)
+    similar_instrument_ids = [edge["similar_instrument_id"] for edge in edges]
+    ops = [
+        pymongo.DeleteMany(
+            {
+                "instrument_id": instrument_id,
+                "similar_instrument_id": {"$nin": similar_instrument_ids},
+            }
+        )
+    ]
+    for edge in edges:
+        ops.append(
+            pymongo.ReplaceOne(
+                {
+                    "instrument_id": instrument_id,
+                    "similar_instrument_id": edge["similar_instrument_id"],
+                },
+                edge,
+                upsert=True,
+            )
+        )
 
-f = open("/home/casey/Downloads/all_symbols.json", "r")
-raw_json = str(f.read())
-parsed = json.loads(raw_json)
+    return ops
 
-for item in parsed:
-    symbol = item["symbol"]
-    if symbol in existing:
-        print("Skipping already downloaded symbol {}".format(symbol))
-        continue
 
-    instrument_id = get_uuid_for_symbol(symbol)
-    if instrument_id is None:
-        print("No index entry found for symbol {}".format(symbol))
-        continue
+def get_pending_instruments(db, fetched_since: datetime) -> List[Tuple[str, str]]:
+    """ Returns the `(symbol, instrument_id)` pairs of all instruments that haven't been fetched
+    since `fetched_since`, ordered by symbol. """
 
-    print(
-        "Fetching recommended symbols for symbol {} instrument ID {}".format(symbol, instrument_id)
+    fetched_instrument_ids = set(
+        doc["instrument_id"]
+        for doc in db[SIMILAR_INSTRUMENTS_PROGRESS_COLLECTION].find(
+            {"fetched_at": {"$gte": fetched_since}},
+            projection={"_id": False, "instrument_id": True},
+        )
     )
-    res = os.system(CMD.format(instrument_id, BEARER_TOKEN, symbol))
-    if res != 0:
-        print("ERROR fetching symbol {}".format(symbol))
-        exit(1)
 
-    time.sleep(SECONDS_BETWEEN_SYMBOLS)
+    instruments = []
+    for doc in db["index"].find(
+        {}, projection={"_id": False, "symbol": True, "instrument_id": True}
+    ):
+        if doc.get("symbol") is None or doc["instrument_id"] in fetched_instrument_ids:
+            continue
+        instruments.append((doc["symbol"], doc["instrument_id"]))
+
+    instruments.sort()
+    return instruments
+
+
+async def fetch_similar(
+    session: aiohttp.ClientSession, rate_limiter: SharedRateLimiter, instrument_id: str
+) -> List[dict]:
+    """ Makes a single attempt at fetching the instruments similar to the provided one.  Failures
+    are signalled by raising the errors from `retry`. """
+
+    await rate_limiter.acquire_async()
+
+    try:
+        async with session.get(SIMILAR_URL.format(instrument_id)) as res:
+            # Instruments without a list of similar instruments are stored as having none, so
+            # their progress is recorded and they're skipped like every other fetched instrument
+            if res.status == 404:
+                return []
+            body = await res.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        raise RetryableError("Error while fetching similar instruments: {}".format(e))
+    except ValueError:
+        raise RetryableError("Robinhood API sending back HTML")
+
+    if not isinstance(body, dict):
+        raise RetryableError("Robinhood sent back garbage: {}".format(body))
+    if body.get("similar") is None:
+        if body.get("detail"):
+            raise Throttled(parse_throttle_res(body["detail"]))
+        raise RetryableError("Unexpected response received from Robinhood: {}".format(body))
+
+    await asyncio.get_event_loop().run_in_executor(None, rate_limiter.report_success)
+    return body["similar"]
+
+
+async def scrape_similar_instruments(
+    headers: dict, instruments: List[Tuple[str, str]], concurrency: int
+):
+    db = get_async_db()
+    rate_limiter = SharedRateLimiter("similar_instruments")
+    semaphore = asyncio.Semaphore(concurrency)
+    failed_symbols = []
+    done_count = 0
+
+    async def attempt(session: aiohttp.ClientSession, instrument_id: str):
+        similar = await fetch_similar(session, rate_limiter, instrument_id)
+        try:
+            edges = parse_similar_instruments(instrument_id, similar)
+        except (TypeError, AttributeError):
+            raise RetryableError("Robinhood sent back garbage: {}".format(similar))
+
+        try:
+            await db[SIMILAR_INSTRUMENTS_COLLECTION].bulk_write(
+                build_adjacency_ops(instrument_id, edges), ordered=True
+            )
+            await db[SIMILAR_INSTRUMENTS_PROGRESS_COLLECTION].update_one(
+                {"instrument_id": instrument_id},
+                {"$set": {"fetched_at": datetime.utcnow()}},
+                upsert=True,
+            )
+        except AutoReconnect as e:
+            raise RetryableError("Error while storing similar instruments: {}".format(e))
+
+    async def handle_instrument(session: aiohttp.ClientSession, symbol: str, instrument_id: str):
+        nonlocal done_count
+
+        async with semaphore:
+            error = await run_with_retries_async(
+                lambda: attempt(session, instrument_id), rate_limiter
+            )
+
+        done_count += 1
+        if error is not None:
+            print(f"Giving up on symbol {symbol}: {error}")
+            failed_symbols.append(symbol)
+        else:
+            print(f"[{done_count}/{len(instruments)}] Stored similar instruments for {symbol}")
+
+    timeout = aiohttp.ClientTimeout(total=15)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(
+        headers=headers, timeout=timeout, connector=connector
+    ) as session:
+        await asyncio.gather(
+            *(
+                handle_instrument(session, symbol, instrument_id)
+                for (symbol, instrument_id) in instruments
+            )
+        )
+
+    if failed_symbols:
+        print(
+            f"Failed to fetch {len(failed_symbols)} symbols; they'll be retried on the next run: "
+            + ",".join(failed_symbols)
+        )
+
+
+@click.command()
+@click.option("--concurrency", type=click.INT, default=4, help="Max number of in-flight requests")
+@click.option(
+    "--refetch_after_hours",
+    type=click.FLOAT,
+    default=24.0 * 7,
+    help="Skip instruments whose similar instruments were fetched more recently than this",
+)
+def main(concurrency: int, refetch_after_hours: float):
+    headers = get_headers()
+
+    db = get_db()
+    ensure_indexes(db, [SIMILAR_INSTRUMENTS_COLLECTION, SIMILAR_INSTRUMENTS_PROGRESS_COLLECTION])
+    fetched_since = datetime.utcnow() - timedelta(hours=refetch_after_hours)
+    instruments = get_pending_instruments(db, fetched_since)
+    print(f"Fetching similar instruments for {len(instruments)} instruments")
+
+    asyncio.run(scrape_similar_instruments(headers, instruments, concurrency))
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
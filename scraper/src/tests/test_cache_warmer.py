@@ -0,0 +1,70 @@
+from ..cache_warmer import (
+    dump_response,
+    get_generational_hash_name,
+    get_warmup_options,
+    hash_options,
+    rank_popularity_differences,
+)
+
+
+def test_hash_options_matches_backend():
+    options = {
+        "hours_ago": 24,
+        "limit": 50,
+        "percentage": False,
+        "min_popularity": None,
+        "start_index": 0,
+    }
+    assert hash_options(options) == "24_50__false_0"
+
+    options.update({"percentage": True, "min_popularity": 100})
+    assert hash_options(options) == "24_50_100_true_0"
+
+
+def test_generational_hash_name():
+    assert get_generational_hash_name("largest_popularity_changes", 3) == (
+        "largest_popularity_changes:3"
+    )
+
+
+def test_dump_response():
+    response = [{"start_popularity": 1, "popularity_difference": None, "name": "Café"}]
+    assert dump_response(response) == (
+        '[{"start_popularity":1,"popularity_difference":null,"name":"Café"}]'
+    )
+
+
+def test_rank_popularity_differences():
+    popularities = {"a": (10, 30), "b": (100, 50), "c": (0, 5), "d": (20, 25)}
+
+    changes = rank_popularity_differences(popularities, -1, True, False, None, 50)
+    assert [entry[0] for entry in changes] == ["b", "a", "c", "d"]
+    assert changes[0] == ("b", 100, 50, -50)
+
+    increases = rank_popularity_differences(popularities, -1, False, False, None, 2)
+    assert [entry[0] for entry in increases] == ["a", "c"]
+
+    decreases = rank_popularity_differences(popularities, 1, False, False, None, 50, 1)
+    assert [entry[0] for entry in decreases] == ["c", "d", "a"]
+
+
+def test_rank_popularity_differences_percentage():
+    popularities = {"a": (10, 30), "b": (100, 50), "c": (0, 5), "d": (20, 25)}
+
+    changes = rank_popularity_differences(popularities, -1, True, True, None, 50)
+    assert changes == [
+        ("a", 10, 30, 200.0),
+        ("b", 100, 50, -50.0),
+        ("d", 20, 25, 25.0),
+        ("c", 0, 5, None),
+    ]
+
+    filtered = rank_popularity_differences(popularities, -1, False, True, 20, 50)
+    assert [entry[0] for entry in filtered] == ["d", "b"]
+
+
+def test_get_warmup_options():
+    all_options = get_warmup_options(1)
+    assert len(all_options) == 8
+    assert hash_options(all_options[0]) == "2_50__false_0"
+    assert hash_options(all_options[-1]) == "2_50_10000_true_0"
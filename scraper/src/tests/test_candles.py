@@ -0,0 +1,42 @@
+from datetime import datetime
+
+from ..utils import parse_candle_results
+
+
+def test_parse_candle_results():
+    results = [
+        {
+            "symbol": "AAPL",
+            "instrument": "https://api.robinhood.com/instruments/450dfc6d-5510-4d40-abfb-f633b7d9be3e/",
+            "historicals": [
+                {
+                    "begins_at": "2020-01-02T00:00:00Z",
+                    "open_price": "296.240000",
+                    "close_price": "300.350000",
+                    "high_price": "300.600000",
+                    "low_price": "295.190000",
+                    "volume": 33911864,
+                    "session": "reg",
+                    "interpolated": False,
+                }
+            ],
+        },
+        None,
+    ]
+
+    assert parse_candle_results(results, "day", "regular") == [
+        {
+            "instrument_id": "450dfc6d-5510-4d40-abfb-f633b7d9be3e",
+            "symbol": "AAPL",
+            "interval": "day",
+            "bounds": "regular",
+            "begins_at": datetime(2020, 1, 2),
+            "open_price": 296.24,
+            "close_price": 300.35,
+            "high_price": 300.6,
+            "low_price": 295.19,
+            "volume": 33911864,
+            "session": "reg",
+            "interpolated": False,
+        }
+    ]
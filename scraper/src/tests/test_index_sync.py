@@ -0,0 +1,60 @@
+from ..index_sync import build_index_doc, diff_instrument_page
+
+
+def instrument(instrument_id: str, symbol: str, **kwargs) -> dict:
+    return {"id": instrument_id, "symbol": symbol, "tradability": "tradable", **kwargs}
+
+
+def existing(instrument_datum: dict) -> dict:
+    doc = build_index_doc(instrument_datum)
+    return {key: doc[key] for key in ("instrument_id", "symbol", "content_hash")}
+
+
+def test_build_index_doc_hash_ignores_key_order():
+    a = build_index_doc({"id": "1", "symbol": "AMD", "name": "Advanced Micro Devices"})
+    b = build_index_doc({"name": "Advanced Micro Devices", "symbol": "AMD", "id": "1"})
+
+    assert a["instrument_id"] == "1" and "id" not in a
+    assert a["content_hash"] == b["content_hash"]
+
+
+def test_diff_skips_unchanged_instruments():
+    page = [instrument("1", "AMD"), instrument("2", "AAPL")]
+    existing_docs = [existing(instrument("1", "AMD")), existing(instrument("2", "AAPL", name="x"))]
+
+    (stale_ids, to_write) = diff_instrument_page(page, existing_docs)
+    assert stale_ids == set()
+    assert [doc["instrument_id"] for doc in to_write] == ["2"]
+
+
+def test_diff_writes_new_instruments():
+    (stale_ids, to_write) = diff_instrument_page([instrument("1", "AMD")], [])
+
+    assert stale_ids == set()
+    assert [doc["instrument_id"] for doc in to_write] == ["1"]
+
+
+def test_diff_resolves_symbol_conflicts():
+    page = [instrument("new", "FB")]
+    existing_docs = [existing(instrument("old", "FB"))]
+
+    (stale_ids, to_write) = diff_instrument_page(page, existing_docs)
+    assert stale_ids == {"old"}
+    assert [doc["instrument_id"] for doc in to_write] == ["new"]
+
+
+def test_diff_handles_renamed_instruments_in_same_page():
+    # `old` gives its symbol to `new` and takes a new one itself
+    page = [instrument("new", "FB"), instrument("old", "META")]
+    existing_docs = [existing(instrument("old", "FB"))]
+
+    (stale_ids, to_write) = diff_instrument_page(page, existing_docs)
+    assert stale_ids == {"old"}
+    assert sorted(doc["instrument_id"] for doc in to_write) == ["new", "old"]
+
+
+def test_diff_last_instrument_wins_within_page():
+    page = [instrument("1", "AMD"), instrument("2", "AMD")]
+
+    (_, to_write) = diff_instrument_page(page, [])
+    assert [doc["instrument_id"] for doc in to_write] == ["2"]
@@ -0,0 +1,42 @@
+from datetime import datetime
+
+import pymongo
+
+from python_common.popularity_buckets import (
+    build_bucket_doc,
+    build_bucket_update_ops,
+    get_bucket_day,
+    unpack_bucket,
+)
+
+
+def test_build_bucket_update_ops():
+    timestamp = datetime(2019, 5, 3, 14, 30, 12)
+    ops = build_bucket_update_ops({"a": 10, "b": 0}, timestamp)
+
+    assert ops == [
+        pymongo.UpdateOne(
+            {"instrument_id": instrument_id, "day": datetime(2019, 5, 3)},
+            {"$push": {"timestamps": timestamp, "popularities": popularity}, "$inc": {"count": 1}},
+            upsert=True,
+        )
+        for (instrument_id, popularity) in [("a", 10), ("b", 0)]
+    ]
+
+
+def test_bucket_round_trip():
+    day = get_bucket_day(datetime(2019, 5, 3, 23, 59))
+    docs = [
+        {"timestamp": datetime(2019, 5, 3, 2), "instrument_id": "a", "popularity": 2},
+        {"timestamp": datetime(2019, 5, 3, 1), "instrument_id": "a", "popularity": 1},
+        {"timestamp": datetime(2019, 5, 3, 3), "instrument_id": "a", "popularity": 3},
+    ]
+    bucket = build_bucket_doc("a", day, docs)
+
+    assert bucket["day"] == datetime(2019, 5, 3)
+    assert bucket["popularities"] == [1, 2, 3]
+    assert bucket["count"] == 3
+    assert unpack_bucket(bucket) == sorted(docs, key=lambda doc: doc["timestamp"])
+    assert unpack_bucket(bucket, start=datetime(2019, 5, 3, 2), end=datetime(2019, 5, 3, 3)) == [
+        docs[0]
+    ]
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from ..utils import build_popularity_docs, parse_popularity_results
+
+
+def test_parse_popularity_results():
+    results = [
+        {
+            "instrument": "https://api.robinhood.com/instruments/f7a777df-9b1f-47f6-a82f-fe2645f663c2/",
+            "num_open_positions": 1337,
+        },
+        {
+            "instrument": "https://api.robinhood.com/instruments/450dfc6d-5510-4d40-abfb-f633b7d9be3e/",
+            "num_open_positions": 0,
+        },
+    ]
+
+    assert parse_popularity_results(results) == {
+        "f7a777df-9b1f-47f6-a82f-fe2645f663c2": 1337,
+        "450dfc6d-5510-4d40-abfb-f633b7d9be3e": 0,
+    }
+
+
+def test_build_popularity_docs():
+    timestamp = datetime(2020, 1, 5, 0, 42, 26)
+    docs = build_popularity_docs({"a": 1, "b": 2}, timestamp)
+
+    assert docs == [
+        {"timestamp": timestamp, "instrument_id": "a", "popularity": 1},
+        {"timestamp": timestamp, "instrument_id": "b", "popularity": 2},
+    ]
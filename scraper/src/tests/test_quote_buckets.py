@@ -0,0 +1,62 @@
+from datetime import datetime
+import json
+from os import path
+
+import pymongo
+
+from python_common.quote_buckets import (
+    BUCKETED_QUOTE_KEYS,
+    build_quote_bucket_update_ops,
+    parse_quote_prices,
+    unpack_quote_bucket,
+)
+
+from ..utils import pluck, parse_updated_at, DESIRED_QUOTE_KEYS
+
+
+def load_parsed_quote() -> dict:
+    with open(path.join(path.dirname(__file__), "./raw_quote.json")) as json_file:
+        raw_quote_dict = json.load(json_file)
+
+    plucked = {
+        **pluck(DESIRED_QUOTE_KEYS, raw_quote_dict),
+        "instrument_id": raw_quote_dict["instrument_id"],
+    }
+    plucked["updated_at"] = parse_updated_at(plucked["updated_at"])
+    return parse_quote_prices(plucked)
+
+
+def test_parse_quote_prices():
+    assert load_parsed_quote() == {
+        "instrument_id": "f7a777df-9b1f-47f6-a82f-fe2645f663c2",
+        "bid_price": 18.9,
+        "ask_price": 35.9,
+        "bid_size": 100,
+        "ask_size": 100,
+        "updated_at": datetime(2018, 5, 1, 20),
+        "last_trade_price": 27.0,
+        "last_extended_hours_trade_price": None,
+    }
+
+
+def test_quote_bucket_round_trip():
+    quote = load_parsed_quote()
+    [op] = build_quote_bucket_update_ops([quote])
+
+    pushed = {key: quote[key] for key in ["updated_at"] + BUCKETED_QUOTE_KEYS}
+    assert op == pymongo.UpdateOne(
+        {
+            "instrument_id": quote["instrument_id"],
+            "day": datetime(2018, 5, 1),
+            "updated_at": {"$ne": quote["updated_at"]},
+        },
+        {"$push": pushed, "$inc": {"count": 1}},
+        upsert=True,
+    )
+
+    # Apply the `$push` to an empty bucket
+    bucket = {"instrument_id": quote["instrument_id"], "day": datetime(2018, 5, 1)}
+    for (key, value) in pushed.items():
+        bucket[key] = [value]
+
+    assert unpack_quote_bucket(bucket) == [quote]
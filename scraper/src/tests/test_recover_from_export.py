@@ -0,0 +1,105 @@
+from collections import namedtuple
+from datetime import datetime
+import json
+
+import pymongo
+
+from ..recover_from_export import (
+    build_upsert_ops,
+    get_export_symbol,
+    in_window,
+    parse_quotes_export,
+    recover_symbol,
+)
+
+
+def test_parse_quotes_export(tmpdir):
+    export = tmpdir.join("AAPL.json")
+    export.write(
+        json.dumps({"historicals": [{"open_price": "1.5", "begins_at": "2019-12-10T14:00:00Z"}]})
+    )
+
+    [doc] = parse_quotes_export(str(export), "instrument")
+    assert doc["updated_at"] == datetime(2019, 12, 10, 14)
+    assert doc["last_trade_price"] == 1.5
+
+    export.write(json.dumps({}))
+    assert parse_quotes_export(str(export), "instrument") is None
+
+
+def test_build_upsert_ops():
+    doc = {"instrument_id": "instrument", "updated_at": datetime(2019, 12, 10), "bid_price": 1.0}
+    assert build_upsert_ops([doc], "updated_at") == [
+        pymongo.UpdateOne(
+            {"instrument_id": "instrument", "updated_at": datetime(2019, 12, 10)},
+            {"$setOnInsert": doc},
+            upsert=True,
+        )
+    ]
+
+
+def test_window_and_symbols():
+    assert in_window(datetime(2020, 1, 1), None, None)
+    assert in_window(datetime(2020, 1, 1), datetime(2020, 1, 1), datetime(2020, 1, 2))
+    assert not in_window(datetime(2020, 1, 2), datetime(2020, 1, 1), datetime(2020, 1, 2))
+    assert get_export_symbol("_CON.csv") == "CON"
+    assert get_export_symbol("AAPL.json") == "AAPL"
+    assert get_export_symbol("BRK.B.csv") == "BRK.B"
+    assert get_export_symbol("_PRN.csv") == "PRN"
+
+
+BulkWriteResult = namedtuple("BulkWriteResult", ["upserted_count"])
+
+
+class FakeCollection:
+    """ Stores documents in a list and supports just the queries that recovery makes. """
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.written_ops = []
+
+    def find(self, query, projection=None):
+        (time_key, time_range) = next(
+            (key, value) for (key, value) in query.items() if key != "instrument_id"
+        )
+        return [
+            doc
+            for doc in self.docs
+            if doc["instrument_id"] == query["instrument_id"]
+            and time_range["$gte"] <= doc[time_key] < time_range["$lt"]
+        ]
+
+    def bulk_write(self, ops, ordered=True):
+        self.written_ops.extend(ops)
+        return BulkWriteResult(upserted_count=len(ops))
+
+
+def test_recover_popularity_skips_stored_milliseconds(tmpdir):
+    stored = {
+        "instrument_id": "instrument",
+        "timestamp": datetime(2020, 1, 5, 0, 42, 26, 123000),
+        "popularity": 10,
+    }
+    popularity = FakeCollection([stored])
+    export = tmpdir.join("AAPL.csv")
+    export.write('timestamp,popularity\n"2020-01-05 00:42:26",10\n"2020-01-05 00:42:27",11\n')
+
+    inserted_count = recover_symbol(
+        {"popularity": popularity}, "popularity", str(export), "instrument", None, None
+    )
+    assert inserted_count == 1
+    recovered = {
+        "instrument_id": "instrument",
+        "timestamp": datetime(2020, 1, 5, 0, 42, 27),
+        "popularity": 11,
+    }
+    assert popularity.written_ops == build_upsert_ops([recovered], "timestamp")
+
+    # Recovering an export that only holds the stored sample writes nothing
+    popularity.written_ops = []
+    export.write('timestamp,popularity\n"2020-01-05 00:42:26",10\n')
+    inserted_count = recover_symbol(
+        {"popularity": popularity}, "popularity", str(export), "instrument", None, None
+    )
+    assert inserted_count == 0
+    assert popularity.written_ops == []
@@ -0,0 +1,80 @@
+from ..retry import (
+    PermanentError,
+    RetryableError,
+    RetryPolicy,
+    Throttled,
+    backoff_delay,
+    raise_for_response,
+    run_with_retries,
+)
+
+POLICY = RetryPolicy(
+    max_attempts=3, max_throttled_attempts=5, base_delay_seconds=1.0, max_delay_seconds=4.0
+)
+
+
+def failing_attempt(errors: list):
+    """ Returns an attempt function that raises each of the provided errors in turn and then
+    succeeds. """
+
+    def attempt():
+        if errors:
+            raise errors.pop(0)
+
+    return attempt
+
+
+def test_backoff_delay_is_capped():
+    for attempt in range(10):
+        delay = backoff_delay(attempt, POLICY)
+        assert 0 <= delay <= min(4.0, 2 ** attempt)
+
+
+def test_run_with_retries_succeeds_after_failures():
+    sleeps = []
+    attempt = failing_attempt([RetryableError("timeout"), RetryableError("timeout")])
+
+    assert run_with_retries(attempt, sleeps.append, policy=POLICY) is None
+    assert len(sleeps) == 2
+
+
+def test_run_with_retries_gives_up_after_budget():
+    sleeps = []
+    errors = [RetryableError(str(i)) for i in range(10)]
+
+    error = run_with_retries(failing_attempt(errors), sleeps.append, policy=POLICY)
+    assert str(error) == "2"
+    assert len(sleeps) == 2
+
+
+def test_run_with_retries_does_not_retry_permanent_errors():
+    sleeps = []
+    errors = [PermanentError("invalid symbol"), RetryableError("timeout")]
+
+    error = run_with_retries(failing_attempt(errors), sleeps.append, policy=POLICY)
+    assert isinstance(error, PermanentError)
+    assert sleeps == []
+
+
+def test_run_with_retries_throttles_have_separate_budget():
+    sleeps = []
+    errors = [Throttled(10), Throttled(10), RetryableError("timeout"), Throttled(10)]
+
+    assert run_with_retries(failing_attempt(errors), sleeps.append, policy=POLICY) is None
+    assert sleeps[0] == 10 and sleeps[1] == 10 and sleeps[3] == 10
+
+
+def test_raise_for_response():
+    raise_for_response({"results": []})
+
+    try:
+        raise_for_response({"detail": "Request was throttled. Expected available in 57 seconds."})
+        assert False
+    except Throttled as e:
+        assert e.cooldown_seconds == 59
+
+    try:
+        raise_for_response({"foo": "bar"})
+        assert False
+    except RetryableError:
+        pass
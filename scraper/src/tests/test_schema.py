@@ -0,0 +1,101 @@
+from datetime import datetime
+
+from python_common import schema
+from python_common.schema import INDEXES, get_plan_stages, get_verify_queries
+
+
+def test_get_plan_stages():
+    plan = {
+        "stage": "SORT",
+        "inputStage": {
+            "stage": "OR",
+            "inputStages": [
+                {"stage": "FETCH", "inputStage": {"stage": "IXSCAN", "keyPattern": {"a": 1}}},
+                {"stage": "COLLSCAN", "filter": {"b": {"$eq": 1}}},
+            ],
+        },
+    }
+
+    assert get_plan_stages(plan) == ["SORT", "OR", "FETCH", "IXSCAN", "COLLSCAN"]
+
+
+def test_verify_queries_target_declared_collections():
+    for query in get_verify_queries():
+        assert query.collection in INDEXES
+
+
+class FakeCollection:
+    def __init__(self, docs=None, indexes=None):
+        self.docs = docs or []
+        self.indexes = indexes or {}
+
+    def find_one(self, query, projection=None):
+        return self.docs[0] if self.docs else None
+
+    def index_information(self):
+        return self.indexes
+
+    def create_index(self, keys, **options):
+        name = "_".join(f"{key}_{direction}" for (key, direction) in keys)
+        self.indexes[name] = {"key": keys, **options}
+
+
+class FakeDb(dict):
+    def __init__(self, popularity_indexes=None, migrated=False):
+        super().__init__(popularity=FakeCollection(indexes=popularity_indexes))
+        self["migrations"] = FakeCollection(
+            [{"_id": "popularity_buckets", "migrated_through": datetime(2020, 1, 6)}]
+            if migrated
+            else []
+        )
+        self.commands = []
+
+    def command(self, name, collection, **kwargs):
+        self.commands.append((name, collection, kwargs))
+
+
+POPULARITY_INDEXES = {"popularity": [schema.index(("timestamp", schema.ASC))]}
+
+
+def get_ttl_commands(db) -> list:
+    return [kwargs["index"]["expireAfterSeconds"] for (_, _, kwargs) in db.commands]
+
+
+def test_popularity_only_expires_with_migrated_history(monkeypatch):
+    monkeypatch.setattr(schema, "INDEXES", POPULARITY_INDEXES)
+    monkeypatch.setattr(schema, "POPULARITY_RETENTION_DAYS", 1)
+
+    for (enabled, migrated, expected_ttls) in [
+        (False, True, []),
+        (True, False, []),
+        (True, True, [86400]),
+    ]:
+        monkeypatch.setattr(schema, "BUCKETED_POPULARITY_ENABLED", enabled)
+        db = FakeDb(migrated=migrated)
+
+        assert schema.ensure_indexes(db) == []
+        # The timestamp index is built whether or not documents expire
+        assert [info["key"] for info in db["popularity"].indexes.values()] == [
+            [("timestamp", schema.ASC)]
+        ]
+        assert get_ttl_commands(db) == expected_ttls
+
+
+def test_popularity_ttl_is_changed_in_place(monkeypatch):
+    monkeypatch.setattr(schema, "INDEXES", POPULARITY_INDEXES)
+    monkeypatch.setattr(schema, "BUCKETED_POPULARITY_ENABLED", True)
+
+    for (retention_days, current_ttl, expected_ttls) in [
+        (1, 86400, []),
+        (2, 86400, [172800]),
+        (None, 86400, [schema.NEVER_EXPIRE_SECONDS]),
+        (None, schema.NEVER_EXPIRE_SECONDS, []),
+    ]:
+        monkeypatch.setattr(schema, "POPULARITY_RETENTION_DAYS", retention_days)
+        timestamp_index = {"key": [("timestamp", schema.ASC)], "expireAfterSeconds": current_ttl}
+        db = FakeDb({"timestamp_1": timestamp_index}, migrated=True)
+
+        assert schema.ensure_indexes(db) == []
+        # The existing index isn't rebuilt with different options
+        assert db["popularity"].indexes == {"timestamp_1": timestamp_index}
+        assert get_ttl_commands(db) == expected_ttls
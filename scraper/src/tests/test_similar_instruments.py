@@ -0,0 +1,31 @@
+from ..utils import parse_similar_instruments
+
+
+def test_parse_similar_instruments():
+    similar = [
+        {
+            "instrument_id": "e39ed23a-7bd1-4587-b060-71988d9ef483",
+            "symbol": "TSLA",
+            "name": "Tesla, Inc. Common Stock",
+            "simple_name": "Tesla",
+        },
+        {"instrument_id": None, "symbol": "GONE"},
+        {"instrument_id": "bab3b12b-4216-4b40-8a3c-8e3b8a5e4b3f", "symbol": "NIO", "name": "NIO"},
+    ]
+
+    assert parse_similar_instruments("450dfc6d-5510-4d40-abfb-f633b7d9be3e", similar) == [
+        {
+            "instrument_id": "450dfc6d-5510-4d40-abfb-f633b7d9be3e",
+            "similar_instrument_id": "e39ed23a-7bd1-4587-b060-71988d9ef483",
+            "similar_symbol": "TSLA",
+            "similar_name": "Tesla",
+            "rank": 0,
+        },
+        {
+            "instrument_id": "450dfc6d-5510-4d40-abfb-f633b7d9be3e",
+            "similar_instrument_id": "bab3b12b-4216-4b40-8a3c-8e3b8a5e4b3f",
+            "similar_symbol": "NIO",
+            "similar_name": "NIO",
+            "rank": 2,
+        },
+    ]
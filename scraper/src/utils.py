@@ -40,6 +40,68 @@ def build_instrument_url(instrument_id: str) -> str:
     return f"https://api.robinhood.com/instruments/{instrument_id}/"
 
 
+def parse_popularity_results(results: List[dict]) -> dict:
+    return {
+        parse_instrument_url(datum["instrument"]): datum["num_open_positions"] for datum in results
+    }
+
+
+def build_popularity_docs(popularity_map: dict, timestamp: datetime) -> List[dict]:
+    return [
+        {"timestamp": timestamp, "instrument_id": instrument_id, "popularity": popularity}
+        for (instrument_id, popularity) in popularity_map.items()
+    ]
+
+
+CANDLE_PRICE_KEYS = ["open_price", "close_price", "high_price", "low_price"]
+
+
+def parse_candle_results(results: List[dict], interval: str, bounds: str) -> List[dict]:
+    """ Converts the results of a `marketdata/historicals` response into candle documents.
+    Results for symbols that Robinhood couldn't find are `None` and are skipped. """
+
+    candles = []
+    for result in results:
+        if result is None:
+            continue
+
+        instrument_id = parse_instrument_url(result["instrument"])
+        for historical in result["historicals"]:
+            candle = {
+                "instrument_id": instrument_id,
+                "symbol": result["symbol"],
+                "interval": interval,
+                "bounds": bounds,
+                "begins_at": parse_updated_at(historical["begins_at"]),
+                "volume": historical.get("volume"),
+                "session": historical.get("session"),
+                "interpolated": historical.get("interpolated"),
+            }
+            for key in CANDLE_PRICE_KEYS:
+                price = historical.get(key)
+                candle[key] = None if price is None else float(price)
+            candles.append(candle)
+
+    return candles
+
+
+def parse_similar_instruments(instrument_id: str, similar: List[dict]) -> List[dict]:
+    """ Converts the instruments that Robinhood lists as similar to an instrument into edges of the
+    similar instruments graph, ranked in the order that Robinhood returned them. """
+
+    return [
+        {
+            "instrument_id": instrument_id,
+            "similar_instrument_id": datum["instrument_id"],
+            "similar_symbol": datum.get("symbol"),
+            "similar_name": datum.get("simple_name") or datum.get("name"),
+            "rank": rank,
+        }
+        for (rank, datum) in enumerate(similar)
+        if datum.get("instrument_id") is not None
+    ]
+
+
 def omit(k, d: dict) -> dict:
     new_d = {**d}
     new_d.__delitem__(k)
@@ -3,7 +3,6 @@ quotes, popularity, or stores the ID in a database. """
 
 
 import datetime, hmac, base64, struct, hashlib, time
-from functools import reduce
 from json.decoder import JSONDecodeError
 from pprint import pprint
 from os import environ
@@ -11,17 +10,46 @@ from os import environ
 import click
 import pika
 import pymongo
-from pymongo.errors import BulkWriteError
+from pymongo.errors import AutoReconnect, BulkWriteError
 import requests
 
 from Robinhood import Robinhood, endpoints
 from Robinhood.exceptions import InvalidTickerSymbol
 
-from common import parse_throttle_res
-from db import get_db, set_popularities_finished, set_quotes_finished, unlock_cache
+from python_common.popularity_buckets import (
+    BUCKETED_POPULARITY_ENABLED,
+    POPULARITY_BUCKETS_COLLECTION,
+    build_bucket_update_ops,
+)
+from python_common.quote_buckets import (
+    BUCKETED_QUOTES_ENABLED,
+    QUOTES_BUCKETS_COLLECTION,
+    build_quote_bucket_update_ops,
+    parse_quote_prices,
+)
+from python_common.schema import ensure_indexes
+
+from db import (
+    get_db,
+    record_popularities,
+    set_popularities_finished,
+    set_quotes_finished,
+    unlock_cache,
+)
+from queue_metrics import get_management_url, record_queue_lag
+from rate_limiter import RATE_LIMITERS
+from retry import (
+    PermanentError,
+    RetryableError,
+    get_dead_letter_queue,
+    raise_for_response,
+    run_with_retries,
+)
 from utils import (
     parse_instrument_url,
     build_instrument_url,
+    build_popularity_docs,
+    parse_popularity_results,
     parse_updated_at,
     pluck,
     DESIRED_QUOTE_KEYS,
@@ -29,25 +57,30 @@ from utils import (
 )
 
 INDEX_COL = get_db()["index"]
+POPULARITY_BUCKETS_COL = get_db()[POPULARITY_BUCKETS_COLLECTION]
+QUOTES_BUCKETS_COL = get_db()[QUOTES_BUCKETS_COLLECTION]
 
 TRADER = Robinhood()
 
 
 def store_popularities(popularity_map: dict, collection: pymongo.collection.Collection):
-    """ Creates an entry in the database for the popularity. """
+    """ Creates an entry in the database for the popularity.  Neither write is idempotent, so this
+    must only be called once per fetched batch. """
 
     timestamp = datetime.datetime.utcnow()
     pprint(popularity_map)
-    mapped_documents = map(
-        lambda key: {
-            "timestamp": timestamp,
-            "instrument_id": key,
-            "popularity": popularity_map[key],
-        },
-        popularity_map.keys(),
-    )
+    collection.insert_many(build_popularity_docs(popularity_map, timestamp))
+    if BUCKETED_POPULARITY_ENABLED:
+        POPULARITY_BUCKETS_COL.bulk_write(
+            build_bucket_update_ops(popularity_map, timestamp), ordered=False
+        )
 
-    collection.insert_many(mapped_documents)
+    # The batch is already persisted at this point, so failing to update the rankings mustn't
+    # cause it to be retried or dead-lettered
+    try:
+        record_popularities(popularity_map, timestamp)
+    except Exception as e:  # pylint: disable=W0703
+        print(f"ERROR: Failed to record popularities in the rankings: {e}")
 
 
 def store_quotes(quotes: list, collection: pymongo.collection.Collection):
@@ -58,7 +91,8 @@ def store_quotes(quotes: list, collection: pymongo.collection.Collection):
 
         plucked = {"instrument_id": instrument_id, **pluck(DESIRED_QUOTE_KEYS, quote)}
         plucked["updated_at"] = parse_updated_at(plucked["updated_at"])
-        return plucked
+        # Prices are stored as numbers so that readers don't have to parse them over and over
+        return parse_quote_prices(plucked)
 
     quotes = list(filter(lambda quote: quote != None, quotes))
 
@@ -85,6 +119,7 @@ def store_quotes(quotes: list, collection: pymongo.collection.Collection):
     INDEX_COL.bulk_write(ops, ordered=False)
 
     quotes = list(map(map_quote, quotes))
+    bucket_ops = build_quote_bucket_update_ops(quotes) if BUCKETED_QUOTES_ENABLED else []
     try:
         collection.insert_many(quotes, ordered=False)
     except BulkWriteError as bwe:
@@ -93,6 +128,17 @@ def store_quotes(quotes: list, collection: pymongo.collection.Collection):
                 print("ERROR: Unhandled exception occured during batch write:")
                 pprint(err)
 
+    if not bucket_ops:
+        return
+    try:
+        QUOTES_BUCKETS_COL.bulk_write(bucket_ops, ordered=False)
+    except BulkWriteError as bwe:
+        for err in bwe.details["writeErrors"]:
+            # Quotes that haven't changed since the last scrape are already in their bucket
+            if err["code"] != 11000:
+                print("ERROR: Unhandled exception occured during batch write:")
+                pprint(err)
+
 
 def store_fundamentals(data, collection: pymongo.collection.Collection):
     if not data:
@@ -116,169 +162,124 @@ def fetch_popularity(
     instrument_ids: str,
     collection: pymongo.collection.Collection,
     sleep,
-    worker_request_cooldown_seconds=1.0,
-):
+    worker_request_cooldown_seconds=0.0,
+) -> Exception:
+    """ Fetches and stores popularities for the batch of instrument IDs, retrying the fetch on
+    failure.  The popularities are stored once they've been fetched, outside of the retries, so a
+    retry can never store a batch twice.  Returns the error that caused the batch to be given up
+    on, if any. """
+
     if instrument_ids == "__DONE":
         print("Received DONE message for popularity fetching; marking as complete in Redis...")
         set_popularities_finished()
-        return
+        return None
 
     url = "https://api.robinhood.com/instruments/popularity/?ids={}".format(instrument_ids)
+    rate_limiter = RATE_LIMITERS["popularity"]
+    popularities = {}
 
-    def reduce_popularity(acc: dict, datum: dict) -> dict:
-        instrument_id = parse_instrument_url(datum["instrument"])
-
-        return {**acc, instrument_id: datum["num_open_positions"]}
-
-    def call_self():
-        """ In the case of some kind of error, wait 30 seconds and then re-call ourself to try
-        again. """
-
-        sleep(30)
-        fetch_popularity(
-            instrument_ids,
-            collection,
-            sleep,
-            worker_request_cooldown_seconds=worker_request_cooldown_seconds,
-        )
+    def attempt():
+        rate_limiter.acquire(sleep)
+        try:
+            res = TRADER.get_url(url)
+        except requests.exceptions.RequestException as e:
+            raise RetryableError("Error while fetching popularity: {}".format(e))
+        except JSONDecodeError:
+            raise RetryableError("Robinhood API sending back HTML")
 
-    try:
-        res = TRADER.get_url(url)
-        popularities = reduce(reduce_popularity, res["results"], {})
-        store_popularities(popularities, collection)
-        sleep(worker_request_cooldown_seconds)
-    except KeyError:  # Likely a ratelimit issue; cooldown.
-        if not res.get("results"):
-            print("ERROR: Unexpected response received from popularity request: {}".format(res))
-            sleep(120)
-            return
-
-        print(res)
-        cooldown_seconds = parse_throttle_res(res["detail"])
-        print(
-            "Popularity fetch request failed; waiting for {} second cooldown...".format(
-                cooldown_seconds
-            )
-        )
-        sleep(cooldown_seconds)
+        raise_for_response(res)
+        try:
+            popularities.update(parse_popularity_results(res["results"]))
+        except (TypeError, KeyError):
+            raise RetryableError("Robinhood sent back garbage: {}".format(res))
+        rate_limiter.report_success()
 
-        fetch_popularity(
-            instrument_ids,
-            collection,
-            sleep,
-            worker_request_cooldown_seconds=worker_request_cooldown_seconds,
-        )
-    except requests.exceptions.ReadTimeout:
-        print("Read timeout while fetching popularity... Sleeping 30 seconds and re-trying.")
-        call_self()
-    except TypeError:  # They sent back some broken data; just ignore it.
-        print("Robinhood sent back garbage; ignoring.")
-        call_self()
-    except JSONDecodeError:
-        print("Robinhood API sending back HTML; backing off.")
-        call_self()
+    error = run_with_retries(attempt, sleep, rate_limiter)
+    if error is None:
+        try:
+            store_popularities(popularities, collection)
+        except AutoReconnect as e:
+            error = e
+    sleep(worker_request_cooldown_seconds)
+    return error
 
 
 def fetch_quote(
     symbols: str,
     collection: pymongo.collection.Collection,
     sleep,
-    worker_request_cooldown_seconds=1.0,
-):
+    worker_request_cooldown_seconds=0.0,
+) -> Exception:
+    """ Fetches and stores quotes for the batch of symbols, retrying on failure.  Returns the error
+    that caused the batch to be given up on, if any. """
+
     if symbols == "__DONE":
         print("Received DONE message for quote fetching; marking as complete in Redis...")
         set_quotes_finished()
-        return
+        return None
 
-    try:
-        url = f"{endpoints.quotes()}?symbols={symbols}"
-        res = requests.get(url, headers=TRADER.headers, timeout=15)
-        res = res.json()
-        quotes = res["results"]
-        store_quotes(quotes, collection)
-
-        sleep(worker_request_cooldown_seconds)
-    except KeyError:  # Likely a ratelimit issue; cooldown.
-        if not res.get("detail"):
-            print("ERROR: Unexpected response received from quote request: {}".format(res))
-            sleep(120)
-            return
-
-        cooldown_seconds = parse_throttle_res(res["detail"])
-        print(
-            "Quote fetch request failed; waiting for {} second cooldown...".format(cooldown_seconds)
-        )
-        sleep(cooldown_seconds)
+    url = f"{endpoints.quotes()}?symbols={symbols}"
+    rate_limiter = RATE_LIMITERS["quotes"]
 
-        fetch_quote(
-            symbols,
-            collection,
-            sleep,
-            worker_request_cooldown_seconds=worker_request_cooldown_seconds,
-        )
-    except InvalidTickerSymbol:
-        print("Error while fetching symbols: {}".format(symbols))
-    except requests.exceptions.ReadTimeout:
-        print("Read timeout while fetching quotes... Sleeping 30 seconds and re-trying.")
-        sleep(30)
-        fetch_quote(
-            symbols,
-            collection,
-            sleep,
-            worker_request_cooldown_seconds=worker_request_cooldown_seconds,
-        )
+    def attempt():
+        rate_limiter.acquire(sleep)
+        try:
+            res = requests.get(url, headers=TRADER.headers, timeout=15).json()
+        except requests.exceptions.RequestException as e:
+            raise RetryableError("Error while fetching quotes: {}".format(e))
+        except JSONDecodeError:
+            raise RetryableError("Robinhood API sending back HTML")
+        except InvalidTickerSymbol:
+            raise PermanentError("Error while fetching symbols: {}".format(symbols))
+
+        raise_for_response(res)
+        rate_limiter.report_success()
+
+        try:
+            store_quotes(res["results"], collection)
+        except AutoReconnect as e:
+            raise RetryableError("Error while storing quotes: {}".format(e))
+
+    error = run_with_retries(attempt, sleep, rate_limiter)
+    sleep(worker_request_cooldown_seconds)
+    return error
 
 
 def fetch_fundamentals(
     instrument_ids: str,
     collection: pymongo.collection.Collection,
     sleep,
-    worker_request_cooldown_seconds=1.0,
-):
+    worker_request_cooldown_seconds=0.0,
+) -> Exception:
+    """ Fetches and stores fundamentals for the batch of instrument IDs, retrying on failure.
+    Returns the error that caused the batch to be given up on, if any. """
+
     if instrument_ids == "__DONE":
         print("Received DONE message for fundamentals fetching.")
-        return
+        return None
 
-    try:
-        instrument_urls = ",".join(list(map(build_instrument_url, instrument_ids.split(","))))
-        url = f"https://api.robinhood.com/fundamentals/?instruments={instrument_urls}"
-        res = requests.get(url, headers=TRADER.headers, timeout=15)
-        res = res.json()
-        fundamentals = res["results"]
-        store_fundamentals(fundamentals, collection)
-
-        sleep(worker_request_cooldown_seconds)
-    except KeyError:  # Likely a ratelimit issue; cooldown.
-        if not res.get("detail"):
-            print("ERROR: Unexpected response received from fundamentals request: {}".format(res))
-            sleep(120)
-            return
-
-        cooldown_seconds = parse_throttle_res(res["detail"])
-        print(
-            "Fundamentals fetch request failed; waiting for {} second cooldown...".format(
-                cooldown_seconds
-            )
-        )
-        sleep(cooldown_seconds)
+    instrument_urls = ",".join(list(map(build_instrument_url, instrument_ids.split(","))))
+    url = f"https://api.robinhood.com/fundamentals/?instruments={instrument_urls}"
+    rate_limiter = RATE_LIMITERS["fundamentals"]
 
-        fetch_fundamentals(
-            instrument_ids,
-            collection,
-            sleep,
-            worker_request_cooldown_seconds=worker_request_cooldown_seconds,
-        )
-    except InvalidTickerSymbol:
-        print("Error while fetching instrument ids: {}".format(instrument_ids))
-    except requests.exceptions.ReadTimeout:
-        print("Read timeout while fetching quotes... Sleeping 30 seconds and re-trying.")
-        sleep(30)
-        fetch_fundamentals(
-            instrument_ids,
-            collection,
-            sleep,
-            worker_request_cooldown_seconds=worker_request_cooldown_seconds,
-        )
+    def attempt():
+        rate_limiter.acquire(sleep)
+        try:
+            res = requests.get(url, headers=TRADER.headers, timeout=15).json()
+        except requests.exceptions.RequestException as e:
+            raise RetryableError("Error while fetching fundamentals: {}".format(e))
+        except JSONDecodeError:
+            raise RetryableError("Robinhood API sending back HTML")
+        except InvalidTickerSymbol:
+            raise PermanentError("Error while fetching instrument ids: {}".format(instrument_ids))
+
+        raise_for_response(res)
+        rate_limiter.report_success()
+        store_fundamentals(res["results"], collection)
+
+    error = run_with_retries(attempt, sleep, rate_limiter)
+    sleep(worker_request_cooldown_seconds)
+    return error
 
 
 WORK_CBS = {
@@ -294,8 +295,53 @@ WORK_CBS = {
 )
 @click.option("--rabbitmq_host", default="localhost")
 @click.option("--rabbitmq_port", type=click.INT, default=5672)
-@click.option("--worker_request_cooldown_seconds", type=click.FLOAT, default=1.0)
-def cli(mode: str, rabbitmq_host: str, rabbitmq_port: str, worker_request_cooldown_seconds: float):
+@click.option(
+    "--worker_request_cooldown_seconds",
+    type=click.FLOAT,
+    default=0.0,
+    help="Extra delay after each request on top of the rate limit shared by all workers",
+)
+@click.option(
+    "--engine",
+    type=click.Choice(["sync", "async"]),
+    default="sync",
+    help="The async engine keeps multiple requests in flight at once (popularity mode only)",
+)
+@click.option(
+    "--prefetch",
+    type=click.INT,
+    default=None,
+    help=(
+        "Max number of unacknowledged messages delivered to this worker at once.  Defaults to 1 "
+        "for the sync engine and twice the concurrency for the async engine."
+    ),
+)
+@click.option(
+    "--concurrency",
+    type=click.INT,
+    default=8,
+    help="Max number of in-flight requests for the async engine",
+)
+@click.option(
+    "--lag_report_interval_seconds",
+    type=click.FLOAT,
+    default=60.0,
+    help="How often to publish the ready/unacked message counts of the work queue; 0 to disable",
+)
+def cli(
+    mode: str,
+    rabbitmq_host: str,
+    rabbitmq_port: str,
+    worker_request_cooldown_seconds: float,
+    engine: str,
+    prefetch: int,
+    concurrency: int,
+    lag_report_interval_seconds: float,
+):
+    if engine == "async" and mode != "popularity":
+        print("Error: The async engine is only supported in popularity mode.")
+        exit(1)
+
     if mode in ["quote", "fundamentals"]:
         robinhood_username = environ.get("ROBINHOOD_USERNAME")
         robinhood_password = environ.get("ROBINHOOD_PASSWORD")
@@ -315,6 +361,33 @@ def cli(mode: str, rabbitmq_host: str, rabbitmq_port: str, worker_request_cooldo
     print("Unlocking cache...")
     unlock_cache()
 
+    # Make sure that the indexes that our writes rely on exist
+    collections = [WORK_CBS[mode][1]]
+    if mode == "popularity" and BUCKETED_POPULARITY_ENABLED:
+        collections.append(POPULARITY_BUCKETS_COLLECTION)
+    if mode == "quote" and BUCKETED_QUOTES_ENABLED:
+        collections.append(QUOTES_BUCKETS_COLLECTION)
+    ensure_indexes(get_db(), collections)
+
+    if prefetch is None:
+        prefetch = concurrency * 2 if engine == "async" else 1
+    management_url = get_management_url(rabbitmq_host)
+
+    if engine == "async":
+        from async_worker import run_popularity_worker
+
+        print("init async popularity worker")
+        run_popularity_worker(
+            rabbitmq_host,
+            rabbitmq_port,
+            TRADER.headers,
+            prefetch=prefetch,
+            concurrency=concurrency,
+            management_url=management_url,
+            lag_report_interval_seconds=lag_report_interval_seconds,
+        )
+        return
+
     print("init rabbitmq connection")
     rabbitmq_connection = pika.BlockingConnection(
         pika.ConnectionParameters(host=rabbitmq_host, port=rabbitmq_port)
@@ -326,14 +399,44 @@ def cli(mode: str, rabbitmq_host: str, rabbitmq_port: str, worker_request_cooldo
     db = get_db()
     collection = db[collection_name]
     rabbitmq_channel.queue_declare(queue=channel_name)
+    dead_letter_queue = get_dead_letter_queue(channel_name)
+    rabbitmq_channel.queue_declare(queue=dead_letter_queue)
+    # Only have `prefetch` un-acked messages delivered to us at once so that work is dispatched
+    # fairly between workers and little is redelivered if we restart.
+    rabbitmq_channel.basic_qos(prefetch_count=prefetch)
 
-    def handle_work(_channel, _method, _properties, body):
-        work_cb(
-            body.decode("utf-8"),
-            collection,
-            rabbitmq_connection.sleep,
-            worker_request_cooldown_seconds=worker_request_cooldown_seconds,
-        )
+    def handle_work(channel, method, _properties, body):
+        try:
+            error = work_cb(
+                body.decode("utf-8"),
+                collection,
+                rabbitmq_connection.sleep,
+                worker_request_cooldown_seconds=worker_request_cooldown_seconds,
+            )
+        except Exception as e:  # pylint: disable=W0703
+            error = e
+
+        if error is not None:
+            print("Giving up on batch; moving it to {}: {}".format(dead_letter_queue, error))
+            channel.basic_publish(
+                exchange="",
+                routing_key=dead_letter_queue,
+                body=body,
+                properties=pika.BasicProperties(
+                    headers={"x-source-queue": channel_name, "x-error": repr(error)}
+                ),
+            )
+
+        # Only ack once the results have been persisted (or the batch was dead-lettered) so that
+        # the batch is redelivered if we die while processing it.
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+
+    def report_lag():
+        record_queue_lag(management_url, channel_name)
+        rabbitmq_connection.call_later(lag_report_interval_seconds, report_lag)
+
+    if lag_report_interval_seconds > 0:
+        rabbitmq_connection.call_later(0, report_lag)
 
     rabbitmq_channel.basic_consume(channel_name, handle_work, auto_ack=False)
     rabbitmq_channel.start_consuming()
@@ -1,10 +1,41 @@
 """
 Sums up popularity for all stocks by category and computes aggregate popularity history for each category
+
+The popularity history is processed one day at a time: each day's popularities are reduced to the
+first popularity of every instrument, and those are summed into dense arrays indexed by day and
+sector/industry.  Memory use only depends on the number of days and categories.  Popularities are
+read from `popularity_buckets` instead of `popularity` if `BUCKETED_POPULARITY` is enabled.
+
+With `--incremental`, the daily sums are instead persisted to the `category_popularity_daily`
+collection and only days after the last checkpoint are aggregated.  The sector and industry
+assignments that the sums were computed with are kept in `category_assignments`; every day with
+popularity data for an instrument whose assignment changed since the last run is re-aggregated.
 """
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import groupby
 import os
+from typing import Dict, Iterator, List, Tuple
+
+import click
+import numpy as np
+import pymongo
 
 from python_common.db import get_db
+from python_common.popularity_buckets import (
+    BUCKETED_POPULARITY_ENABLED,
+    POPULARITY_BUCKETS_COLLECTION,
+    get_first_popularity_day,
+    get_last_popularity_day,
+    iter_popularities,
+)
+from python_common.schema import ensure_indexes
+
+CATEGORY_POPULARITY_COLLECTION = "category_popularity_daily"
+CATEGORY_ASSIGNMENTS_COLLECTION = "category_assignments"
+CHECKPOINTS_COLLECTION = "checkpoints"
+CHECKPOINT_ID = "category_popularity_daily"
+
+ASSIGNMENT_WRITE_BATCH_SIZE = 1000
 
 
 def get_day_id(dt: datetime) -> str:
@@ -19,115 +50,359 @@ def get_all_stock_fundamentals():
     db = get_db()
 
     fundamentals_by_instrument_id = dict()
-    all_fundamentals = list(db["fundamentals"].find())
+    all_fundamentals = db["fundamentals"].find(
+        {}, projection={"_id": False, "instrument_id": True, "sector": True, "industry": True}
+    )
     for f in all_fundamentals:
         fundamentals_by_instrument_id[f["instrument_id"]] = f
 
     return fundamentals_by_instrument_id
 
 
-def main():
-    fundamentals_by_instrument_id = get_all_stock_fundamentals()
+class CategoryIndex:
+    """ Assigns dense indices to instruments and to the sectors and industries they belong to. """
 
-    # sector -> instrument_id -> dayId -> popularity
-    updates_by_sector = dict()
-    # industry -> instrument_id -> dayId -> popularity
-    updates_by_industry = dict()
-    all_day_ids = set()
+    def __init__(self, fundamentals_by_instrument_id: Dict[str, dict]):
+        self.sectors = sorted(
+            {f["sector"] for f in fundamentals_by_instrument_id.values() if f.get("sector")}
+        )
+        self.industries = sorted(
+            {f["industry"] for f in fundamentals_by_instrument_id.values() if f.get("industry")}
+        )
+        sector_indices = {sector: i for (i, sector) in enumerate(self.sectors)}
+        industry_indices = {industry: i for (i, industry) in enumerate(self.industries)}
+
+        self.instrument_indices = {}
+        # Sector and industry index of every instrument, or -1 if it doesn't have one
+        sector_by_instrument = []
+        industry_by_instrument = []
+        for (instrument_id, fundamentals) in fundamentals_by_instrument_id.items():
+            self.instrument_indices[instrument_id] = len(sector_by_instrument)
+            sector_by_instrument.append(sector_indices.get(fundamentals.get("sector"), -1))
+            industry_by_instrument.append(industry_indices.get(fundamentals.get("industry"), -1))
+
+        self.sector_by_instrument = np.array(sector_by_instrument, dtype=np.int64)
+        self.industry_by_instrument = np.array(industry_by_instrument, dtype=np.int64)
+
+    def sum_by_category(
+        self, instrument_indices: np.ndarray, popularities: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, bool]:
+        """ Sums the provided popularities by sector and by industry.  Also returns whether any of
+        the instruments has both a sector and an industry. """
+
+        sectors = self.sector_by_instrument[instrument_indices]
+        industries = self.industry_by_instrument[instrument_indices]
+        has_sector = sectors >= 0
+        has_industry = industries >= 0
+
+        sector_sums = np.bincount(
+            sectors[has_sector], weights=popularities[has_sector], minlength=len(self.sectors)
+        )
+        industry_sums = np.bincount(
+            industries[has_industry],
+            weights=popularities[has_industry],
+            minlength=len(self.industries),
+        )
+        return (sector_sums, industry_sums, bool(np.any(has_sector & has_industry)))
 
-    db = get_db()
-    for update in db["popularity"].find().sort("timestamp"):
-        fundamentals = fundamentals_by_instrument_id.get(update["instrument_id"])
-        if fundamentals is None:
-            continue
 
-        day_id = get_day_id(update["timestamp"])
-        instrument_id = update["instrument_id"]
+def get_popularity_day_range(db) -> Tuple[datetime, datetime]:
+    """ Returns the start of the first day with popularity data and the start of the day after
+    the last one. """
 
-        sector = fundamentals["sector"]
-        if sector is not None:
-            if updates_by_sector.get(sector) is None:
-                updates_by_sector[sector] = dict()
+    start = get_first_popularity_day(db)
+    if start is None:
+        return (None, None)
 
-            if updates_by_sector[sector].get(instrument_id) is None:
-                updates_by_sector[sector][instrument_id] = dict()
+    return (start, get_last_popularity_day(db) + timedelta(days=1))
 
-            if updates_by_sector[sector][instrument_id].get(day_id) is None:
-                updates_by_sector[sector][instrument_id][day_id] = update["popularity"]
 
-        industry = fundamentals["sector"]
-        if industry is not None:
-            if updates_by_industry.get(industry) is None:
-                updates_by_industry[industry] = dict()
+def iter_first_popularities_of_day(db, day: datetime) -> Iterator[dict]:
+    """ Yields the first popularity of every instrument on the provided day.  Raw popularities are
+    grouped by MongoDB; buckets already hold a single instrument's day, so they're reduced as
+    they're unpacked. """
 
-            if updates_by_industry[industry].get(instrument_id) is None:
-                updates_by_industry[industry][instrument_id] = dict()
+    if BUCKETED_POPULARITY_ENABLED:
+        docs = iter_popularities(db, start=day, end=day + timedelta(days=1))
+        for (instrument_id, data) in groupby(docs, key=lambda doc: doc["instrument_id"]):
+            yield {"_id": instrument_id, "popularity": next(data)["popularity"]}
+        return
 
-            if updates_by_industry[industry][instrument_id].get(day_id) is None:
-                updates_by_industry[industry][instrument_id][day_id] = update["popularity"]
+    yield from db["popularity"].aggregate(
+        [
+            {"$match": {"timestamp": {"$gte": day, "$lt": day + timedelta(days=1)}}},
+            {"$sort": {"timestamp": pymongo.ASCENDING}},
+            {"$group": {"_id": "$instrument_id", "popularity": {"$first": "$popularity"}}},
+        ],
+        allowDiskUse=True,
+    )
 
-        if industry is not None and sector is not None:
-            if day_id not in all_day_ids:
-                print(day_id)
 
-            all_day_ids.add(day_id)
+def get_day_arrays(
+    category_index: CategoryIndex, docs: Iterator[dict]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """ Converts a day's first popularities into arrays of instrument indices and popularities,
+    skipping instruments without fundamentals. """
 
-    print("Finished scrolling all updates; starting to aggregate by popularity")
+    instrument_indices = []
+    popularities = []
+    for doc in docs:
+        instrument_index = category_index.instrument_indices.get(doc["_id"])
+        if instrument_index is None or doc.get("popularity") is None:
+            continue
 
-    # sector -> day_id -> popularity
-    pop_by_sector = dict()
-    # industry -> day_id -> popularity
-    pop_by_industry = dict()
+        instrument_indices.append(instrument_index)
+        popularities.append(doc["popularity"])
 
-    # Sum it all up
-    for day_id in sorted(all_day_ids):
-        for (sector, updates_by_instrument_id) in updates_by_sector.items():
-            if pop_by_sector.get(sector) is None:
-                pop_by_sector[sector] = dict()
+    return (np.array(instrument_indices, dtype=np.int64), np.array(popularities, dtype=np.float64))
 
-            pop_by_sector[sector][day_id] = 0
 
-            for (instrument_id, pop_by_day_id) in updates_by_instrument_id.items():
-                pop = pop_by_day_id.get(day_id)
-                if pop is None:
-                    continue
+def normalize_category_name(category: str) -> str:
+    # Adapted from https://stackoverflow.com/a/295152/3833068
+    return "".join(
+        x for x in category.replace(" ", "-").replace("&", "and") if x.isalnum() or x == "-"
+    )
+
+
+def write_category_csvs(
+    output_dir: str, prefix: str, categories: List[str], day_ids: List[str], sums: np.ndarray
+):
+    """ Writes one CSV for each category with its summed popularity for every day. """
+
+    for (category_index, category) in enumerate(categories):
+        filename = f"{prefix}_{normalize_category_name(category)}.csv"
+        with open(os.path.join(output_dir, filename), "w") as f:
+            for (day_index, day_id) in enumerate(day_ids):
+                f.write(f"{day_id},{int(sums[day_index, category_index])}\n")
+
+
+def get_start_of_day(dt: datetime) -> datetime:
+    return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def build_category_docs(
+    category_index: CategoryIndex, day: datetime, sector_sums: np.ndarray, industry_sums: np.ndarray
+) -> List[dict]:
+    """ Builds the `category_popularity_daily` documents of a day.  Categories without any
+    popularity on that day are left out. """
+
+    day_id = get_day_id(day)
+    docs = []
+    for (category_type, categories, sums) in [
+        ("sector", category_index.sectors, sector_sums),
+        ("industry", category_index.industries, industry_sums),
+    ]:
+        for i in np.flatnonzero(sums):
+            docs.append(
+                {
+                    "day_id": day_id,
+                    "day": day,
+                    "category_type": category_type,
+                    "category": categories[i],
+                    "popularity": int(sums[i]),
+                }
+            )
+
+    return docs
+
+
+def materialize_day(db, category_index: CategoryIndex, day: datetime) -> int:
+    """ Aggregates a day and replaces all of its `category_popularity_daily` documents, returning
+    the number of categories with popularity on that day. """
+
+    (instrument_indices, popularities) = get_day_arrays(
+        category_index, iter_first_popularities_of_day(db, day)
+    )
+    (sector_sums, industry_sums, _) = category_index.sum_by_category(
+        instrument_indices, popularities
+    )
+    docs = build_category_docs(category_index, day, sector_sums, industry_sums)
+
+    db[CATEGORY_POPULARITY_COLLECTION].delete_many({"day_id": get_day_id(day)})
+    if docs:
+        db[CATEGORY_POPULARITY_COLLECTION].insert_many(docs, ordered=False)
+    return len(docs)
+
+
+def get_assignment(fundamentals: dict) -> Tuple[str, str]:
+    return (fundamentals.get("sector") or None, fundamentals.get("industry") or None)
+
+
+def get_changed_instrument_ids(db, fundamentals_by_instrument_id: Dict[str, dict]) -> List[str]:
+    """ Returns the IDs of all instruments whose sector or industry differs from the assignment
+    that was saved by the last run, including instruments that were added or removed. """
+
+    saved_assignments = {
+        doc["instrument_id"]: (doc.get("sector"), doc.get("industry"))
+        for doc in db[CATEGORY_ASSIGNMENTS_COLLECTION].find({}, projection={"_id": False})
+    }
+    current_assignments = {
+        instrument_id: get_assignment(fundamentals)
+        for (instrument_id, fundamentals) in fundamentals_by_instrument_id.items()
+    }
+
+    return [
+        instrument_id
+        for instrument_id in set(saved_assignments) | set(current_assignments)
+        if saved_assignments.get(instrument_id, (None, None))
+        != current_assignments.get(instrument_id, (None, None))
+    ]
+
+
+def get_days_with_popularity(db, instrument_ids: List[str], end: datetime) -> List[datetime]:
+    """ Returns the start of every day before `end` with popularity data for any of the provided
+    instruments. """
+
+    if BUCKETED_POPULARITY_ENABLED:
+        # Every bucket holds a single day, so the days with data are those with a bucket
+        return sorted(
+            db[POPULARITY_BUCKETS_COLLECTION].distinct(
+                "day", {"instrument_id": {"$in": instrument_ids}, "day": {"$lt": end}}
+            )
+        )
 
-                pop_by_sector[sector][day_id] += pop
+    day_ids = db["popularity"].aggregate(
+        [
+            {"$match": {"instrument_id": {"$in": instrument_ids}, "timestamp": {"$lt": end}}},
+            {"$group": {"_id": {"$dateToString": {"format": "%Y-%m-%d", "date": "$timestamp"}}}},
+        ],
+        allowDiskUse=True,
+    )
+    return sorted(datetime.strptime(doc["_id"], "%Y-%m-%d") for doc in day_ids)
 
-        for (industry, updates_by_instrument_id) in updates_by_industry.items():
-            if pop_by_industry.get(industry) is None:
-                pop_by_industry[industry] = dict()
 
-            pop_by_industry[industry][day_id] = 0
+def save_assignments(db, fundamentals_by_instrument_id: Dict[str, dict], instrument_ids: List[str]):
+    """ Saves the current sector and industry assignment of the provided instruments. """
 
-            for (instrument_id, pop_by_day_id) in updates_by_instrument_id.items():
-                pop = pop_by_day_id.get(day_id)
-                if pop is None:
-                    continue
+    ops = []
+    for instrument_id in instrument_ids:
+        fundamentals = fundamentals_by_instrument_id.get(instrument_id)
+        if fundamentals is None:
+            ops.append(pymongo.DeleteOne({"instrument_id": instrument_id}))
+            continue
 
-                pop_by_industry[industry][day_id] += pop
+        (sector, industry) = get_assignment(fundamentals)
+        ops.append(
+            pymongo.ReplaceOne(
+                {"instrument_id": instrument_id},
+                {"instrument_id": instrument_id, "sector": sector, "industry": industry},
+                upsert=True,
+            )
+        )
+
+    for i in range(0, len(ops), ASSIGNMENT_WRITE_BATCH_SIZE):
+        db[CATEGORY_ASSIGNMENTS_COLLECTION].bulk_write(
+            ops[i : i + ASSIGNMENT_WRITE_BATCH_SIZE], ordered=False
+        )
 
-    # Dump it all to CSV, one for each sector
-    if not os.path.isdir("/tmp/out"):
-        os.mkdir("/tmp/out")
 
-    for (sector, vals) in pop_by_sector.items():
-        # Adapted from https://stackoverflow.com/a/295152/3833068
-        normalized_sector = "".join(
-            x for x in sector.replace(" ", "-").replace("&", "and") if x.isalnum() or x == "-"
+def save_checkpoint(db, next_day: datetime):
+    db[CHECKPOINTS_COLLECTION].replace_one(
+        {"_id": CHECKPOINT_ID}, {"_id": CHECKPOINT_ID, "next_day": next_day}, upsert=True
+    )
+
+
+def materialize_incremental(db, fundamentals_by_instrument_id: Dict[str, dict]):
+    """ Brings `category_popularity_daily` up to date with all complete days of popularity data.
+    Every step only replaces whole days, so an interrupted run is finished by the next one. """
+
+    ensure_indexes(db, [CATEGORY_POPULARITY_COLLECTION, CATEGORY_ASSIGNMENTS_COLLECTION])
+    category_index = CategoryIndex(fundamentals_by_instrument_id)
+    changed_instrument_ids = get_changed_instrument_ids(db, fundamentals_by_instrument_id)
+
+    checkpoint = db[CHECKPOINTS_COLLECTION].find_one({"_id": CHECKPOINT_ID})
+    if checkpoint is None:
+        (start, _) = get_popularity_day_range(db)
+        if start is None:
+            print("No popularity data to aggregate")
+            return
+    else:
+        start = checkpoint["next_day"]
+        # Days that were already materialized need to be redone if they contain any instrument
+        # that moved to a different sector or industry
+        if changed_instrument_ids:
+            stale_days = get_days_with_popularity(db, changed_instrument_ids, start)
+            print(
+                f"{len(changed_instrument_ids)} instruments changed sector or industry; "
+                f"re-aggregating {len(stale_days)} days"
+            )
+            for day in stale_days:
+                materialize_day(db, category_index, day)
+
+    # Today is still being scraped, so only complete days are materialized
+    end = get_start_of_day(datetime.utcnow())
+    day = start
+    while day < end:
+        category_count = materialize_day(db, category_index, day)
+        print(f"{get_day_id(day)}: {category_count} categories")
+        day += timedelta(days=1)
+        save_checkpoint(db, day)
+
+    save_assignments(db, fundamentals_by_instrument_id, changed_instrument_ids)
+    print(f"Materialized category popularity up to {get_day_id(end)}")
+
+
+@click.command()
+@click.option("--output-dir", type=click.Path(), default="/tmp/out")
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help=f"Only aggregate days since the last run into `{CATEGORY_POPULARITY_COLLECTION}`",
+)
+def main(output_dir: str, incremental: bool):
+    db = get_db()
+    fundamentals_by_instrument_id = get_all_stock_fundamentals()
+    if incremental:
+        materialize_incremental(db, fundamentals_by_instrument_id)
+        return
+
+    category_index = CategoryIndex(fundamentals_by_instrument_id)
+    print(
+        f"Aggregating {len(category_index.sectors)} sectors and "
+        f"{len(category_index.industries)} industries"
+    )
+
+    (start, end) = get_popularity_day_range(db)
+    if start is None:
+        print("No popularity data to aggregate")
+        return
+    day_count = (end - start).days
+
+    # day -> sector/industry -> popularity
+    pop_by_sector = np.zeros((day_count, len(category_index.sectors)))
+    pop_by_industry = np.zeros((day_count, len(category_index.industries)))
+    # Days where at least one instrument had both a sector and an industry
+    has_data = np.zeros(day_count, dtype=bool)
+
+    for day_index in range(day_count):
+        day = start + timedelta(days=day_index)
+        (instrument_indices, popularities) = get_day_arrays(
+            category_index, iter_first_popularities_of_day(db, day)
         )
-        with open(f"/tmp/out/sector_{normalized_sector}.csv", "w") as f:
-            for (day_id, pop) in sorted(vals.items(), key=lambda x: x[0]):
-                f.write(f"{day_id},{pop}\n")
-
-    for (sector, vals) in pop_by_industry.items():
-        # Adapted from https://stackoverflow.com/a/295152/3833068
-        normalized_industry = "".join(
-            x for x in sector.replace(" ", "-").replace("&", "and") if x.isalnum() or x == "-"
+        (sector_sums, industry_sums, day_has_data) = category_index.sum_by_category(
+            instrument_indices, popularities
         )
-        with open(f"/tmp/out/industry_{normalized_industry}.csv", "w") as f:
-            for (day_id, pop) in sorted(vals.items(), key=lambda x: x[0]):
-                f.write(f"{day_id},{pop}\n")
+        pop_by_sector[day_index] = sector_sums
+        pop_by_industry[day_index] = industry_sums
+        has_data[day_index] = day_has_data
+
+        if day_has_data:
+            print(get_day_id(day))
+
+    print("Finished aggregating all days; writing CSVs")
+
+    all_day_ids = [get_day_id(start + timedelta(days=int(i))) for i in np.flatnonzero(has_data)]
+
+    # Dump it all to CSV, one for each category
+    os.makedirs(output_dir, exist_ok=True)
+    write_category_csvs(
+        output_dir, "sector", category_index.sectors, all_day_ids, pop_by_sector[has_data]
+    )
+    write_category_csvs(
+        output_dir, "industry", category_index.industries, all_day_ids, pop_by_industry[has_data]
+    )
 
 
-main()
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
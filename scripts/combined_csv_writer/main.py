@@ -4,15 +4,92 @@ Generates a CSV file consisting of popularity data for the past 24 hours for all
 
 from datetime import datetime, timedelta
 import os
-from typing import List
+from typing import Iterator
 
 import click
+import pymongo
 
 from python_common.db import get_db
+from python_common.popularity_buckets import (
+    BUCKETED_POPULARITY_ENABLED,
+    POPULARITY_BUCKETS_COLLECTION,
+    get_bucket_day,
+)
+
+SNAPSHOT_HOURS = 25
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def get_unpack_bucket_stages(since: datetime) -> list:
+    """ Returns the pipeline stages that turn the popularity buckets covering the provided time
+    into one document per popularity, shaped like the ones in the `popularity` collection. """
+
+    return [
+        {"$match": {"day": {"$gte": get_bucket_day(since)}}},
+        {
+            "$project": {
+                "instrument_id": True,
+                "sample": {"$zip": {"inputs": ["$timestamps", "$popularities"]}},
+            }
+        },
+        {"$unwind": "$sample"},
+        {
+            "$project": {
+                "instrument_id": True,
+                "timestamp": {"$arrayElemAt": ["$sample", 0]},
+                "popularity": {"$arrayElemAt": ["$sample", 1]},
+            }
+        },
+    ]
+
+
+def iter_snapshot_popularities(db, since: datetime) -> Iterator[dict]:
+    """ Yields the popularities since the provided time along with their instrument's symbol,
+    ordered by symbol and then timestamp.  Symbols are joined and the results are sorted by
+    MongoDB, so only one batch of documents is held in memory at a time.  Popularities are read
+    from `popularity_buckets` instead of `popularity` if `BUCKETED_POPULARITY` is enabled. """
+
+    collection = "popularity"
+    unpack_stages = []
+    if BUCKETED_POPULARITY_ENABLED:
+        collection = POPULARITY_BUCKETS_COLLECTION
+        unpack_stages = get_unpack_bucket_stages(since)
+
+    return db[collection].aggregate(
+        unpack_stages
+        + [
+            {"$match": {"timestamp": {"$gt": since}}},
+            {
+                "$lookup": {
+                    "from": "index",
+                    "localField": "instrument_id",
+                    "foreignField": "instrument_id",
+                    "as": "instrument",
+                }
+            },
+            {"$unwind": "$instrument"},
+            {
+                "$project": {
+                    "_id": False,
+                    "symbol": "$instrument.symbol",
+                    "timestamp": True,
+                    "popularity": True,
+                }
+            },
+            {"$match": {"symbol": {"$ne": None}}},
+            {"$sort": {"symbol": pymongo.ASCENDING, "timestamp": pymongo.ASCENDING}},
+        ],
+        allowDiskUse=True,
+    )
+
 
+def write_csv_file(output_dir: str, popularity_history: Iterator[dict]) -> int:
+    """ Writes the provided popularities as they arrive, returning how many were written. """
 
-def write_csv_file(output_dir: str, popularity_history: List[dict]):
-    with open(os.path.join(output_dir, "robinhood-popularity.csv"), "w+") as f:
+    written_count = 0
+    with open(
+        os.path.join(output_dir, "robinhood-popularity.csv"), "w+", buffering=WRITE_BUFFER_SIZE
+    ) as f:
         f.write('"symbol","timestamp","users_holding"\n')
 
         for datum in popularity_history:
@@ -21,6 +98,9 @@ def write_csv_file(output_dir: str, popularity_history: List[dict]):
             users_holding = datum["popularity"]
 
             f.write(f'"{symbol}","{timestamp.isoformat()}Z",{users_holding}\n')
+            written_count += 1
+
+    return written_count
 
 
 @click.command()
@@ -29,26 +109,9 @@ def main(output_directory: str):
     if not os.path.exists(output_directory):
         os.makedirs(output_directory, exist_ok=True)
 
-    db = get_db()
-
-    all_index_docs = list(db["index"].find())
-    symbol_by_instrument_id = dict()
-    for doc in all_index_docs:
-        symbol_by_instrument_id[doc["instrument_id"]] = doc["symbol"]
-
-    updates = list(
-        filter(
-            lambda doc: doc["symbol"] is not None,
-            map(
-                lambda doc: {**doc, "symbol": symbol_by_instrument_id.get(doc["instrument_id"])},
-                db["popularity"].find({"timestamp": {"$gt": datetime.now() - timedelta(hours=25)}}),
-            ),
-        )
-    )
-
-    sorted_updates = sorted(updates, key=lambda doc: f"{doc['symbol']}{doc['timestamp']}")
-
-    write_csv_file(output_directory, sorted_updates)
+    since = datetime.utcnow() - timedelta(hours=SNAPSHOT_HOURS)
+    written_count = write_csv_file(output_directory, iter_snapshot_popularities(get_db(), since))
+    print(f"Finished writing {written_count} popularities to {output_directory}!")
 
 
 if __name__ == "__main__":
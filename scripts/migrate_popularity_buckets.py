@@ -0,0 +1,107 @@
+"""
+Migrates popularity history from the `popularity` collection into the bucketed `popularity_buckets`
+collection, one day at a time.  Every bucket is replaced as a whole, so re-running the migration
+over days that were already migrated is safe.
+
+Once a run has migrated everything from the oldest popularity up to its end day, that day is
+recorded in the `migrations` collection.  Raw popularity documents are only expired after this
+marker exists, so the workers must have `BUCKETED_POPULARITY` enabled before the migration is run
+for the buckets to hold the days after it as well.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import click
+import pymongo
+
+from python_common.db import get_db
+from python_common.schema import ensure_indexes
+from python_common.popularity_buckets import (
+    POPULARITY_BUCKETS_COLLECTION,
+    build_bucket_doc,
+    get_bucket_day,
+    get_day_range,
+    get_migrated_through,
+    record_migrated_through,
+)
+
+WRITE_BATCH_SIZE = 1000
+
+
+def migrate_day(db, day: datetime) -> int:
+    """ Builds the buckets for all instruments for the provided day, returning how many popularity
+    documents were migrated. """
+
+    docs_by_instrument_id = defaultdict(list)
+    migrated_count = 0
+    for doc in db["popularity"].find(
+        {"timestamp": {"$gte": day, "$lt": day + timedelta(days=1)}},
+        projection={"_id": False, "timestamp": True, "instrument_id": True, "popularity": True},
+    ):
+        docs_by_instrument_id[doc["instrument_id"]].append(doc)
+        migrated_count += 1
+
+    ops = [
+        pymongo.ReplaceOne(
+            {"instrument_id": instrument_id, "day": day},
+            build_bucket_doc(instrument_id, day, docs),
+            upsert=True,
+        )
+        for (instrument_id, docs) in docs_by_instrument_id.items()
+    ]
+    for i in range(0, len(ops), WRITE_BATCH_SIZE):
+        db[POPULARITY_BUCKETS_COLLECTION].bulk_write(ops[i : i + WRITE_BATCH_SIZE], ordered=False)
+
+    return migrated_count
+
+
+@click.command()
+@click.option(
+    "--start-day",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="First day to migrate; defaults to the day of the oldest popularity",
+)
+@click.option(
+    "--end-day",
+    type=click.DateTime(formats=["%Y-%m-%d"]),
+    default=None,
+    help="Day to stop migrating at (exclusive); defaults to today, which the workers are filling",
+)
+def main(start_day: datetime, end_day: datetime):
+    db = get_db()
+    ensure_indexes(db, [POPULARITY_BUCKETS_COLLECTION])
+
+    oldest = db["popularity"].find_one(sort=[("timestamp", pymongo.ASCENDING)])
+    if oldest is None:
+        print("No popularities to migrate")
+        return
+    oldest_day = get_bucket_day(oldest["timestamp"])
+    migrated_through = get_migrated_through(db)
+
+    if start_day is None:
+        start_day = oldest_day
+    if end_day is None:
+        end_day = get_bucket_day(datetime.utcnow())
+
+    total_count = 0
+    for day in get_day_range(start_day, end_day):
+        migrated_count = migrate_day(db, day)
+        total_count += migrated_count
+        print(f"Migrated {migrated_count} popularities for {day.date()}")
+
+    print(f"Finished migrating {total_count} popularities into {POPULARITY_BUCKETS_COLLECTION}")
+
+    # Only a run that leaves no gap before it extends the migrated history
+    if start_day <= oldest_day or (migrated_through is not None and start_day <= migrated_through):
+        record_migrated_through(db, end_day)
+        print(f"Popularity history is migrated up to {end_day.date()}")
+    else:
+        print(
+            f"WARNING: Days before {start_day.date()} haven't been migrated, so the popularity "
+            "history isn't marked as migrated"
+        )
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
@@ -1,39 +1,218 @@
+"""
+Builds `combined.csv`, a long-format `date,asset,popularity` dataset with the last popularity of
+every symbol on every day, ordered by symbol and then date.
+
+Popularities are read either from the per-symbol CSV files that `main.py` wrote to the output
+directory or straight from MongoDB.  The sorted symbols are split into ranges which are written
+to separate parts by a pool of worker processes and then concatenated, so the output doesn't
+depend on the number of workers.  Gzip and zstd members can be concatenated as well, so
+compressed parts are compressed in parallel too.
+"""
+import csv
+import gzip
+from itertools import groupby
+import math
+from multiprocessing import Pool
 import os
-from collections import OrderedDict
+import shutil
+from typing import Iterator, List, Tuple
 
 import click
 
+from python_common.db import create_db, get_db
+from python_common.popularity_buckets import iter_popularities
+
+from main import RANGES_PER_WORKER, get_symbols_by_instrument_id
+
+OUTPUT_FILENAME = "combined.csv"
+PARTS_DIRNAME = ".combined_parts"
+WRITE_BUFFER_SIZE = 1 << 20
+
+COMPRESSION_EXTENSIONS = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+worker_db = None
+
+
+def open_output(path: str, compression: str):
+    """ Opens a binary file for writing with the provided compression. """
+
+    if compression == "gzip":
+        return gzip.open(path, "wb", compresslevel=6)
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            print("ERROR: zstandard must be installed to write zstd compressed files")
+            exit(1)
+
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+
+    return open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+
+
+def get_file_symbol(filename: str) -> str:
+    symbol = filename[: -len(".csv")]
+    # Symbols that are reserved filenames on Windows are prefixed with an underscore
+    if symbol.startswith("_"):
+        symbol = symbol[1:]
+    return symbol
+
+
+def iter_last_of_day(popularities: Iterator[Tuple[str, str]]) -> Iterator[Tuple[str, str]]:
+    """ Reduces chronologically ordered `(date, popularity)` pairs to the last popularity of every
+    date. """
+
+    cur_date = None
+    last_popularity = None
+    for (date, popularity) in popularities:
+        if date != cur_date and cur_date is not None:
+            yield (cur_date, last_popularity)
+        cur_date = date
+        last_popularity = popularity
+
+    if cur_date is not None:
+        yield (cur_date, last_popularity)
+
+
+def iter_file_popularities(path: str) -> Iterator[Tuple[str, str]]:
+    """ Yields the `(date, popularity)` pairs of a CSV file written by `main.py`. """
+
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        next(reader, None)  # skip header row
+        for row in reader:
+            if len(row) == 2:
+                yield (row[0][:10], row[1])
+
+
+def format_rows(symbol: str, popularities: Iterator[Tuple[str, str]]) -> str:
+    return "".join(
+        f"{date},{symbol},{popularity}\n" for (date, popularity) in iter_last_of_day(popularities)
+    )
+
+
+def write_file_part(args: Tuple[str, List[Tuple[str, str]], str]) -> int:
+    """ Writes the rows of the provided `(symbol, filename)` pairs to a part, returning the number
+    of symbols that were written. """
+
+    (part_path, files, compression) = args
+    with open_output(part_path, compression) as out:
+        for (symbol, path) in files:
+            out.write(format_rows(symbol, iter_file_popularities(path)).encode())
+
+    return len(files)
+
+
+def write_db_part(args: Tuple[str, List[Tuple[str, str]], str]) -> int:
+    """ Writes the rows of the provided `(symbol, instrument_id)` pairs to a part, returning the
+    number of symbols that were written. """
+
+    (part_path, instruments, compression) = args
+    db = worker_db or get_db()
+
+    # Popularities arrive ordered by instrument ID, so each instrument's rows are formatted
+    # before they're written in symbol order
+    cursor = iter_popularities(db, [instrument_id for (_, instrument_id) in instruments])
+    symbols_by_instrument_id = {instrument_id: symbol for (symbol, instrument_id) in instruments}
+    rows_by_instrument_id = {}
+    for (instrument_id, data) in groupby(cursor, key=lambda datum: datum["instrument_id"]):
+        rows_by_instrument_id[instrument_id] = format_rows(
+            symbols_by_instrument_id[instrument_id],
+            ((datum["timestamp"].strftime("%Y-%m-%d"), datum["popularity"]) for datum in data),
+        )
+
+    with open_output(part_path, compression) as out:
+        for (_, instrument_id) in instruments:
+            out.write(rows_by_instrument_id.get(instrument_id, "").encode())
+
+    return len(instruments)
+
+
+def get_symbol_files(directory: str) -> List[Tuple[str, str]]:
+    """ Returns the `(symbol, path)` pairs of all per-symbol CSV files in the directory. """
+
+    files = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(".csv") or filename.startswith("combined"):
+            continue
+        files.append((get_file_symbol(filename), os.path.join(directory, filename)))
+
+    return files
+
+
+def init_worker():
+    global worker_db
+    worker_db = create_db()
+
+
 @click.command()
 @click.argument("output-directory", type=click.Path())
-def main(output_directory: str):
-  out = open(os.path.join(output_directory, "combined.csv"), "w")
-  out.write("date,asset,popularity\n")
+@click.option(
+    "--source",
+    type=click.Choice(["files", "mongo"]),
+    default="files",
+    help="Read the per-symbol CSV files in the output directory or query MongoDB directly",
+)
+@click.option(
+    "--compression", type=click.Choice(list(COMPRESSION_EXTENSIONS.keys())), default="none"
+)
+@click.option(
+    "--workers",
+    type=click.INT,
+    default=os.cpu_count(),
+    help="Number of worker processes; defaults to the number of CPUs",
+)
+def main(output_directory: str, source: str, compression: str, workers: int):
+    os.makedirs(output_directory, exist_ok=True)
 
-  for fname in os.listdir(output_directory):
-    if not ".csv" in fname:
-      continue
-    elif fname.startswith("combined"):
-      continue
+    if source == "files":
+        items = get_symbol_files(output_directory)
+        write_part = write_file_part
+    else:
+        items = [
+            (symbol, instrument_id)
+            for (instrument_id, symbol) in get_symbols_by_instrument_id(get_db()).items()
+        ]
+        write_part = write_db_part
+    items.sort()
 
-    symbol = fname.split(".csv")[0]
-    if symbol.startswith("_"):
-      symbol = symbol[1:]
-    with open(os.path.join(output_directory, fname)) as f:
-      next(f) # skip header row
+    parts_dir = os.path.join(output_directory, PARTS_DIRNAME)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    os.makedirs(parts_dir)
+
+    range_size = max(1, math.ceil(len(items) / (max(workers, 1) * RANGES_PER_WORKER)))
+    tasks = [
+        (os.path.join(parts_dir, f"part-{i:05}"), items[i : i + range_size], compression)
+        for i in range(0, len(items), range_size)
+    ]
+
+    written_count = 0
+    if workers <= 1:
+        for task in tasks:
+            written_count += write_part(task)
+    else:
+        initializer = init_worker if source == "mongo" else None
+        with Pool(workers, initializer=initializer) as pool:
+            for (i, part_written_count) in enumerate(pool.imap_unordered(write_part, tasks)):
+                written_count += part_written_count
+                print(f"Wrote {i + 1}/{len(tasks)} parts; {written_count} symbols so far")
+
+    header_path = os.path.join(parts_dir, "header")
+    with open_output(header_path, compression) as header:
+        header.write(b"date,asset,popularity\n")
 
-      d = OrderedDict()
+    output_path = os.path.join(
+        output_directory, f"{OUTPUT_FILENAME}{COMPRESSION_EXTENSIONS[compression]}"
+    )
+    with open(f"{output_path}.tmp", "wb") as out:
+        for part_path in [header_path] + [task[0] for task in tasks]:
+            with open(part_path, "rb") as part:
+                shutil.copyfileobj(part, out, WRITE_BUFFER_SIZE)
+    os.replace(f"{output_path}.tmp", output_path)
+    shutil.rmtree(parts_dir)
 
-      for line in f:
-        date_str = line[1:11]
-        popularity = line.split('",')[1]
-        d[date_str] = popularity
+    print(f"Finished writing {written_count} symbols to {output_path}!")
 
-      for date, popularity in d.items():
-        out.write(date)
-        out.write(",")
-        out.write(symbol)
-        out.write(",")
-        out.write(popularity)
 
 if __name__ == "__main__":
-  main() # pylint: disable=no-value-for-parameter
+    main()  # pylint: disable=no-value-for-parameter
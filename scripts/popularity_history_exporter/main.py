@@ -1,35 +1,170 @@
+"""
+Exports the popularity history of every instrument to a CSV file named after its symbol.
+
+The sorted instrument IDs are split into contiguous ranges which are exported by a pool of worker
+processes, each with its own MongoDB client, cursor, and files.
+
+With `--incremental`, a watermark file in the output directory records the timestamp of the last
+exported popularity and the size of the CSV file of every instrument.  Only newer popularities are
+queried and appended, and files of instruments whose symbol changed are renamed first.  Files are
+truncated back to their recorded size before appending, so rows written by an interrupted run are
+never duplicated.
+
+With `--format parquet`, the history is instead written as a Parquet dataset partitioned by date,
+with one file per day exported by the worker pool.
+"""
+import math
+from datetime import datetime, timedelta
+import json
+from multiprocessing import Pool
 import os
-from typing import List
+from typing import Dict, List, Optional, Tuple
 
 import click
-import pymongo
 
-from python_common.db import get_db
+from python_common.db import create_db, get_db
+from python_common.parquet_export import import_pyarrow, write_day_partition
+from python_common.popularity_buckets import (
+    get_bucket_day,
+    get_day_range,
+    get_first_popularity_day,
+    iter_popularities,
+)
 
 WINDOWS_RESERVED_FILENAMES = ("CON", "AUX", "LST", "PRN", "NUL", "EOF", "INP", "OUT")
 
+# Every worker gets this many ranges on average, so that workers which finish early pick up the
+# remaining work instead of idling
+RANGES_PER_WORKER = 8
 
-def write_csv_file(output_dir: str, symbol: str, popularity_history: List[dict]):
+WATERMARKS_FILENAME = ".watermarks.json"
+
+# MongoDB stores timestamps with millisecond precision
+TIMESTAMP_RESOLUTION = timedelta(milliseconds=1)
+
+PARQUET_TYPES = {
+    "timestamp": "timestamp[ms]",
+    "symbol": "string",
+    "instrument_id": "string",
+    "popularity": "int64",
+}
+PARQUET_DICTIONARY_COLUMNS = ["symbol", "instrument_id"]
+
+worker_db = None
+
+
+def get_csv_path(output_dir: str, symbol: str) -> str:
     prefix = ""
     if symbol.upper() in WINDOWS_RESERVED_FILENAMES:
         prefix = "_"
-    with open(os.path.join(output_dir, f"{prefix}{symbol}.csv"), "w+") as f:
+    return os.path.join(output_dir, f"{prefix}{symbol}.csv")
+
+
+def format_csv_row(datum: dict) -> str:
+    timestamp = datum["timestamp"].replace(microsecond=0)
+    users_holding = datum["popularity"]
+
+    return f'"{timestamp}",{users_holding}\n'
+
+
+def write_csv_file(output_dir: str, symbol: str, popularity_history: List[dict]):
+    with open(get_csv_path(output_dir, symbol), "w+") as f:
         f.write("timestamp,users_holding\n")
         for datum in popularity_history:
-            timestamp = datum["timestamp"].replace(microsecond=0)
-            users_holding = datum["popularity"]
+            f.write(format_csv_row(datum))
 
-            f.write(f'"{timestamp}",{users_holding}\n')
 
+def load_watermarks(output_dir: str) -> Dict[str, dict]:
+    """ Returns the watermarks of the last incremental export, keyed by instrument ID. """
 
-@click.command()
-@click.argument("output-directory", type=click.Path())
-def main(output_directory: str):
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory, exist_ok=True)
+    try:
+        with open(os.path.join(output_dir, WATERMARKS_FILENAME)) as f:
+            watermarks = json.load(f)
+    except FileNotFoundError:
+        return {}
+
+    for watermark in watermarks.values():
+        watermark["timestamp"] = datetime.fromisoformat(watermark["timestamp"])
+    return watermarks
+
+
+def save_watermarks(output_dir: str, watermarks: Dict[str, dict]):
+    serialized = {
+        instrument_id: {**watermark, "timestamp": watermark["timestamp"].isoformat()}
+        for (instrument_id, watermark) in watermarks.items()
+    }
+
+    path = os.path.join(output_dir, WATERMARKS_FILENAME)
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(serialized, f)
+    os.replace(f"{path}.tmp", path)
 
-    db = get_db()
 
+def rename_csv_files(
+    output_dir: str, symbols_by_instrument_id: Dict[str, str], watermarks: Dict[str, dict]
+):
+    """ Moves the files of instruments whose symbol changed since the last export to their new
+    names.  Instruments whose file is missing lose their watermark and are exported in full. """
+
+    renamed = [
+        (instrument_id, watermark["symbol"], symbols_by_instrument_id[instrument_id])
+        for (instrument_id, watermark) in watermarks.items()
+        if symbols_by_instrument_id.get(instrument_id, watermark["symbol"]) != watermark["symbol"]
+    ]
+
+    # Files are moved out of the way first since symbols can be swapped between instruments.  The
+    # temporary names don't end in `.csv` so that they're never picked up as a symbol's file.
+    for (instrument_id, old_symbol, _) in renamed:
+        old_path = get_csv_path(output_dir, old_symbol)
+        if os.path.exists(old_path):
+            os.replace(old_path, f"{old_path}.{instrument_id}.renaming")
+
+    for (instrument_id, old_symbol, new_symbol) in renamed:
+        temp_path = f"{get_csv_path(output_dir, old_symbol)}.{instrument_id}.renaming"
+        if not os.path.exists(temp_path):
+            del watermarks[instrument_id]
+            continue
+
+        os.replace(temp_path, get_csv_path(output_dir, new_symbol))
+        watermarks[instrument_id]["symbol"] = new_symbol
+        print(f"Renamed {old_symbol} to {new_symbol}")
+
+
+def append_csv_file(
+    db, output_dir: str, instrument_id: str, symbol: str, watermark: Optional[dict]
+) -> Optional[dict]:
+    """ Appends the popularities newer than the watermark to the instrument's file, or writes the
+    whole file if there's no watermark.  Returns the new watermark, or `None` if the instrument
+    doesn't have any popularities. """
+
+    path = get_csv_path(output_dir, symbol)
+    if watermark is not None and os.path.exists(path):
+        f = open(path, "r+")
+        f.truncate(watermark["size"])
+        f.seek(0, os.SEEK_END)
+        start = watermark["timestamp"] + TIMESTAMP_RESOLUTION
+        last_timestamp = watermark["timestamp"]
+    else:
+        f = open(path, "w")
+        f.write("timestamp,users_holding\n")
+        start = None
+        last_timestamp = None
+
+    with f:
+        for datum in iter_popularities(db, [instrument_id], start=start):
+            f.write(format_csv_row(datum))
+            last_timestamp = datum["timestamp"]
+
+        size = f.tell()
+
+    if last_timestamp is None:
+        os.remove(path)
+        return None
+
+    return {"symbol": symbol, "timestamp": last_timestamp, "size": size}
+
+
+def get_symbols_by_instrument_id(db) -> Dict[str, str]:
     index_items = db["index"].find(
         {}, projection={"instrument_id": True, "symbol": True, "_id": False}
     )
@@ -40,18 +175,28 @@ def main(output_directory: str):
             continue
         symbols_by_instrument_id[item["instrument_id"]] = symbol
 
-    cursor = db["popularity"].find(
-        {},
-        projection={"_id": 0, "timestamp": 1, "popularity": 1, "instrument_id": 1},
-        sort=[("instrument_id", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)],
-    )
+    return symbols_by_instrument_id
+
+
+def split_instrument_ids(instrument_ids: List[str], range_count: int) -> List[List[str]]:
+    """ Splits the sorted instrument IDs into at most `range_count` contiguous ranges of roughly
+    equal size. """
+
+    instrument_ids = sorted(instrument_ids)
+    range_size = max(1, math.ceil(len(instrument_ids) / range_count))
+    return [instrument_ids[i : i + range_size] for i in range(0, len(instrument_ids), range_size)]
+
+
+def export_instruments(db, output_directory: str, symbols_by_instrument_id: Dict[str, str]) -> int:
+    """ Writes the CSV files of the provided instruments, returning how many were written. """
+
+    cursor = iter_popularities(db, list(symbols_by_instrument_id.keys()))
 
     written_count = 0
     cur_symbol = None
     acc = []
     for datum in cursor:
-        instrument_id = datum.get("instrument_id")
-        symbol = symbols_by_instrument_id.get(instrument_id)
+        symbol = symbols_by_instrument_id.get(datum.get("instrument_id"))
 
         if symbol is None:
             continue
@@ -67,6 +212,198 @@ def main(output_directory: str):
         write_csv_file(output_directory, cur_symbol, acc)
         written_count += 1
 
+    return written_count
+
+
+def append_instruments(
+    db,
+    output_directory: str,
+    symbols_by_instrument_id: Dict[str, str],
+    watermarks: Dict[str, dict],
+) -> Dict[str, dict]:
+    """ Appends new popularities to the files of the provided instruments, returning their new
+    watermarks. """
+
+    new_watermarks = {}
+    for (instrument_id, symbol) in symbols_by_instrument_id.items():
+        watermark = append_csv_file(
+            db, output_directory, instrument_id, symbol, watermarks.get(instrument_id)
+        )
+        if watermark is not None:
+            new_watermarks[instrument_id] = watermark
+
+    return new_watermarks
+
+
+def export_parquet_day(
+    db, output_directory: str, day: datetime, symbols_by_instrument_id: Dict[str, str]
+) -> int:
+    """ Writes the popularities of a day to its Parquet partition, returning how many were
+    written. """
+
+    columns = {key: [] for key in PARQUET_TYPES}
+    for datum in iter_popularities(
+        db, start=day, end=day + timedelta(days=1), order_by_instrument=False
+    ):
+        symbol = symbols_by_instrument_id.get(datum.get("instrument_id"))
+        if symbol is None:
+            continue
+
+        columns["timestamp"].append(datum["timestamp"])
+        columns["symbol"].append(symbol)
+        columns["instrument_id"].append(datum["instrument_id"])
+        columns["popularity"].append(datum["popularity"])
+
+    if not columns["timestamp"]:
+        return 0
+
+    write_day_partition(output_directory, day, columns, PARQUET_TYPES, PARQUET_DICTIONARY_COLUMNS)
+    return len(columns["timestamp"])
+
+
+def init_worker():
+    global worker_db
+    worker_db = create_db()
+
+
+def export_range(args: Tuple[str, Dict[str, str]]) -> int:
+    (output_directory, symbols_by_instrument_id) = args
+    return export_instruments(worker_db, output_directory, symbols_by_instrument_id)
+
+
+def append_range(args: Tuple[str, Dict[str, str], Dict[str, dict]]) -> Dict[str, dict]:
+    (output_directory, symbols_by_instrument_id, watermarks) = args
+    return append_instruments(worker_db, output_directory, symbols_by_instrument_id, watermarks)
+
+
+def export_parquet_range(args: Tuple[str, datetime, Dict[str, str]]) -> int:
+    (output_directory, day, symbols_by_instrument_id) = args
+    return export_parquet_day(worker_db, output_directory, day, symbols_by_instrument_id)
+
+
+def run_parquet(output_directory: str, symbols_by_instrument_id: Dict[str, str], workers: int):
+    import_pyarrow()
+
+    db = get_db()
+    first_day = get_first_popularity_day(db)
+    if first_day is None:
+        print("No popularities to export")
+        return
+
+    # Today's partition is exported as well and replaced by the next export
+    days = list(get_day_range(first_day, get_bucket_day(datetime.utcnow()) + timedelta(days=1)))
+
+    written_count = 0
+    if workers <= 1:
+        for day in days:
+            written_count += export_parquet_day(db, output_directory, day, symbols_by_instrument_id)
+    else:
+        tasks = [(output_directory, day, symbols_by_instrument_id) for day in days]
+        with Pool(workers, initializer=init_worker) as pool:
+            results = pool.imap_unordered(export_parquet_range, tasks)
+            for (i, day_written_count) in enumerate(results):
+                written_count += day_written_count
+                print(f"Exported {i + 1}/{len(tasks)} days; {written_count} popularities so far")
+
+    print(f"Finished writing {written_count} popularities to {output_directory}!")
+
+
+def run_incremental(output_directory: str, symbols_by_instrument_id: Dict[str, str], workers: int):
+    watermarks = load_watermarks(output_directory)
+    rename_csv_files(output_directory, symbols_by_instrument_id, watermarks)
+
+    if workers <= 1:
+        watermarks.update(
+            append_instruments(get_db(), output_directory, symbols_by_instrument_id, watermarks)
+        )
+    else:
+        ranges = split_instrument_ids(
+            list(symbols_by_instrument_id.keys()), workers * RANGES_PER_WORKER
+        )
+        tasks = [
+            (
+                output_directory,
+                {instrument_id: symbols_by_instrument_id[instrument_id] for instrument_id in ids},
+                {
+                    instrument_id: watermarks[instrument_id]
+                    for instrument_id in ids
+                    if instrument_id in watermarks
+                },
+            )
+            for ids in ranges
+        ]
+
+        with Pool(workers, initializer=init_worker) as pool:
+            for (i, range_watermarks) in enumerate(pool.imap_unordered(append_range, tasks)):
+                watermarks.update(range_watermarks)
+                print(f"Appended {i + 1}/{len(tasks)} instrument ranges")
+
+    save_watermarks(output_directory, watermarks)
+    print(f"Finished appending to {len(watermarks)} CSV files in {output_directory}!")
+
+
+@click.command()
+@click.argument("output-directory", type=click.Path())
+@click.option(
+    "--workers",
+    type=click.INT,
+    default=os.cpu_count(),
+    help="Number of worker processes; defaults to the number of CPUs",
+)
+@click.option(
+    "--incremental",
+    is_flag=True,
+    default=False,
+    help="Only append popularities that are newer than the last incremental export",
+)
+@click.option(
+    "--format",
+    "output_format",
+    type=click.Choice(["csv", "parquet"]),
+    default="csv",
+    help="Write one CSV file per symbol, or a Parquet dataset partitioned by date",
+)
+def main(output_directory: str, workers: int, incremental: bool, output_format: str):
+    if output_format == "parquet" and incremental:
+        print("ERROR: --incremental is only supported for CSV exports")
+        exit(1)
+
+    if not os.path.exists(output_directory):
+        os.makedirs(output_directory, exist_ok=True)
+
+    symbols_by_instrument_id = get_symbols_by_instrument_id(get_db())
+    if output_format == "parquet":
+        run_parquet(output_directory, symbols_by_instrument_id, workers)
+        return
+    if incremental:
+        run_incremental(output_directory, symbols_by_instrument_id, workers)
+        return
+
+    if workers <= 1:
+        written_count = export_instruments(get_db(), output_directory, symbols_by_instrument_id)
+        print(f"Finished writing {written_count} CSV files to {output_directory}!")
+        return
+
+    ranges = split_instrument_ids(
+        list(symbols_by_instrument_id.keys()), workers * RANGES_PER_WORKER
+    )
+    tasks = [
+        (
+            output_directory,
+            {instrument_id: symbols_by_instrument_id[instrument_id] for instrument_id in ids},
+        )
+        for ids in ranges
+    ]
+
+    written_count = 0
+    with Pool(workers, initializer=init_worker) as pool:
+        for (i, range_written_count) in enumerate(pool.imap_unordered(export_range, tasks)):
+            written_count += range_written_count
+            print(
+                f"Exported {i + 1}/{len(tasks)} instrument ranges; "
+                f"{written_count} CSV files written so far"
+            )
+
     print(f"Finished writing {written_count} CSV files to {output_directory}!")
 
 
@@ -0,0 +1,105 @@
+"""
+Exports the quote history of every instrument as a Parquet dataset partitioned by date, in the
+same layout as `main.py --format parquet`.  Days are exported in parallel by a pool of worker
+processes, each with its own MongoDB client.
+"""
+from datetime import datetime, timedelta
+from multiprocessing import Pool
+import os
+from typing import Dict, Tuple
+
+import click
+
+from python_common.db import create_db, get_db
+from python_common.parquet_export import import_pyarrow, write_day_partition
+from python_common.popularity_buckets import get_bucket_day, get_day_range
+from python_common.quote_buckets import BUCKETED_QUOTE_KEYS, get_first_quote_day, iter_quotes
+
+from main import get_symbols_by_instrument_id
+
+PARQUET_TYPES = {
+    "updated_at": "timestamp[ms]",
+    "symbol": "string",
+    "instrument_id": "string",
+    "bid_price": "float64",
+    "ask_price": "float64",
+    "last_trade_price": "float64",
+    "last_extended_hours_trade_price": "float64",
+    "bid_size": "int64",
+    "ask_size": "int64",
+}
+PARQUET_DICTIONARY_COLUMNS = ["symbol", "instrument_id"]
+
+worker_db = None
+
+
+def export_day(db, output_directory: str, day: datetime, symbols_by_instrument_id: Dict[str, str]):
+    """ Writes the quotes of a day to its Parquet partition, returning how many were written. """
+
+    columns = {key: [] for key in PARQUET_TYPES}
+    for quote in iter_quotes(db, start=day, end=day + timedelta(days=1), order_by_instrument=False):
+        symbol = symbols_by_instrument_id.get(quote.get("instrument_id"))
+        if symbol is None:
+            continue
+
+        columns["updated_at"].append(quote["updated_at"])
+        columns["symbol"].append(symbol)
+        columns["instrument_id"].append(quote["instrument_id"])
+        for key in BUCKETED_QUOTE_KEYS:
+            columns[key].append(quote.get(key))
+
+    if not columns["updated_at"]:
+        return 0
+
+    write_day_partition(output_directory, day, columns, PARQUET_TYPES, PARQUET_DICTIONARY_COLUMNS)
+    return len(columns["updated_at"])
+
+
+def init_worker():
+    global worker_db
+    worker_db = create_db()
+
+
+def export_day_task(args: Tuple[str, datetime, Dict[str, str]]) -> int:
+    (output_directory, day, symbols_by_instrument_id) = args
+    return export_day(worker_db, output_directory, day, symbols_by_instrument_id)
+
+
+@click.command()
+@click.argument("output-directory", type=click.Path())
+@click.option(
+    "--workers",
+    type=click.INT,
+    default=os.cpu_count(),
+    help="Number of worker processes; defaults to the number of CPUs",
+)
+def main(output_directory: str, workers: int):
+    import_pyarrow()
+
+    db = get_db()
+    first_day = get_first_quote_day(db)
+    if first_day is None:
+        print("No quotes to export")
+        return
+
+    os.makedirs(output_directory, exist_ok=True)
+    symbols_by_instrument_id = get_symbols_by_instrument_id(db)
+    # Today's partition is exported as well and replaced by the next export
+    days = list(get_day_range(first_day, get_bucket_day(datetime.utcnow()) + timedelta(days=1)))
+
+    written_count = 0
+    if workers <= 1:
+        for day in days:
+            written_count += export_day(db, output_directory, day, symbols_by_instrument_id)
+    else:
+        tasks = [(output_directory, day, symbols_by_instrument_id) for day in days]
+        with Pool(workers, initializer=init_worker) as pool:
+            for (i, day_written_count) in enumerate(pool.imap_unordered(export_day_task, tasks)):
+                written_count += day_written_count
+                print(f"Exported {i + 1}/{len(tasks)} days; {written_count} quotes so far")
+
+    print(f"Finished writing {written_count} quotes to {output_directory}!")
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
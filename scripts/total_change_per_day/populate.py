@@ -1,191 +1,345 @@
+from collections import namedtuple
 import datetime
-from typing import Dict
+from itertools import groupby
+from typing import Dict, Iterator
 
 import click
+import numpy as np
+import pymongo
 
 from python_common.db import get_db
+from python_common.popularity_buckets import BUCKETED_POPULARITY_ENABLED, iter_popularities
+from python_common.quote_buckets import parse_price
+from python_common.schema import ensure_indexes
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+# Number of documents that are read into memory before being reduced during a backfill
+BACKFILL_CHUNK_SIZE = 5_000_000
+CURSOR_BATCH_SIZE = 10_000
+WRITE_BATCH_SIZE = 1000
+
+
+def aggregate_first_last(db, collection: str, time_key: str, value_key: str, start, end):
+    """ Yields the first and last value of every instrument in `[start, end)`.  The documents are
+    walked in the order of the index on `time_key`, so `$group` sees them chronologically. """
+
+    return db[collection].aggregate(
+        [
+            {"$match": {time_key: {"$gte": start, "$lt": end}, value_key: {"$ne": None}}},
+            {"$sort": {time_key: pymongo.ASCENDING}},
+            {
+                "$group": {
+                    "_id": "$instrument_id",
+                    "first": {"$first": f"${value_key}"},
+                    "last": {"$last": f"${value_key}"},
+                }
+            },
+        ],
+        allowDiskUse=True,
+    )
+
+
+def iter_first_last_popularities(db, start, end) -> Iterator[dict]:
+    """ Same as `aggregate_first_last` for popularities, but reads from `popularity_buckets` if
+    `BUCKETED_POPULARITY` is enabled. """
+
+    if not BUCKETED_POPULARITY_ENABLED:
+        yield from aggregate_first_last(db, "popularity", "timestamp", "popularity", start, end)
+        return
+
+    docs = iter_popularities(db, start=start, end=end)
+    for (instrument_id, data) in groupby(docs, key=lambda doc: doc["instrument_id"]):
+        values = [datum["popularity"] for datum in data if datum["popularity"] is not None]
+        if values:
+            yield {"_id": instrument_id, "first": values[0], "last": values[-1]}
+
+
+def get_disabled_days(db) -> set:
+    return set(get_day_number(datum["day_id"]) for datum in db["invalid_dayids"].find())
 
 
 def populate_day(day: str):
+    """ Computes and saves the changes of a single day.  Days cover the same UTC window as in
+    `backfill`, and weekends and disabled days are skipped just like they are there, so that both
+    produce the same changes for every day. """
+
     print(day)
+    day_id = day
     day = datetime.datetime.strptime(day, "%Y-%m-%d")
-    day = day.replace(tzinfo=datetime.timezone(datetime.timedelta(hours=-4)))
     next_day = day + datetime.timedelta(days=1)
-    print(f"Getting changes for day {day}")
 
     db = get_db()
 
-    diffs_by_instrument_id = {}
-    # Iterate through all popularity and quote updates for that day and get the diff for
-    # both for each unique instrument id
-    cur_instrument_id = None
-    cur_start_val = None
-    last_val = None
-    for doc in (
-        db["popularity"]
-        .find({"timestamp": {"$gte": day, "$lt": next_day}})
-        .sort([("instrument_id", 1), ("timestamp", 1)])
-    ):
-        instrument_id = doc["instrument_id"]
-
-        if instrument_id != cur_instrument_id:
-            if cur_start_val is not None and last_val is not None:
-                diffs_by_instrument_id[cur_instrument_id] = {
-                    "start_popularity": int(cur_start_val),
-                    "end_popularity": int(last_val),
-                }
-            cur_instrument_id = instrument_id
-            cur_start_val = doc["popularity"]
+    day_number = get_day_number(day_id)
+    if not get_weekday_mask(np.array([day_number]), get_disabled_days(db))[0]:
+        print(f"Skipping {day_id} since it's a weekend or disabled day")
+        return
+    print(f"Getting changes for day {day}")
 
-        last_val = doc["popularity"]
-    diffs_by_instrument_id[cur_instrument_id] = {
-        "start_popularity": cur_start_val,
-        "end_popularity": last_val,
-    }
+    buckets = {}
+    for doc in iter_first_last_popularities(db, day, next_day):
+        buckets[doc["_id"]] = {"start_pop": int(doc["first"]), "end_pop": int(doc["last"])}
 
     print("Got popularities, getting quotes...")
-    cur_instrument_id = None
-    cur_start_val = None
-    last_val = None
-    for doc in (
-        db["quotes"]
-        .find({"updated_at": {"$gte": day, "$lt": next_day}})
-        .sort([("instrument_id", 1), ("updated_at", 1)])
-    ):
-        instrument_id = doc["instrument_id"]
-
-        if instrument_id != cur_instrument_id:
-            if (
-                diffs_by_instrument_id.get(cur_instrument_id) is not None
-                and cur_start_val is not None
-                and last_val is not None
-            ):
-                if cur_start_val is not None:
-                    diffs_by_instrument_id[cur_instrument_id]["start_price"] = float(cur_start_val)
-                    diffs_by_instrument_id[cur_instrument_id]["end_price"] = float(last_val)
-            cur_instrument_id = instrument_id
-            cur_start_val = doc["last_trade_price"]
-
-        last_val = doc["last_trade_price"]
-    if diffs_by_instrument_id.get(cur_instrument_id) is not None:
-        diffs_by_instrument_id[cur_instrument_id]["start_price"] = cur_start_val
-        diffs_by_instrument_id[cur_instrument_id]["end_price"] = last_val
-
-    total_pop_diff = 0
-    for val in diffs_by_instrument_id.values():
-        if val.get("start_popularity") is None or val.get("end_popularity") is None:
-            continue
-        pop_diff = abs(val["end_popularity"] - val["start_popularity"])
-        total_pop_diff += pop_diff
-
+    for doc in aggregate_first_last(db, "quotes", "updated_at", "last_trade_price", day, next_day):
+        bucket = buckets.setdefault(doc["_id"], {})
+        bucket["start_price"] = parse_price(doc["first"])
+        bucket["end_price"] = parse_price(doc["last"])
+
+    save_backfill(db, {day_id: buckets})
+
+    total_pop_diff = sum(
+        abs(bucket["end_pop"] - bucket["start_pop"])
+        for bucket in buckets.values()
+        if bucket.get("start_pop") is not None
+    )
     print(f"{day} TOTAL POP DIFF: {total_pop_diff}")
 
 
 def save_backfill(db, buckets_by_dayid: Dict[str, Dict[str, dict]]):
+    """ Replaces the changes of every provided day with bulk upserts, removing changes of
+    instruments that are no longer part of a day. """
+
     for (day_id, buckets) in buckets_by_dayid.items():
-        to_insert = []
+        ops = []
         abs_pop_diff_sum = 0
 
         for (instrument_id, doc) in buckets.items():
-            to_insert.append(
-                {
-                    "day_id": day_id,
-                    "instrument_id": instrument_id,
-                    "start_price": doc.get("start_price"),
-                    "end_price": doc.get("end_price"),
-                    "start_popularity": doc.get("start_pop"),
-                    "end_popularity": doc.get("end_pop"),
-                }
+            ops.append(
+                pymongo.ReplaceOne(
+                    {"day_id": day_id, "instrument_id": instrument_id},
+                    {
+                        "day_id": day_id,
+                        "instrument_id": instrument_id,
+                        "start_price": doc.get("start_price"),
+                        "end_price": doc.get("end_price"),
+                        "start_popularity": doc.get("start_pop"),
+                        "end_popularity": doc.get("end_pop"),
+                    },
+                    upsert=True,
+                )
             )
 
             if doc.get("start_pop") is not None and doc.get("end_pop") is not None:
                 abs_pop_diff_sum += abs(doc["end_pop"] - doc["start_pop"])
-        db["total_change_per_day"].delete_many({"day_id": day_id})
-        db["total_change_per_day"].insert_many(to_insert)
 
-        db["total_change_per_day_sums"].delete_many({"day_id": day_id})
-        db["total_change_per_day_sums"].insert_one(
-            {"day_id": day_id, "abs_pop_diff_sum": abs_pop_diff_sum}
+        db["total_change_per_day"].delete_many(
+            {"day_id": day_id, "instrument_id": {"$nin": list(buckets.keys())}}
         )
+        for i in range(0, len(ops), WRITE_BATCH_SIZE):
+            db["total_change_per_day"].bulk_write(ops[i : i + WRITE_BATCH_SIZE], ordered=False)
 
+        db["total_change_per_day_sums"].replace_one(
+            {"day_id": day_id},
+            {"day_id": day_id, "abs_pop_diff_sum": abs_pop_diff_sum},
+            upsert=True,
+        )
 
-def backfill():
-    db = get_db()
-    buckets_by_dayid = {}
 
-    disabled_day_ids = set([datum["day_id"] for datum in db["invalid_dayids"].find()])
+# The first and last value of every (day, instrument) pair, as parallel arrays sorted by day and
+# then instrument code.  Days are numbered from the epoch.
+FirstLast = namedtuple(
+    "FirstLast",
+    ["days", "instruments", "first_seconds", "first_values", "last_seconds", "last_values"],
+)
 
-    for doc in db["popularity"].find():
-        if (
-            doc.get("popularity") is None
-            or doc.get("instrument_id") is None
-            or doc.get("timestamp") is None
-            or doc["timestamp"].isoweekday() >= 6
-        ):
-            continue
 
-        day_id = doc["timestamp"].strftime("%Y-%m-%d")
-        if day_id in disabled_day_ids:
-            continue
-        bucket = buckets_by_dayid.get(day_id)
-        if bucket is None:
-            buckets_by_dayid[day_id] = {}
-            bucket = buckets_by_dayid[day_id]
-
-        instrument_id = doc["instrument_id"]
-        acc = bucket.get(instrument_id)
-        if acc is None:
-            bucket[instrument_id] = {}
-            acc = bucket[instrument_id]
-
-        if acc.get("start_pop_timestamp") is None or acc["start_pop_timestamp"] > doc["timestamp"]:
-            acc["start_pop_timestamp"] = doc["timestamp"]
-            acc["start_pop"] = int(doc["popularity"])
-
-        if acc.get("end_pop_timestamp") is None or acc["end_pop_timestamp"] < doc["timestamp"]:
-            acc["end_pop_timestamp"] = doc["timestamp"]
-            acc["end_pop"] = int(doc["popularity"])
-
-    for doc in db["quotes"].find():
-        if (
-            doc.get("instrument_id") is None
-            or doc.get("updated_at") is None
-            or doc.get("last_trade_price") is None
-            or doc["updated_at"].isoweekday() >= 6
-        ):
-            continue
+def reduce_first_last(
+    days: np.ndarray, instruments: np.ndarray, seconds: np.ndarray, values: np.ndarray
+) -> FirstLast:
+    """ Reduces the provided values to the first and last value of every (day, instrument). """
+
+    if len(days) == 0:
+        empty_int = np.zeros(0, dtype=np.int64)
+        empty_float = np.zeros(0, dtype=np.float64)
+        return FirstLast(empty_int, empty_int, empty_int, empty_float, empty_int, empty_float)
+
+    order = np.lexsort((seconds, instruments, days))
+    (days, instruments) = (days[order], instruments[order])
+    (seconds, values) = (seconds[order], values[order])
+
+    is_group_start = np.ones(len(days), dtype=bool)
+    is_group_start[1:] = (days[1:] != days[:-1]) | (instruments[1:] != instruments[:-1])
+    starts = np.flatnonzero(is_group_start)
+    ends = np.append(starts[1:], len(days)) - 1
+
+    return FirstLast(
+        days[starts],
+        instruments[starts],
+        seconds[starts],
+        values[starts],
+        seconds[ends],
+        values[ends],
+    )
+
+
+def merge_first_last(
+    acc: FirstLast,
+    days: np.ndarray,
+    instruments: np.ndarray,
+    seconds: np.ndarray,
+    values: np.ndarray,
+) -> FirstLast:
+    """ Folds a chunk of values into previously reduced first and last values. """
+
+    if acc is None:
+        return reduce_first_last(days, instruments, seconds, values)
 
-        day_id = doc["updated_at"].strftime("%Y-%m-%d")
-        if day_id in disabled_day_ids:
+    # The first and last value of every group are the only ones that can still win
+    return reduce_first_last(
+        np.concatenate([acc.days, acc.days, days]),
+        np.concatenate([acc.instruments, acc.instruments, instruments]),
+        np.concatenate([acc.first_seconds, acc.last_seconds, seconds]),
+        np.concatenate([acc.first_values, acc.last_values, values]),
+    )
+
+
+def get_day_number(day_id: str) -> int:
+    return int(np.datetime64(day_id, "D").astype(np.int64))
+
+
+def get_day_id(day_number: int) -> str:
+    return str(np.datetime64(int(day_number), "D"))
+
+
+def get_weekday_mask(days: np.ndarray, disabled_days: set) -> np.ndarray:
+    """ Returns which of the provided day numbers are weekdays that aren't disabled. """
+
+    # The epoch was a Thursday
+    mask = (days + 3) % 7 < 5
+    if disabled_days:
+        mask &= ~np.isin(days, list(disabled_days))
+    return mask
+
+
+def stream_first_last(
+    cursor, time_key: str, value_key: str, instrument_codes: Dict[str, int], disabled_days: set
+) -> FirstLast:
+    """ Streams documents into columnar chunks and reduces them to the first and last value of
+    every instrument on every weekday that isn't disabled.  Instrument IDs are assigned codes in
+    `instrument_codes`. """
+
+    acc = None
+    (instruments, timestamps, values) = ([], [], [])
+
+    def flush(acc: FirstLast) -> FirstLast:
+        seconds = np.array(timestamps, dtype="datetime64[s]").astype(np.int64)
+        days = seconds // SECONDS_PER_DAY
+        mask = get_weekday_mask(days, disabled_days)
+
+        return merge_first_last(
+            acc,
+            days[mask],
+            np.array(instruments, dtype=np.int64)[mask],
+            seconds[mask],
+            np.array(values, dtype=np.float64)[mask],
+        )
+
+    for doc in cursor:
+        instrument_id = doc.get("instrument_id")
+        timestamp = doc.get(time_key)
+        value = parse_price(doc.get(value_key))
+        if instrument_id is None or timestamp is None or value is None:
             continue
-        bucket = buckets_by_dayid.get(day_id)
-        if bucket is None:
-            buckets_by_dayid[day_id] = {}
-            bucket = buckets_by_dayid[day_id]
-
-        instrument_id = doc["instrument_id"]
-        acc = bucket.get(instrument_id)
-        if acc is None:
-            bucket[instrument_id] = {}
-            acc = bucket[instrument_id]
-
-        if (
-            acc.get("start_price_timestamp") is None
-            or acc["start_price_timestamp"] > doc["updated_at"]
+
+        instruments.append(instrument_codes.setdefault(instrument_id, len(instrument_codes)))
+        timestamps.append(timestamp)
+        values.append(value)
+
+        if len(values) >= BACKFILL_CHUNK_SIZE:
+            acc = flush(acc)
+            (instruments, timestamps, values) = ([], [], [])
+
+    return flush(acc)
+
+
+def get_day_slice(first_last: FirstLast, day: int) -> slice:
+    return slice(
+        np.searchsorted(first_last.days, day, side="left"),
+        np.searchsorted(first_last.days, day, side="right"),
+    )
+
+
+def backfill():
+    db = get_db()
+
+    disabled_days = get_disabled_days(db)
+    instrument_codes = {}
+
+    print("Reducing popularities...")
+    # The reduction doesn't depend on the order of the documents, so raw popularities are read in
+    # their natural order rather than through the index that `iter_popularities` sorts by
+    if BUCKETED_POPULARITY_ENABLED:
+        popularity_cursor = iter_popularities(db)
+    else:
+        popularity_cursor = db["popularity"].find(
+            {},
+            projection={"_id": False, "instrument_id": True, "timestamp": True, "popularity": True},
+            batch_size=CURSOR_BATCH_SIZE,
+        )
+    popularities = stream_first_last(
+        popularity_cursor,
+        "timestamp",
+        "popularity",
+        instrument_codes,
+        disabled_days,
+    )
+    print("Reducing quotes...")
+    prices = stream_first_last(
+        db["quotes"].find(
+            {},
+            projection={
+                "_id": False,
+                "instrument_id": True,
+                "updated_at": True,
+                "last_trade_price": True,
+            },
+            batch_size=CURSOR_BATCH_SIZE,
+        ),
+        "updated_at",
+        "last_trade_price",
+        instrument_codes,
+        disabled_days,
+    )
+
+    instrument_ids = [None] * len(instrument_codes)
+    for (instrument_id, code) in instrument_codes.items():
+        instrument_ids[code] = instrument_id
+
+    for day in np.union1d(popularities.days, prices.days):
+        buckets = {}
+
+        day_slice = get_day_slice(popularities, day)
+        for (code, start_pop, end_pop) in zip(
+            popularities.instruments[day_slice],
+            popularities.first_values[day_slice],
+            popularities.last_values[day_slice],
         ):
-            acc["start_price_timestamp"] = doc["updated_at"]
-            acc["start_price"] = float(doc["last_trade_price"])
+            buckets[instrument_ids[code]] = {"start_pop": int(start_pop), "end_pop": int(end_pop)}
 
-        if acc.get("end_price_timestamp") is None or acc["end_price_timestamp"] < doc["updated_at"]:
-            acc["end_price_timestamp"] = doc["updated_at"]
-            acc["end_price"] = float(doc["last_trade_price"])
+        day_slice = get_day_slice(prices, day)
+        for (code, start_price, end_price) in zip(
+            prices.instruments[day_slice],
+            prices.first_values[day_slice],
+            prices.last_values[day_slice],
+        ):
+            bucket = buckets.setdefault(instrument_ids[code], {})
+            bucket["start_price"] = float(start_price)
+            bucket["end_price"] = float(end_price)
 
-    save_backfill(db, buckets_by_dayid)
+        day_id = get_day_id(day)
+        save_backfill(db, {day_id: buckets})
+        print(f"Saved changes of {len(buckets)} instruments for {day_id}")
 
 
 @click.command()
 @click.argument("day", type=click.STRING)
 def main(day):
+    ensure_indexes(
+        get_db(), ["popularity", "quotes", "total_change_per_day", "total_change_per_day_sums"]
+    )
+
     if day == "backfill":
         backfill()
     else:
@@ -0,0 +1,263 @@
+from collections import defaultdict, namedtuple
+from datetime import datetime
+from itertools import groupby
+
+import numpy as np
+import pymongo
+import pytest
+
+from python_common import popularity_buckets
+from python_common.popularity_buckets import (
+    POPULARITY_BUCKETS_COLLECTION,
+    build_bucket_doc,
+    get_bucket_day,
+)
+
+import populate
+from populate import get_day_number, get_weekday_mask, reduce_first_last, stream_first_last
+
+
+def seconds_of(*timestamps: str) -> np.ndarray:
+    return np.array(timestamps, dtype="datetime64[s]").astype(np.int64)
+
+
+def test_reduce_first_last_unsorted_input():
+    seconds = seconds_of(
+        "2020-01-06T15:00:00",
+        "2020-01-06T09:00:00",
+        "2020-01-07T10:00:00",
+        "2020-01-06T12:00:00",
+        "2020-01-06T11:00:00",
+    )
+    days = seconds // populate.SECONDS_PER_DAY
+    instruments = np.array([0, 0, 0, 1, 1])
+    values = np.array([3.0, 1.0, 4.0, 6.0, 5.0])
+
+    first_last = reduce_first_last(days, instruments, seconds, values)
+    (monday, tuesday) = (get_day_number("2020-01-06"), get_day_number("2020-01-07"))
+    assert list(first_last.days) == [monday, monday, tuesday]
+    assert list(first_last.instruments) == [0, 1, 0]
+    assert list(first_last.first_values) == [1.0, 5.0, 4.0]
+    assert list(first_last.last_values) == [3.0, 6.0, 4.0]
+
+
+def test_stream_first_last_across_chunks(monkeypatch):
+    monkeypatch.setattr(populate, "BACKFILL_CHUNK_SIZE", 2)
+    cursor = [
+        {"instrument_id": "a", "timestamp": datetime(2020, 1, 6, 10), "popularity": 10},
+        {"instrument_id": "a", "timestamp": datetime(2020, 1, 6, 11), "popularity": 11},
+        {"instrument_id": "a", "timestamp": datetime(2020, 1, 6, 12), "popularity": 12},
+        {"instrument_id": "a", "timestamp": datetime(2020, 1, 6, 13), "popularity": 13},
+    ]
+
+    first_last = stream_first_last(cursor, "timestamp", "popularity", {}, set())
+    assert list(first_last.days) == [get_day_number("2020-01-06")]
+    # The first value comes from the first chunk and the last one from the second chunk
+    assert list(first_last.first_values) == [10.0]
+    assert list(first_last.last_values) == [13.0]
+
+
+def test_weekday_mask():
+    (saturday, sunday, monday) = (
+        get_day_number("2020-01-04"),
+        get_day_number("2020-01-05"),
+        get_day_number("2020-01-06"),
+    )
+    days = np.array([saturday, sunday, monday])
+
+    assert list(get_weekday_mask(days, set())) == [False, False, True]
+    assert list(get_weekday_mask(days, {monday})) == [False, False, False]
+
+
+def matches(doc: dict, query: dict) -> bool:
+    for (key, condition) in query.items():
+        value = doc.get(key)
+        if not isinstance(condition, dict):
+            if value != condition:
+                return False
+            continue
+
+        for (op, operand) in condition.items():
+            if op == "$gte" and not (value is not None and value >= operand):
+                return False
+            if op == "$lt" and not (value is not None and value < operand):
+                return False
+            if op == "$ne" and value == operand:
+                return False
+            if op == "$nin" and value in operand:
+                return False
+            if op == "$in" and value not in operand:
+                return False
+
+    return True
+
+
+class FakeCollection:
+    """ Stores documents in a list and supports just the queries that `populate` makes. """
+
+    def __init__(self):
+        self.docs = []
+
+    def find(self, query=None, projection=None, sort=None, batch_size=None):
+        return [doc for doc in self.docs if matches(doc, query or {})]
+
+    def aggregate(self, pipeline, allowDiskUse=False):
+        (match, sort, group) = pipeline
+        [(time_key, _)] = sort["$sort"].items()
+        value_key = group["$group"]["first"]["$first"][1:]
+
+        values_by_instrument_id = defaultdict(list)
+        for doc in sorted(self.find(match["$match"]), key=lambda doc: doc[time_key]):
+            values_by_instrument_id[doc["instrument_id"]].append(doc[value_key])
+
+        return [
+            {"_id": instrument_id, "first": values[0], "last": values[-1]}
+            for (instrument_id, values) in values_by_instrument_id.items()
+        ]
+
+    def delete_many(self, query):
+        self.docs = [doc for doc in self.docs if not matches(doc, query)]
+
+    def replace_one(self, query, replacement, upsert=False):
+        self.delete_many(query)
+        self.docs.append(dict(replacement))
+
+    def bulk_write(self, ops, ordered=True):
+        for op in ops:
+            self.replace_one(op.filter, op.replacement, op.upsert)
+
+
+RecordedReplaceOne = namedtuple("RecordedReplaceOne", ["filter", "replacement", "upsert"])
+
+
+@pytest.fixture(autouse=True)
+def record_replace_ops(monkeypatch):
+    """ Has `populate` build replacements whose fields `FakeCollection.bulk_write` can read. """
+
+    monkeypatch.setattr(pymongo, "ReplaceOne", RecordedReplaceOne)
+
+
+def popularity(instrument_id: str, timestamp: datetime, value: int) -> dict:
+    return {"instrument_id": instrument_id, "timestamp": timestamp, "popularity": value}
+
+
+def quote(instrument_id: str, updated_at: datetime, price) -> dict:
+    return {"instrument_id": instrument_id, "updated_at": updated_at, "last_trade_price": price}
+
+
+def fixture_db() -> dict:
+    db = defaultdict(FakeCollection)
+    db["popularity"].docs = [
+        # Saturday
+        popularity("a", datetime(2020, 1, 4, 15), 90),
+        popularity("a", datetime(2020, 1, 6, 18), 120),
+        popularity("a", datetime(2020, 1, 6, 14), 100),
+        popularity("b", datetime(2020, 1, 6, 15), 50),
+        popularity("b", datetime(2020, 1, 6, 19), 40),
+        # Samples after 20:00 UTC belong to the same UTC day as the ones before
+        popularity("a", datetime(2020, 1, 6, 22, 30), 140),
+        popularity("b", datetime(2020, 1, 6, 23, 59), 30),
+        popularity("a", datetime(2020, 1, 7, 2), 150),
+        popularity("a", datetime(2020, 1, 7, 15), 130),
+        popularity("a", datetime(2020, 1, 7, 19), 125),
+    ]
+    db["quotes"].docs = [
+        quote("a", datetime(2020, 1, 4, 15), "9.0"),
+        quote("a", datetime(2020, 1, 6, 14), "10.5"),
+        quote("a", datetime(2020, 1, 6, 19), 11.0),
+        quote("a", datetime(2020, 1, 6, 21), "11.5"),
+        quote("c", datetime(2020, 1, 7, 15), "3.25"),
+        quote("c", datetime(2020, 1, 7, 16), None),
+        quote("c", datetime(2020, 1, 7, 17), "3.5"),
+    ]
+    return db
+
+
+def get_changes(db) -> list:
+    return sorted(
+        (
+            {key: value for (key, value) in doc.items() if key != "_id"}
+            for doc in db["total_change_per_day"].docs
+        ),
+        key=lambda doc: (doc["day_id"], doc["instrument_id"]),
+    )
+
+
+def get_sums(db) -> dict:
+    return {doc["day_id"]: doc["abs_pop_diff_sum"] for doc in db["total_change_per_day_sums"].docs}
+
+
+def test_populate_day_matches_backfill(monkeypatch):
+    backfill_db = fixture_db()
+    monkeypatch.setattr(populate, "get_db", lambda: backfill_db)
+    populate.backfill()
+
+    day_db = fixture_db()
+    monkeypatch.setattr(populate, "get_db", lambda: day_db)
+    for day_id in ["2020-01-04", "2020-01-06", "2020-01-07"]:
+        populate.populate_day(day_id)
+
+    assert get_sums(day_db) == get_sums(backfill_db) == {"2020-01-06": 60, "2020-01-07": 25}
+    assert get_changes(day_db) == get_changes(backfill_db)
+    assert get_changes(day_db)[0]["end_price"] == 11.5
+
+
+def test_populate_day_skips_disabled_days(monkeypatch):
+    for populate_fn in [populate.backfill, lambda: populate.populate_day("2020-01-07")]:
+        db = fixture_db()
+        db["invalid_dayids"].docs = [{"day_id": "2020-01-07"}]
+        monkeypatch.setattr(populate, "get_db", lambda: db)
+        populate_fn()
+
+        assert "2020-01-07" not in get_sums(db)
+
+
+def test_populate_day_removes_stale_changes(monkeypatch):
+    db = fixture_db()
+    monkeypatch.setattr(populate, "get_db", lambda: db)
+    stale = {"day_id": "2020-01-06", "instrument_id": "gone", "start_popularity": 1}
+    other_day = {"day_id": "2020-01-07", "instrument_id": "gone", "start_popularity": 1}
+    db["total_change_per_day"].docs = [stale, other_day]
+
+    populate.populate_day("2020-01-06")
+    populate.populate_day("2020-01-06")
+
+    changes = get_changes(db)
+    assert stale not in changes and other_day in changes
+    assert [doc["instrument_id"] for doc in changes if doc["day_id"] == "2020-01-06"] == ["a", "b"]
+    assert get_sums(db) == {"2020-01-06": 60}
+
+
+def test_backfill_reads_popularity_buckets(monkeypatch):
+    raw_db = fixture_db()
+    monkeypatch.setattr(populate, "get_db", lambda: raw_db)
+    populate.backfill()
+
+    bucketed_db = fixture_db()
+    docs = sorted(
+        bucketed_db["popularity"].docs,
+        key=lambda doc: (doc["instrument_id"], get_bucket_day(doc["timestamp"])),
+    )
+    bucketed_db[POPULARITY_BUCKETS_COLLECTION].docs = [
+        build_bucket_doc(instrument_id, day, list(day_docs))
+        for ((instrument_id, day), day_docs) in groupby(
+            docs, key=lambda doc: (doc["instrument_id"], get_bucket_day(doc["timestamp"]))
+        )
+    ]
+    # Only the buckets are left to be read
+    bucketed_db["popularity"].docs = []
+    monkeypatch.setattr(populate, "BUCKETED_POPULARITY_ENABLED", True)
+    monkeypatch.setattr(popularity_buckets, "BUCKETED_POPULARITY_ENABLED", True)
+    monkeypatch.setattr(populate, "get_db", lambda: bucketed_db)
+    populate.backfill()
+
+    assert get_sums(bucketed_db) == get_sums(raw_db)
+    assert get_changes(bucketed_db) == get_changes(raw_db)
+
+    bucketed_db["total_change_per_day"].docs = []
+    bucketed_db["total_change_per_day_sums"].docs = []
+    for day_id in ["2020-01-06", "2020-01-07"]:
+        populate.populate_day(day_id)
+
+    assert get_sums(bucketed_db) == get_sums(raw_db)
+    assert get_changes(bucketed_db) == get_changes(raw_db)